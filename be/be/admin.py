@@ -5,7 +5,7 @@ class SSHKeyAdmin(admin.ModelAdmin):
     list_display = ('id', 'name', 'key_content')
 
 class ServerAdmin(admin.ModelAdmin):
-    list_display = ('id', 'site_name', 'server_name', 'user', 'host', 'ssh_key')
+    list_display = ('id', 'site_name', 'server_name', 'user', 'host', 'port', 'ssh_key')
 
 class RoleAdmin(admin.ModelAdmin):
     filter_horizontal = ('permissions',)
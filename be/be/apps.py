@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class BeConfig(AppConfig):
+    name = 'be'
+
+    def ready(self):
+        # Connects the signal receivers keeping UserServerAccess up to date
+        from . import permissions  # noqa: F401
@@ -9,11 +9,14 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'be.settings')
 django.setup()
 
 from . import routing
+from .ws_auth import JWTAuthMiddleware
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
     "websocket": AuthMiddlewareStack(
-        URLRouter(
-            routing.websocket_urlpatterns
+        JWTAuthMiddleware(
+            URLRouter(
+                routing.websocket_urlpatterns
+            )
         )
     ),
 })
@@ -1,190 +1,856 @@
+import asyncio
+import codecs
+import collections
+import itertools
 import json
-import paramiko
-import threading
-import io
 import traceback
 import logging
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 
 logger = logging.getLogger(__name__)
 from django.shortcuts import get_object_or_404
 from .models import Server
+from .ssh_pump import pump
+from .sessions import (
+    VIEWER_SALT, VIEWER_TOKEN_MAX_AGE, TerminalSession, get_session, register_session, session_group,
+    viewer_group
+)
+from .ssh_pool import resolve_route
+from .prewarm import adopt, claim, close_shell, open_shell
+from .ssh_io import run_ssh_io
+from .permissions import can_connect
+from . import terminal_protocol as protocol
+from . import metrics
+from .recording import Recorder, recording_dir
+from .playback import PLAYBACK_SALT, PLAYBACK_TOKEN_MAX_AGE, RecordingReader
+from .fanout import EXEC_SALT, EXEC_TOKEN_MAX_AGE, resolve_routes, run_exec, select_servers
+from django.core import signing
 from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+def clamp_size(value):
+    # Terminal columns/rows the backend accepts from clients
+    return min(max(value, 1), 1000)
+
+
 class SSHConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         logger.info("SSHConsumer: Entering connect method.")
         self.server_id = self.scope['url_route']['kwargs']['server_id']
         self.session_id = self.scope['url_route']['kwargs']['session_id']
-        self.ssh_client = None
-        self.channel = None
-        self.read_thread = None
+        self.output_buffer = bytearray()
+        self.flush_task = None
+        self.last_flush = 0
+        self.disconnected = False
+        # Output is buffered but not sent while held
+        self.hold_output = False
+        # Set when this consumer closes the session itself (EOF, connect
+        # failure, closed by an administrator) rather than losing the client
+        self.ending_session = False
+        # Set when another connection took over the session
+        self.replaced = False
+        self.loop = asyncio.get_running_loop()
+        self.query = parse_qs(self.scope.get('query_string', b'').decode())
+        # Latest terminal size asked for by the client and the task applying it
+        self.pending_size = None
+        self.resize_task = None
+        # Loop time of the last message from the client, and whether it ever
+        # answered a ping (older clients don't, they are never timed out)
+        self.last_received = self.loop.time()
+        self.answers_pings = False
+        self.heartbeat_task = None
+        # Clients offering the binary subprotocol get raw bytes frames,
+        # everyone else keeps the JSON text messages.
+        self.binary = protocol.SUBPROTOCOL in self.scope.get('subprotocols', [])
+        self.output_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        metrics.monitor_event_loop(self.loop)
 
         logger.info(f"SSHConsumer: Attempting to accept WebSocket connection for server_id={self.server_id}, session_id={self.session_id}")
-        await self.accept()
+        await self.accept(subprotocol=protocol.SUBPROTOCOL if self.binary else None)
+        # Checked again here, the WebSocket URL alone doesn't prove anything
+        user = self.scope.get('user')
+        if not await database_sync_to_async(can_connect)(user, self.server_id):
+            logger.warning(f"SSHConsumer: Permission denied for {getattr(user, 'username', None) or 'anonymous user'} to server_id={self.server_id}")
+            await self.send_control({'error': 'Permission denied.'})
+            await self.close(code=4003)
+            return
+        # Make the session reachable from other workers
+        await self.channel_layer.group_add(session_group(self.session_id), self.channel_name)
+        if settings.TERMINAL_PING_INTERVAL and settings.TERMINAL_PING_TIMEOUT:
+            self.heartbeat_task = self.loop.create_task(self.heartbeat())
         logger.info(f"SSHConsumer: WebSocket connection accepted for server_id={self.server_id}, session_id={self.session_id}")
 
+        session = get_session(self.session_id)
+        if session is not None and session.server_id == self.server_id and session.user_id == user.id and session.resumable():
+            await self.resume_session(session)
+            return
+
+        # Only binary clients acknowledge output, so only they get flow control
+        self.session = TerminalSession(self.session_id, self.server_id, flow_control=self.binary, user_id=user.id)
+        register_session(self.session)
+        await self.send_control({'type': 'session_started'})
 
         import datetime
         current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         logger.info(f"SSHConsumer: WebSocket connection established at {current_time}. Sending current time to frontend.")
-        await self.send(text_data=json.dumps({
+        await self.send_control({
             'type': 'time_update',
             'time': current_time
-        }))
+        })
 
+        started = time.monotonic()
+        # A shell connect_server started opening for this session, if any
+        warm = claim(self.session_id, int(self.server_id), user.id) if settings.TERMINAL_PREWARM_TIMEOUT else None
+        # Open the PTY at the client's size right away, instead of 80x24
+        # followed by a resize and a redraw
+        cols = self.query_size('cols', 80)
+        rows = self.query_size('rows', 24)
         try:
             logger.info(f"SSHConsumer: WebSocket connected for server_id={self.server_id}, session_id={self.session_id}")
-            # Fetch server and SSH key details
-            logger.info("SSHConsumer: Fetching server details...")
-            server = await self.get_server(self.server_id)
-            logger.info(f"SSHConsumer: Fetched server details for {server.site_name} - {server.server_name}")
-            ssh_key = await sync_to_async(lambda: server.ssh_key)()
-            # Decrypt the SSH key
-            logger.info("SSHConsumer: Decrypting SSH key...")
-            ssh_key_content = ssh_key.decrypt_key()
-            logger.info("SSHConsumer: SSH key decrypted.")
-
-            # Establish SSH connection
-            logger.info("SSHConsumer: Initializing SSH client...")
-            self.ssh_client = paramiko.SSHClient()
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            logger.info("SSHConsumer: SSH client initialized.")
-
-            # Load the private key
-            logger.info("SSHConsumer: Loading private key...")
-            # Use sync_to_async for synchronous key loading
-            pkey = await sync_to_async(paramiko.RSAKey.from_private_key)(io.StringIO(ssh_key_content))
-            logger.info("SSHConsumer: Private key loaded.")
-
-            proxy_server = await sync_to_async(lambda: server.proxy_server)()
-            if proxy_server:
-                logger.info(f"SSHConsumer: Connecting via proxy server {proxy_server.host}...")
-                # Connect to the proxy server
-                proxy_server = await self.get_server(proxy_server.id)
-                proxy_ssh_key = await sync_to_async(lambda: proxy_server.ssh_key)()
-                proxy_ssh_key_content = proxy_ssh_key.decrypt_key()
-                proxy_pkey = await sync_to_async(paramiko.RSAKey.from_private_key)(io.StringIO(proxy_ssh_key_content))
-
-                # Create a transport to the proxy server
-                transport = paramiko.Transport((proxy_server.host, 22))
-                transport.connect(username=proxy_server.user, pkey=proxy_pkey)
-
-                # Open a channel through the proxy to the destination server
-                channel = transport.open_channel("direct-tcpip", (server.host, 22), ("127.0.0.1", 0))
-
-                # Authenticate to the destination server
-                self.ssh_client.connect(server.host, username=server.user, pkey=pkey, sock=channel)
-                logger.info(f"SSHConsumer: SSH connection established via proxy server {proxy_server.host}.")
+            if warm is not None:
+                logger.info("SSHConsumer: Adopting the prewarmed shell...")
+                ssh_client, channel = await adopt(warm)
+                timings = warm.timings
+                self.session.size = warm.size
             else:
-                logger.info(f"SSHConsumer: Attempting to connect to {server.host} as {server.user}...")
-                # Use sync_to_async for synchronous SSH connection
-                await sync_to_async(self.ssh_client.connect)(server.host, username=server.user, pkey=pkey)
-                logger.info("SSHConsumer: SSH connection established.")
+                timings = {}
+                # Fetch server and SSH key details
+                logger.info("SSHConsumer: Fetching server details...")
+                with metrics.ssh_connect_seconds.time(phase='db_lookup') as timer:
+                    server = await self.get_server(self.server_id)
+                    route = await sync_to_async(resolve_route)(server)
+                timings['db_lookup'] = timer.seconds
+                logger.info(f"SSHConsumer: Fetched server details for {server.site_name} - {server.server_name}")
+                for proxy_server, _ in route[:-1]:
+                    logger.info(f"SSHConsumer: Connecting via proxy server {proxy_server.host}:{proxy_server.port}...")
 
-            # Start a shell
-            logger.info("SSHConsumer: Invoking shell...")
-            self.channel = self.ssh_client.invoke_shell()
+                logger.info(f"SSHConsumer: Attempting to connect to {server.host} as {server.user}...")
+                # Reuse pooled connections to the server and its proxy servers
+                # if there are any. Only new connections decrypt keys and
+                # handshake.
+                timeout = settings.SSH_CONNECT_TIMEOUT * len(route) + settings.SSH_IO_TIMEOUT
+                ssh_client, channel = await run_ssh_io(
+                    open_shell, route, (cols, rows), timings, time.monotonic() + timeout,
+                    timeout=timeout, on_abandoned=close_shell
+                )
+                self.session.size = (cols, rows)
             logger.info("SSHConsumer: Shell invoked.")
 
-            # Start a thread to read from the SSH channel
-            self.read_thread = threading.Thread(target=self.read_from_channel, daemon=True)
-            self.read_thread.start()
+            if settings.TERMINAL_RECORDING_DIR:
+                # Set before the pump starts reading, so the first output is
+                # recorded. The session doesn't own the shell yet, so close
+                # it here if the recording can't be started.
+                try:
+                    self.session.recorder = Recorder(self.server_id, self.session_id, width=cols, height=rows)
+                except Exception:
+                    await run_ssh_io(close_shell, (ssh_client, channel))
+                    raise
+
+            # From here on the session owns the connection and the channel
+            self.session.start(ssh_client, channel, self)
+            logger.info("SSHConsumer: Channel registered with pump.")
+            if self.disconnected:
+                # The client left while we were connecting
+                await self.session.close()
+                return
+            if self.session.size != (cols, rows):
+                # The prewarmed shell was opened at another size
+                self.request_resize(cols, rows)
+            # Where the time to the prompt went, for the client to show or log
+            await self.send_control({
+                'type': 'connect_timing',
+                'prewarmed': warm is not None,
+                'reused_connection': 'tcp_kex' not in timings,
+                'seconds': round(time.monotonic() - started, 4),
+                'phases': {phase: round(seconds, 4) for phase, seconds in timings.items()},
+            })
 
+        except asyncio.TimeoutError:
+            metrics.ssh_connect_failures.inc(reason='timeout')
+            logger.error(f"SSH connection to server_id={self.server_id} timed out.")
+            await self.fail_connect('Failed to connect to server: timed out')
         except Exception as e:
+            metrics.ssh_connect_failures.inc(reason='error')
             logger.error(f"SSH connection error: {e}", exc_info=True)
-            await self.send(text_data=json.dumps({
-                'error': f'Failed to connect to server: {e}'
-            }))
-            await self.close()
+            await self.fail_connect(f'Failed to connect to server: {e}')
+
+    async def fail_connect(self, error):
+        self.ending_session = True
+        await self.session.close()
+        await self.send_control({'error': error})
+        await self.close()
+
+    async def resume_session(self, session):
+        # The client tells us how many output bytes it already has
+        offset = self.query.get('offset', [None])[0]
+        self.session = session
+        self.hold_output = True
+        previous, start = session.attach(self, int(offset) if offset and offset.isdigit() else None)
+        if previous is not None:
+            # The old connection may not have noticed it is gone yet
+            previous.replaced = True
+            await previous.close()
+        # Announced before the replay, so the client knows where it starts
+        await self.send_control({'type': 'session_resumed', 'offset': start})
+        self.hold_output = False
+        self.schedule_flush()
+        # The client may come back with another window size
+        if 'cols' in self.query and 'rows' in self.query:
+            self.request_resize(self.query_size('cols', 80), self.query_size('rows', 24))
 
     async def disconnect(self, close_code):
         logger.info(f"SSHConsumer: Disconnecting with code {close_code}")
-        if self.channel:
-            self.channel.close()
-            logger.info("SSHConsumer: SSH channel closed.")
-        if self.ssh_client:
-            self.ssh_client.close()
-            logger.info("SSHConsumer: SSH client closed.")
-        if self.read_thread and self.read_thread.is_alive():
-            # It's generally not safe to forcefully stop a thread,
-            # but for a daemon thread reading from a closed channel,
-            # it should exit naturally. We can add a small timeout
-            # if needed, but for now, rely on the channel closing.
+        self.disconnected = True
+        await self.channel_layer.group_discard(session_group(self.session_id), self.channel_name)
+        if self.flush_task:
+            self.flush_task.cancel()
+        if self.resize_task:
+            self.resize_task.cancel()
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+        session = getattr(self, 'session', None)
+        if session is None or self.replaced:
             pass
+        elif (
+            session.resumable() and not self.ending_session and close_code != 1000
+            and settings.TERMINAL_SESSION_GRACE > 0
+        ):
+            # The client went away without closing the terminal: keep the
+            # shell running so it can reconnect
+            session.detach(self)
+        elif session.channel is not None:
+            await session.close()
         logger.info("SSHConsumer: Disconnect method finished.")
 
 
-    async def receive(self, text_data):
-        logger.info(f"SSHConsumer: Received message: {text_data}")
+    async def receive(self, text_data=None, bytes_data=None):
+        # Hot path: never log payloads, which may hold typed secrets. The
+        # session logs a sample of its traffic at DEBUG instead.
+        self.last_received = self.loop.time()
         try:
+            if bytes_data is not None:
+                await self.receive_frame(bytes_data)
+                return
+
             text_data_json = json.loads(text_data)
+            if text_data_json.get('type') == 'resize':
+                self.request_resize(text_data_json['cols'], text_data_json['rows'])
+                return
+            if text_data_json.get('type') == 'pong':
+                self.answers_pings = True
+                return
             message = text_data_json.get('message')
 
-            if self.channel and message:
-                logger.info(f"SSHConsumer: Sending message to SSH channel: {message}")
-                self.channel.send(message)
+            if self.session.channel and message:
+                self.session.write_input(message.encode())
         except Exception as e:
             logger.error(f"Error receiving message: {e}", exc_info=True)
 
-    def read_from_channel(self):
-        logger.info("SSHConsumer: Read thread started.")
+    async def receive_frame(self, frame):
+        opcode, payload = protocol.decode_frame(frame)
+        channel = self.session.channel
+        if not channel:
+            return
+        if opcode == protocol.OP_DATA:
+            self.session.write_input(payload)
+        elif opcode == protocol.OP_RESIZE:
+            self.request_resize(*protocol.decode_resize(payload))
+        elif opcode == protocol.OP_ACK:
+            if self.session.output_acked(protocol.decode_ack(payload)):
+                logger.debug("SSHConsumer: Output drained below low-water mark, resuming channel.")
+                pump.resume(channel)
+        elif opcode == protocol.OP_CONTROL:
+            message = protocol.decode_control(payload)
+            if message.get('type') == 'resize':
+                self.request_resize(message['cols'], message['rows'])
+            elif message.get('type') == 'pong':
+                self.answers_pings = True
+            else:
+                logger.info(f"SSHConsumer: Ignoring control message: {message}")
+        else:
+            logger.warning(f"SSHConsumer: Unknown frame opcode {opcode}")
+
+    async def heartbeat(self):
+        # Pings the client every TERMINAL_PING_INTERVAL seconds. A client that
+        # answers pings but sent nothing for TERMINAL_PING_TIMEOUT seconds is
+        # gone, even if TCP hasn't noticed: detach the session as for any lost
+        # connection, without waiting for the server to give up on the socket.
+        while True:
+            await asyncio.sleep(settings.TERMINAL_PING_INTERVAL)
+            if self.answers_pings and self.loop.time() - self.last_received >= settings.TERMINAL_PING_TIMEOUT:
+                logger.warning(f"SSHConsumer: No answer from the client of session {self.session_id}, dropping it.")
+                metrics.terminal_reaped.inc(reason='ping_timeout')
+                self.heartbeat_task = None
+                session = getattr(self, 'session', None)
+                if session is not None and session.resumable() and settings.TERMINAL_SESSION_GRACE > 0:
+                    session.detach(self)
+                await self.close(code=4408)
+                return
+            await self.send_control({
+                'type': 'ping',
+                'interval': settings.TERMINAL_PING_INTERVAL,
+                'timeout': settings.TERMINAL_PING_TIMEOUT,
+            })
+
+    def query_size(self, name, default):
+        value = self.query.get(name, [''])[0]
+        return clamp_size(int(value)) if value.isdigit() else default
+
+    def request_resize(self, cols, rows):
+        # Dragging a window edge sends a burst of sizes: apply the first one
+        # right away, then only the latest one per TERMINAL_RESIZE_DEBOUNCE
+        self.pending_size = (clamp_size(int(cols)), clamp_size(int(rows)))
+        if self.resize_task is None:
+            self.resize_task = self.loop.create_task(self.apply_resize())
+
+    async def apply_resize(self):
         try:
-            while not self.channel.closed:
-                if self.channel.recv_ready():
-                    data = self.channel.recv(1024).decode()
-                    logger.info(f"SSHConsumer: Received data from channel: {data}")
-                    # Send data back to the WebSocket consumer's receive method
-                    from asgiref.sync import async_to_sync
-                    async_to_sync(self.channel_layer.send)(
-                        self.channel_name,
-                        {
-                            'type': 'ssh_output',
-                            'output': data
-                        }
-                    )
-                elif self.channel.recv_stderr_ready():
-                    data = self.channel.recv_stderr(1024).decode()
-                    logger.info(f"SSHConsumer: Received stderr from channel: {data}")
-                    # Send data back to the WebSocket consumer's receive method
-                    from asgiref.sync import async_to_sync
-                    async_to_sync(self.channel_layer.send)(
-                        self.channel_name,
-                        {
-                            'type': 'ssh_output',
-                            'output': data
-                        }
-                    )
-                else:
-                    # Small sleep to prevent busy-waiting
-                    import time
-                    time.sleep(0.01)
+            while self.pending_size is not None:
+                size, self.pending_size = self.pending_size, None
+                channel = self.session.channel
+                if channel and size != self.session.size:
+                    cols, rows = size
+                    await run_ssh_io(channel.resize_pty, width=cols, height=rows)
+                    self.session.size = size
+                    self.session.record_resize(cols, rows)
+                await asyncio.sleep(settings.TERMINAL_RESIZE_DEBOUNCE)
         except Exception as e:
-            logger.error(f"Error reading from channel: {e}", exc_info=True)
+            logger.error(f"SSHConsumer: Resizing the terminal failed: {e!r}")
         finally:
-            logger.info("SSHConsumer: Read thread finished.")
-            # Signal the consumer to close the WebSocket
-            from asgiref.sync import async_to_sync
-            async_to_sync(self.channel_layer.send)(
-                self.channel_name,
-                {
-                    'type': 'ssh_close'
-                }
-            )
+            self.resize_task = None
+
+    # Send a status/error message in whichever protocol the client speaks
+    async def send_control(self, message):
+        if self.binary:
+            await self.send(bytes_data=protocol.encode_control(message))
+        else:
+            await self.send(text_data=json.dumps(message))
 
     async def get_server(self, server_id):
         # Since Django ORM is synchronous, run it in a separate thread pool
         # or use Django's async support if available (Django 3.1+)
         # Assuming Django 3.1+ or using sync_to_async
         from asgiref.sync import sync_to_async
-        return await sync_to_async(get_object_or_404)(Server, pk=server_id)
+        return await sync_to_async(get_object_or_404)(Server.objects.select_related('ssh_key'), pk=server_id)
 
-    # Handler for messages received from the read_from_channel thread
-    async def ssh_output(self, event):
-        logger.info(f"SSHConsumer: Sending SSH output to WebSocket: {event['output']}")
+    # Runs on the event loop for output handed over by the session
+    def queue_output(self, data):
+        if self.disconnected:
+            return
+        self.output_buffer += data
+        if not self.hold_output:
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        # Coalesce output into one WebSocket frame per flush window. The first
+        # chunk after an idle period is flushed right away so interactive
+        # echo isn't delayed, while floods are merged into larger frames.
+        if not self.output_buffer:
+            return
+        if len(self.output_buffer) >= settings.TERMINAL_OUTPUT_FLUSH_BYTES:
+            delay = 0
+        else:
+            delay = self.last_flush + settings.TERMINAL_OUTPUT_FLUSH_INTERVAL - self.loop.time()
+        if self.flush_task is None:
+            self.flush_task = self.loop.create_task(self.flush_output_later(delay))
+        elif delay <= 0 and not self.flush_task.done():
+            # A full buffer doesn't wait for the rest of the window
+            self.flush_task.cancel()
+            self.flush_task = self.loop.create_task(self.flush_output_later(0))
+
+    async def flush_output_later(self, delay):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Cleared before sending, so only a sleeping task is ever cancelled
+        self.flush_task = None
+        await self.flush_output()
+
+    async def flush_output(self):
+        self.last_flush = self.loop.time()
+        if not self.output_buffer:
+            return
+        output = bytes(self.output_buffer)
+        self.output_buffer.clear()
+        self.session.record_output(output)
         # Send the SSH output to the WebSocket
-        await self.send(text_data=json.dumps({'output': event['output']}))
+        if self.binary:
+            # Raw bytes, xterm.js takes care of decoding
+            await self.send(bytes_data=protocol.encode_frame(protocol.OP_DATA, output))
+        else:
+            # The incremental decoder keeps multi-byte UTF-8 sequences that
+            # are split across flushes intact
+            await self.send(text_data=json.dumps({'output': self.output_decoder.decode(output)}))
+        if not self.session.flow_control and self.session.output_acked(len(output)):
+            # A text client reattached to a session paused for an earlier
+            # binary client: what was pending is sent, read the channel again
+            pump.resume(self.session.channel)
+
+    # Close the WebSocket once the SSH channel closes and its output is sent
+    async def close_after_output(self):
+        if self.disconnected or self.replaced:
+            return
+        logger.info("SSHConsumer: SSH channel closed. Closing WebSocket.")
+        self.ending_session = True
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush_output()
+        await self.close()
+
+    # Handler for session.close messages sent to the session group from any worker
+    async def session_close(self, event):
+        logger.info(f"SSHConsumer: Session {self.session_id} closed remotely: {event.get('reason')}")
+        await self.send_control({
+            'error': f"Session closed: {event.get('reason', 'closed by administrator')}"
+        })
+        self.ending_session = True
+        await self.close()
+
+    # Handlers for messages of TerminalViewerConsumers, from any worker
+
+    async def session_viewer_join(self, event):
+        # Also sent every TERMINAL_VIEWER_LEASE / 3 seconds to renew the lease
+        session = getattr(self, 'session', None)
+        if session is None or session.channel is None or self.replaced:
+            return
+        session.add_viewer(event['reply_channel'])
+        if not event.get('snapshot'):
+            return
+        offset, data = session.snapshot()
+        cols, rows = session.size
+        try:
+            await self.channel_layer.send(event['reply_channel'], {
+                'type': 'viewer.snapshot',
+                'offset': offset,
+                'frame': protocol.encode_frame(protocol.OP_DATA, data),
+                'cols': cols,
+                'rows': rows,
+            })
+        except Exception as e:
+            logger.warning(f"SSHConsumer: Sending a snapshot of session {self.session_id} to a viewer failed: {e!r}")
+
+    async def session_viewer_leave(self, event):
+        session = getattr(self, 'session', None)
+        if session is not None:
+            session.remove_viewer(event['reply_channel'])
+
+    async def session_viewer_input(self, event):
+        # Input of a co-driving viewer
+        session = getattr(self, 'session', None)
+        if session is not None and session.channel and not self.replaced:
+            session.write_input(event['data'])
+
+
+# A viewer that hasn't got its first snapshot after this many seconds gives up
+VIEWER_JOIN_TIMEOUT = 5
+
+
+class TerminalViewerConsumer(AsyncWebsocketConsumer):
+    """
+    Watches a terminal session owned by another connection, read-only
+    ('view') or also typing into it ('drive'), without an SSH connection of
+    its own. The session broadcasts its output to a viewer group, tagged with
+    byte offsets. A viewer that misses output (its channel layer queue was
+    full, or its client stopped acknowledging) drops it and redraws from a
+    snapshot instead of slowing down the session.
+    """
+
+    async def connect(self):
+        self.heartbeat_task = None
+        try:
+            target = signing.loads(self.scope['url_route']['kwargs']['token'], salt=VIEWER_SALT, max_age=VIEWER_TOKEN_MAX_AGE)
+        except signing.BadSignature:
+            logger.warning("TerminalViewerConsumer: Rejected invalid or expired viewer token.")
+            await self.close()
+            return
+        self.session_id = target['session_id']
+        self.mode = target['mode']
+        self.loop = asyncio.get_running_loop()
+        self.binary = protocol.SUBPROTOCOL in self.scope.get('subprotocols', [])
+        self.output_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        # Offset of the next output byte to show, None until a snapshot arrives
+        self.offset = None
+        # Output bytes sent but not yet acknowledged by a binary client, and
+        # whether output is being dropped until it catches up
+        self.unacked_bytes = 0
+        self.lagging = False
+        await self.accept(subprotocol=protocol.SUBPROTOCOL if self.binary else None)
+        await self.channel_layer.group_add(viewer_group(self.session_id), self.channel_name)
+        logger.info(f"TerminalViewerConsumer: Watching session {self.session_id} ({self.mode}).")
+        self.heartbeat_task = self.loop.create_task(self.heartbeat())
+
+    async def disconnect(self, close_code):
+        if self.heartbeat_task is None:
+            return
+        self.heartbeat_task.cancel()
+        await self.channel_layer.group_discard(viewer_group(self.session_id), self.channel_name)
+        await self.channel_layer.group_send(session_group(self.session_id), {
+            'type': 'session.viewer_leave', 'reply_channel': self.channel_name
+        })
+
+    async def heartbeat(self):
+        await self.join()
+        await asyncio.sleep(VIEWER_JOIN_TIMEOUT)
+        if self.offset is None and not self.lagging:
+            await self.send_control({'error': 'Session not found or not connected.'})
+            await self.close()
+            return
+        while True:
+            await asyncio.sleep(settings.TERMINAL_VIEWER_LEASE / 3)
+            await self.join()
+
+    async def join(self):
+        # Renews the lease, and asks for a snapshot until one arrived
+        await self.channel_layer.group_send(session_group(self.session_id), {
+            'type': 'session.viewer_join',
+            'reply_channel': self.channel_name,
+            'snapshot': self.offset is None and not self.lagging,
+        })
+
+    async def resync(self):
+        self.offset = None
+        await self.join()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            if bytes_data is not None:
+                opcode, payload = protocol.decode_frame(bytes_data)
+                if opcode == protocol.OP_DATA:
+                    await self.send_input(payload)
+                elif opcode == protocol.OP_ACK:
+                    self.unacked_bytes = max(0, self.unacked_bytes - protocol.decode_ack(payload))
+                    if self.lagging and self.unacked_bytes <= settings.TERMINAL_FLOW_LOW_WATER:
+                        self.lagging = False
+                        await self.resync()
+                # Viewers follow the size of the session, resizes are ignored
+                return
+            message = json.loads(text_data).get('message')
+            if message:
+                await self.send_input(message.encode())
+        except Exception as e:
+            logger.error(f"TerminalViewerConsumer: Error receiving message: {e}", exc_info=True)
+
+    async def send_input(self, data):
+        if self.mode != 'drive':
+            return
+        await self.channel_layer.group_send(session_group(self.session_id), {
+            'type': 'session.viewer_input', 'data': data
+        })
+
+    async def viewer_output(self, event):
+        if self.offset is None:
+            return
+        frame = event['frame']
+        offset = event['offset']
+        end = offset + len(frame) - 1
+        if end <= self.offset:
+            # Already part of the snapshot
+            return
+        if offset > self.offset:
+            logger.debug("TerminalViewerConsumer: Missed %d bytes of output, resyncing.", offset - self.offset)
+            await self.resync()
+            return
+        if self.binary and self.unacked_bytes >= settings.TERMINAL_FLOW_HIGH_WATER:
+            # The client can't keep up: drop output until it caught up, then
+            # redraw from a snapshot
+            self.offset = None
+            self.lagging = True
+            return
+        if offset < self.offset:
+            # Starts inside the snapshot
+            frame = frame[:1] + frame[1 + self.offset - offset:]
+        self.offset = end
+        await self.send_output(frame)
+
+    async def viewer_snapshot(self, event):
+        if self.lagging:
+            return
+        frame = event['frame']
+        self.offset = event['offset'] + len(frame) - 1
+        self.output_decoder.reset()
+        # The client clears its screen before the snapshot is written
+        await self.send_control({'type': 'snapshot', 'cols': event['cols'], 'rows': event['rows']})
+        await self.send_output(frame)
 
-    # Handler to close the WebSocket when the SSH channel closes
-    async def ssh_close(self, event):
-        logger.info("SSHConsumer: Received ssh_close event. Closing WebSocket.")
+    async def viewer_resize(self, event):
+        await self.send_control({'type': 'resize', 'cols': event['cols'], 'rows': event['rows']})
+
+    async def viewer_end(self, event):
+        await self.send_control({'type': 'session_ended'})
         await self.close()
+
+    async def send_output(self, frame):
+        if self.binary:
+            self.unacked_bytes += len(frame) - 1
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=json.dumps({'output': self.output_decoder.decode(frame[1:])}))
+
+    async def send_control(self, message):
+        if self.binary:
+            await self.send(bytes_data=protocol.encode_control(message))
+        else:
+            await self.send(text_data=json.dumps(message))
+
+
+class ExecConsumer(AsyncWebsocketConsumer):
+    """
+    Runs one command on every server of a selection at once (see fanout.py)
+    and sends each host's result as soon as it finishes, tagged with its
+    server. The client may send {'action': 'cancel'} to stop waiting for
+    the hosts that haven't finished.
+    """
+
+    async def connect(self):
+        self.tasks = []
+        self.run_task = None
+        try:
+            run = signing.loads(self.scope['url_route']['kwargs']['token'], salt=EXEC_SALT, max_age=EXEC_TOKEN_MAX_AGE)
+        except signing.BadSignature:
+            logger.warning("ExecConsumer: Rejected invalid or expired exec token.")
+            await self.close()
+            return
+        await self.accept()
+        self.run_task = asyncio.create_task(self.run(run))
+
+    async def disconnect(self, close_code):
+        self.cancel()
+        if self.run_task:
+            self.run_task.cancel()
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            message = json.loads(text_data)
+        except (TypeError, ValueError):
+            return
+        if message.get('action') == 'cancel':
+            self.cancel()
+
+    async def run(self, run):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        # Selected again, permissions may have changed since the URL was
+        # handed out
+        def select():
+            servers = select_servers(run['user_id'], run['site_name'], run['server_ids'])
+            return resolve_routes(servers[:settings.EXEC_FANOUT_MAX_HOSTS])
+        try:
+            routes = await database_sync_to_async(select)()
+        except Exception as e:
+            logger.error(f"ExecConsumer: Selecting servers for {run['username']} failed: {e}")
+            await self.send(text_data=json.dumps({'type': 'exec_error', 'error': 'Failed to select the servers.'}))
+            await self.close()
+            return
+        logger.info(f"ExecConsumer: User {run['username']} running {run['command']!r} on {len(routes)} servers.")
+        await self.send(text_data=json.dumps({
+            'type': 'exec_started',
+            'command': run['command'],
+            'servers': [
+                {'id': server.id, 'site_name': server.site_name, 'server_name': server.server_name}
+                for server in routes
+            ],
+        }))
+
+        self.tasks = [
+            asyncio.create_task(self.run_host(server, route, run['command']))
+            for server, route in routes.items()
+        ]
+        outcomes = collections.Counter(
+            'cancelled' if isinstance(outcome, asyncio.CancelledError) else outcome
+            for outcome in await asyncio.gather(*self.tasks, return_exceptions=True)
+        )
+        logger.info(f"ExecConsumer: Finished {run['command']!r} for {run['username']}: {dict(outcomes)}")
+        await self.send(text_data=json.dumps({
+            'type': 'exec_finished',
+            'results': dict(outcomes),
+            'seconds': round(loop.time() - started, 3),
+        }))
+        await self.close()
+
+    async def run_host(self, server, route, command):
+        started = asyncio.get_running_loop().time()
+        result = {
+            'type': 'exec_result',
+            'server_id': server.id,
+            'site_name': server.site_name,
+            'server_name': server.server_name,
+        }
+        try:
+            if isinstance(route, Exception):
+                raise route
+            exit_status, output, truncated = await run_exec(route, command)
+            result.update(exit_status=exit_status, output=output.decode('utf-8', errors='replace'), truncated=truncated)
+            outcome = 'ok' if exit_status == 0 else 'failed'
+        except TimeoutError:
+            result['error'] = 'Timed out.'
+            outcome = 'timeout'
+        except Exception as e:
+            logger.warning(f"ExecConsumer: Command on {server.site_name}-{server.server_name} failed: {e}")
+            result['error'] = str(e) or type(e).__name__
+            outcome = 'error'
+        result['seconds'] = round(asyncio.get_running_loop().time() - started, 3)
+        metrics.exec_hosts.inc(result=outcome)
+        await self.send(text_data=json.dumps(result))
+        return outcome
+
+
+# Events read from the recording per executor call
+PLAYBACK_BATCH_EVENTS = 500
+# Speeds a playback can run at
+PLAYBACK_MIN_SPEED = 1
+PLAYBACK_MAX_SPEED = 50
+
+
+class PlaybackConsumer(AsyncWebsocketConsumer):
+    """
+    Replays a recorded session in real time (or up to 50x faster), with
+    pause and seek. Client messages are JSON objects with an 'action' of
+    'play', 'pause', 'speed' (with 'speed') or 'seek' (with 'time').
+    """
+
+    async def connect(self):
+        self.play_task = None
+        try:
+            target = signing.loads(self.scope['url_route']['kwargs']['token'], salt=PLAYBACK_SALT, max_age=PLAYBACK_TOKEN_MAX_AGE)
+        except signing.BadSignature:
+            logger.warning("PlaybackConsumer: Rejected invalid or expired playback token.")
+            await self.close()
+            return
+        await self.accept()
+        try:
+            self.reader = await sync_to_async(RecordingReader, thread_sensitive=False)(
+                recording_dir(target['server_id'], target['session_id'])
+            )
+        except (OSError, ValueError) as e:
+            logger.error(f"PlaybackConsumer: Cannot open recording {target}: {e}")
+            await self.send(text_data=json.dumps({'error': 'Recording not found.'}))
+            await self.close()
+            return
+        logger.info(f"PlaybackConsumer: Playing back recording of session {target['session_id']} on server {target['server_id']}.")
+        self.speed = PLAYBACK_MIN_SPEED
+        self.playing = True
+        # Recording time shown at loop time anchor_time, for the current speed
+        self.position = 0
+        self.anchor_position = 0
+        self.anchor_time = 0
+        # Set when play/pause/speed change, to wake up a waiting playback
+        self.changed = asyncio.Event()
+        await self.send(text_data=json.dumps({
+            'type': 'playback_info',
+            'duration': self.reader.duration,
+            'cols': self.reader.width,
+            'rows': self.reader.height,
+        }))
+        self.seek(0)
+
+    async def disconnect(self, close_code):
+        if self.play_task:
+            self.play_task.cancel()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            message = json.loads(text_data)
+            action = message.get('action')
+            if action == 'seek':
+                self.seek(max(0.0, float(message['time'])))
+            elif action == 'speed':
+                self.reanchor()
+                self.speed = min(PLAYBACK_MAX_SPEED, max(PLAYBACK_MIN_SPEED, float(message['speed'])))
+                self.changed.set()
+            elif action in ('play', 'pause'):
+                self.reanchor()
+                self.playing = action == 'play'
+                self.changed.set()
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"PlaybackConsumer: Ignoring invalid message: {e!r}")
+
+    def seek(self, at):
+        if self.play_task:
+            self.play_task.cancel()
+        self.start_clock(at)
+        self.play_task = asyncio.create_task(self.play(at))
+
+    def start_clock(self, at):
+        self.position = self.anchor_position = at
+        self.anchor_time = asyncio.get_running_loop().time()
+
+    def reanchor(self):
+        # Continue from the current position at the current wall clock time
+        loop = asyncio.get_running_loop()
+        if self.playing:
+            self.position = self.anchor_position + (loop.time() - self.anchor_time) * self.speed
+        self.anchor_position = self.position
+        self.anchor_time = loop.time()
+
+    async def play(self, at):
+        events = self.reader.events(at)
+        next_batch = sync_to_async(lambda: list(itertools.islice(events, PLAYBACK_BATCH_EVENTS)), thread_sensitive=False)
+        # Output up to the seek position rebuilds the screen in one frame
+        await self.send(text_data=json.dumps({'type': 'reset'}))
+        pending = []
+        fast_forward = True
+        last_position_sent = 0
+        while True:
+            batch = await next_batch()
+            if not batch:
+                break
+            for event_at, code, data in batch:
+                if fast_forward and event_at >= at:
+                    fast_forward = False
+                    self.start_clock(at)
+                if not fast_forward and self.delay_until(event_at) != 0:
+                    # Send what is due before sleeping until the next event
+                    await self.send_output(pending)
+                    await self.wait_for(event_at)
+                if code == 'o':
+                    pending.append(data)
+                elif code == 'r':
+                    await self.send_output(pending)
+                    cols, rows = data.split('x')
+                    await self.send(text_data=json.dumps({'type': 'resize', 'cols': int(cols), 'rows': int(rows)}))
+                if not fast_forward and event_at - last_position_sent >= 0.5:
+                    await self.send_output(pending)
+                    await self.send(text_data=json.dumps({'type': 'playback_position', 'time': event_at}))
+                    last_position_sent = event_at
+            if not fast_forward:
+                await self.send_output(pending)
+        await self.send_output(pending)
+        await self.send(text_data=json.dumps({'type': 'playback_end'}))
+
+    def delay_until(self, event_at):
+        """
+        Returns the seconds until the playback clock reaches event_at, 0 if
+        it is (about) due and None while paused.
+        """
+        if not self.playing:
+            return None
+        delay = (event_at - self.anchor_position) / self.speed - (asyncio.get_running_loop().time() - self.anchor_time)
+        # Events closer together than this are sent in one frame
+        return delay if delay > 0.005 else 0
+
+    async def wait_for(self, event_at):
+        """
+        Sleeps until the playback clock reaches event_at, following pause and
+        speed changes meanwhile.
+        """
+        while True:
+            delay = self.delay_until(event_at)
+            if delay == 0:
+                return
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def send_output(self, pending):
+        if pending:
+            await self.send(text_data=json.dumps({'output': ''.join(pending)}))
+            pending.clear()
@@ -0,0 +1,117 @@
+"""
+Runs one command on many servers at once (see ExecConsumer).
+
+Every host gets its own exec channel, opened on the pooled connection to it
+(so proxy servers are shared and connections are reused across runs), and
+its own thread from a dedicated executor of EXEC_FANOUT_CONCURRENCY threads.
+A run over N hosts therefore takes about the slowest host's latency as long
+as N fits in the executor, and never competes with terminals for SSH I/O
+threads.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import metrics
+from .models import Server
+from .ssh_pool import resolve_route, ssh_pool
+
+logger = logging.getLogger(__name__)
+
+EXEC_SALT = 'be.exec'
+# Seconds the WebSocket URL handed out by the exec endpoint stays valid
+EXEC_TOKEN_MAX_AGE = 60
+# Longest command accepted
+EXEC_MAX_COMMAND = 4096
+
+executor = ThreadPoolExecutor(max_workers=settings.EXEC_FANOUT_CONCURRENCY, thread_name_prefix='ssh-exec')
+
+metrics.register_gauge('webssh_exec_threads', 'Threads started by the command fan-out executor.', lambda: len(executor._threads))
+metrics.register_gauge('webssh_exec_queued', 'Hosts waiting for a free command fan-out thread.', lambda: executor._work_queue.qsize())
+
+
+def select_servers(user_id, site_name=None, server_ids=None):
+    """
+    Returns the servers user_id may open, of site site_name and/or among
+    server_ids, ordered like the server list.
+    """
+    servers = Server.objects.filter(user_access__user_id=user_id)
+    if site_name:
+        servers = servers.filter(site_name=site_name)
+    if server_ids is not None:
+        servers = servers.filter(id__in=server_ids)
+    return servers.select_related('ssh_key').order_by('site_name', 'server_name', 'id')
+
+
+def resolve_routes(servers):
+    """
+    Returns {server: route or the error resolving it} for the servers. Runs
+    ORM queries, so call it from sync code.
+    """
+    proxies = {}
+    routes = {}
+    for server in servers:
+        try:
+            routes[server] = resolve_route(server, proxies)
+        except (Server.DoesNotExist, ValueError) as e:
+            routes[server] = e
+    return routes
+
+
+def _remaining(deadline):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError('timed out')
+    return remaining
+
+
+def exec_command(route, command, timeout, max_output):
+    """
+    Runs command on the last hop of a route built by resolve_route() and
+    returns (exit status, output, truncated). stderr is merged into the
+    output, of which the first max_output bytes are kept. Blocking; raises
+    TimeoutError when connecting and running the command take longer than
+    timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    client = ssh_pool.acquire_route(route, deadline=deadline)
+    try:
+        channel = client.get_transport().open_session(timeout=_remaining(deadline))
+        try:
+            channel.set_combine_stderr(True)
+            channel.settimeout(_remaining(deadline))
+            channel.exec_command(command)
+            output = bytearray()
+            truncated = False
+            while True:
+                channel.settimeout(_remaining(deadline))
+                data = channel.recv(32768)
+                if not data:
+                    break
+                # Keep reading past the limit, the exit status comes after
+                # the output
+                keep = max_output - len(output)
+                if len(data) > keep:
+                    truncated = True
+                output += data[:keep]
+            if not channel.status_event.wait(_remaining(deadline)):
+                raise TimeoutError('timed out')
+            return channel.exit_status, bytes(output), truncated
+        finally:
+            channel.close()
+    finally:
+        ssh_pool.release(client)
+
+
+async def run_exec(route, command):
+    """
+    Runs exec_command() on the fan-out executor. The host's timeout starts
+    when a thread picks it up, and cancelling it before then skips the host.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, exec_command, route, command, settings.EXEC_FANOUT_TIMEOUT, settings.EXEC_FANOUT_MAX_OUTPUT
+    )
@@ -0,0 +1,76 @@
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+import paramiko
+from django.conf import settings
+
+# Private key types tried, in order, when parsing a stored key
+KEY_CLASSES = (paramiko.RSAKey, paramiko.Ed25519Key, paramiko.ECDSAKey)
+
+
+def parse_private_key(key_content):
+    """
+    Parses a private key in any supported format (RSA, Ed25519, ECDSA).
+    """
+    for key_class in KEY_CLASSES:
+        try:
+            return key_class.from_private_key(io.StringIO(key_content))
+        except paramiko.SSHException:
+            continue
+    raise paramiko.SSHException("Unsupported or invalid private key.")
+
+
+class PKeyCache:
+    """
+    Bounded in-memory LRU cache of parsed private keys.
+
+    Entries are keyed by SSHKey id and a digest of the stored (encrypted)
+    content, so a reconnect storm decrypts and parses each key once instead
+    of once per connection. Nothing is ever written to disk.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = OrderedDict()
+        # cache key -> lock held while that key is being loaded, so
+        # concurrent misses for one key decrypt and parse it only once
+        self._loading = {}
+
+    def get(self, ssh_key):
+        """
+        Returns the parsed paramiko key of an SSHKey instance.
+        """
+        cache_key = (ssh_key.id, hashlib.sha256(ssh_key.key_content.encode()).digest())
+        with self._lock:
+            if cache_key in self._keys:
+                self._keys.move_to_end(cache_key)
+                return self._keys[cache_key]
+            loading = self._loading.setdefault(cache_key, threading.Lock())
+
+        with loading:
+            with self._lock:
+                if cache_key in self._keys:
+                    return self._keys[cache_key]
+            try:
+                pkey = parse_private_key(ssh_key.decrypt_key())
+            finally:
+                with self._lock:
+                    self._loading.pop(cache_key, None)
+            with self._lock:
+                self._keys[cache_key] = pkey
+                while len(self._keys) > settings.SSH_PKEY_CACHE_SIZE:
+                    self._keys.popitem(last=False)
+            return pkey
+
+    def invalidate(self, key_id):
+        """
+        Drops every cached key of an SSHKey id.
+        """
+        with self._lock:
+            for cache_key in [k for k in self._keys if k[0] == key_id]:
+                del self._keys[cache_key]
+
+
+pkey_cache = PKeyCache()
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from be.models import UserServerAccess
+from be.permissions import rebuild_access
+
+
+class Command(BaseCommand):
+    help = "Recomputes which servers each user may open from their roles."
+
+    def handle(self, *args, **options):
+        rebuild_access()
+        self.stdout.write(f"{UserServerAccess.objects.count()} user server grants.")
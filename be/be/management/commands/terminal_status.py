@@ -0,0 +1,67 @@
+import re
+import urllib.request
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Samples of the Prometheus text format: name, labels, value
+SAMPLE = re.compile(r'^(\w+)(?:\{([^}]*)\})? (\S+)$')
+LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+# What is reported, as (title, metric name, label filter)
+COUNTS = (
+    ('Terminal sessions', 'webssh_terminal_sessions', {}),
+    ('  paused by flow control', 'webssh_terminal_sessions_paused', {}),
+    ('Pooled SSH connections in use', 'webssh_ssh_pool_connections', {'in_use': 'true'}),
+    ('Pooled SSH connections idle', 'webssh_ssh_pool_connections', {'in_use': 'false'}),
+    ('Prewarmed shells waiting', 'webssh_terminal_prewarms_pending', {}),
+    ('Reaped: idle sessions', 'webssh_terminal_reaped_total', {'reason': 'idle'}),
+    ('Reaped: SSH side dead', 'webssh_terminal_reaped_total', {'reason': 'dead_peer'}),
+    ('Reaped: browser unresponsive', 'webssh_terminal_reaped_total', {'reason': 'ping_timeout'}),
+    ('Dead SSH connections closed', 'webssh_ssh_dead_connections_total', {}),
+)
+
+
+def parse_metrics(text):
+    """
+    Returns the samples of a /metrics response as (name, labels, value).
+    """
+    samples = []
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            samples.append((name, dict(LABEL.findall(labels or '')), float(value)))
+    return samples
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports the terminal sessions, pooled SSH connections and reaped sessions of running workers, "
+        "read from their /metrics endpoint. Every worker keeps its own, so pass each one's URL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'urls', nargs='*', default=['http://127.0.0.1:8000'],
+            help="Base URL of each worker (default http://127.0.0.1:8000)."
+        )
+
+    def handle(self, *args, **options):
+        if not settings.METRICS_TOKEN:
+            raise CommandError("Set METRICS_TOKEN, as for the workers, to read their /metrics endpoint.")
+        for url in options['urls']:
+            request = urllib.request.Request(url.rstrip('/') + '/metrics')
+            request.add_header('Authorization', f'Bearer {settings.METRICS_TOKEN}')
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    samples = parse_metrics(response.read().decode())
+            except OSError as e:
+                raise CommandError(f"Could not read the metrics of {url}: {e}")
+            self.stdout.write(url)
+            for title, name, wanted in COUNTS:
+                total = sum(
+                    value for sample, labels, value in samples
+                    if sample == name and all(labels.get(label) == want for label, want in wanted.items())
+                )
+                self.stdout.write(f"  {title + ':':<34}{total:>8.0f}")
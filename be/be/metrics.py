@@ -0,0 +1,229 @@
+"""
+Process-wide metrics in the Prometheus text exposition format, served at
+/metrics. Counters and histograms are updated from the event loop, the
+channel pump and the SSH I/O threads; gauges are read when scraped.
+"""
+import asyncio
+import bisect
+import threading
+import time
+
+from channels.layers import get_channel_layer
+
+# Buckets (seconds) for the SSH connect phase histograms
+CONNECT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Buckets (seconds) for the event loop lag histogram
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+# How often the event loop lag is probed, in seconds
+LAG_PROBE_INTERVAL = 0.5
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(list(zip(self.labelnames, key)))} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        # label values -> [bucket counts..., sum, count]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            state = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def time(self, **labels):
+        """
+        Context manager observing the duration of its block.
+        """
+        return _Timer(self, labels)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((key, list(state)) for key, state in self._values.items())
+        for key, state in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', '+Inf')])} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {state[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {state[-1]}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.monotonic() - self.start
+        self.histogram.observe(self.seconds, **self.labels)
+
+
+class Gauge:
+    """
+    Gauge whose samples are computed by func() at scrape time. func returns a
+    number, or a list of (label values, number) for a labelled gauge.
+    """
+
+    def __init__(self, name, help_text, func, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.labelnames = labelnames
+
+    def collect(self):
+        value = self.func()
+        if value is None:
+            return []
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        if not self.labelnames:
+            value = [((), value)]
+        for key, sample in value:
+            lines.append(f"{self.name}{_format_labels(list(zip(self.labelnames, key)))} {sample}")
+        return lines
+
+
+ssh_connect_seconds = Histogram(
+    'webssh_ssh_connect_phase_seconds',
+    'Time spent in each phase of opening a terminal: db_lookup, key_decrypt, tcp_kex, auth, shell.',
+    CONNECT_BUCKETS, labelnames=('phase',)
+)
+terminal_prewarms = Counter(
+    'webssh_terminal_prewarms_total', 'Shells opened ahead of their WebSocket, by outcome: adopted or expired.', labelnames=('result',)
+)
+ssh_connect_failures = Counter(
+    'webssh_ssh_connect_failures_total', 'Terminals that failed to connect, by reason.', labelnames=('reason',)
+)
+ssh_dead_connections = Counter(
+    'webssh_ssh_dead_connections_total', 'Pooled SSH connections closed because their peer stopped answering keepalives.'
+)
+terminal_reaped = Counter(
+    'webssh_terminal_reaped_total',
+    'Terminals closed as idle or dead, by reason: idle, dead_peer (SSH side) or ping_timeout (browser side).',
+    labelnames=('reason',)
+)
+terminal_bytes = Counter(
+    'webssh_terminal_bytes_total', 'Terminal bytes relayed, in (to SSH) or out (to the browser).', labelnames=('direction',)
+)
+terminal_frames = Counter(
+    'webssh_terminal_frames_total', 'Terminal WebSocket frames relayed, in or out.', labelnames=('direction',)
+)
+exec_hosts = Counter(
+    'webssh_exec_hosts_total', 'Hosts a fanned-out command ran on, by result: ok, failed, timeout or error.', labelnames=('result',)
+)
+recording_dropped_bytes = Counter(
+    'webssh_recording_dropped_bytes_total',
+    'Terminal input and output left out of recordings because the recording writer fell behind.'
+)
+sftp_bytes = Counter(
+    'webssh_sftp_bytes_total', 'Bytes moved by SFTP transfers, up (to the server) or down.', labelnames=('direction',)
+)
+event_loop_lag = Histogram(
+    'webssh_event_loop_lag_seconds', 'How late the event loop runs a scheduled callback.', LAG_BUCKETS
+)
+
+_gauges = []
+
+
+def register_gauge(name, help_text, func, labelnames=()):
+    _gauges.append(Gauge(name, help_text, func, labelnames))
+
+
+def observe_connect_phase(phase, seconds, timings=None):
+    """
+    Observes one phase of opening a terminal, and adds it to the timings
+    dict of that terminal when given.
+    """
+    ssh_connect_seconds.observe(seconds, phase=phase)
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0) + seconds
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text format.
+    """
+    lines = []
+    for metric in (ssh_connect_seconds, terminal_prewarms, ssh_connect_failures, ssh_dead_connections, terminal_reaped, terminal_bytes, terminal_frames, exec_hosts, sftp_bytes, event_loop_lag, *_gauges):
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+def _channel_layer_depth():
+    # Only the in-memory layer exposes its queues; other backends have their
+    # own monitoring (e.g. Redis list lengths)
+    queues = getattr(get_channel_layer(), 'channels', None)
+    if queues is None:
+        return None
+    return sum(queue.qsize() for queue in list(queues.values()))
+
+
+register_gauge('webssh_channel_layer_queue_depth', 'Messages waiting in the in-memory channel layer.', _channel_layer_depth)
+
+# event loop -> its lag probe task (asyncio only keeps weak task references)
+_monitored_loops = {}
+_monitored_lock = threading.Lock()
+
+
+def monitor_event_loop(loop):
+    """
+    Starts measuring the lag of loop, once per loop. Call it from the loop.
+    """
+    with _monitored_lock:
+        if loop in _monitored_loops:
+            return
+        _monitored_loops[loop] = loop.create_task(_probe_lag(loop))
+
+
+async def _probe_lag(loop):
+    try:
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            event_loop_lag.observe(max(0.0, loop.time() - start - LAG_PROBE_INTERVAL))
+    finally:
+        with _monitored_lock:
+            _monitored_loops.pop(loop, None)
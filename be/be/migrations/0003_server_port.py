@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('be', '0002_server_proxy_server'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='server',
+            name='port',
+            field=models.PositiveIntegerField(default=22),
+        ),
+    ]
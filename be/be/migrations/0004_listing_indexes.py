@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('be', '0003_server_port'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='server',
+            index=models.Index(fields=['site_name', 'server_name', 'id'], name='server_listing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sshkey',
+            index=models.Index(fields=['name', 'id'], name='sshkey_listing_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_access(apps, schema_editor):
+    # Materialize the grants existing roles already give
+    UserRole = apps.get_model('be', 'UserRole')
+    UserServerAccess = apps.get_model('be', 'UserServerAccess')
+    granted = set(
+        UserRole.objects.filter(roles__permissions__isnull=False)
+        .values_list('user_id', 'roles__permissions').distinct()
+    )
+    UserServerAccess.objects.bulk_create(
+        [UserServerAccess(user_id=user_id, server_id=server_id) for user_id, server_id in granted],
+        ignore_conflicts=True
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('be', '0004_listing_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserServerAccess',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('server', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_access', to='be.server')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='server_access', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'server'), name='unique_user_server_access')],
+            },
+        ),
+        migrations.RunPython(populate_access, migrations.RunPython.noop),
+    ]
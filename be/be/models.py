@@ -1,7 +1,11 @@
+import functools
+
 from django.db import models
 from cryptography.fernet import Fernet
 from django.conf import settings
 
+from .key_cache import pkey_cache
+
 def generate_encryption_key():
     """
     Generates a new encryption key.
@@ -15,21 +19,42 @@ def get_fernet():
     encryption_key = settings.ENCRYPTION_KEY
     if not encryption_key:
         raise ValueError("Encryption key not found in settings.")
+    return _fernet(encryption_key)
+
+@functools.lru_cache(maxsize=1)
+def _fernet(encryption_key):
+    # One shared instance per encryption key instead of one per call
     return Fernet(encryption_key)
 
 class SSHKey(models.Model):
     name = models.CharField(max_length=255)
     key_content = models.TextField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['name', 'id'], name='sshkey_listing_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         fernet = get_fernet()
         self.key_content = fernet.encrypt(self.key_content.encode()).decode()
         super().save(*args, **kwargs)
+        pkey_cache.invalidate(self.id)
+
+    def delete(self, *args, **kwargs):
+        pkey_cache.invalidate(self.id)
+        return super().delete(*args, **kwargs)
 
     def decrypt_key(self):
         fernet = get_fernet()
         return fernet.decrypt(self.key_content.encode()).decode()
 
+    def load_pkey(self):
+        """
+        Returns the decrypted key parsed as a paramiko key, cached in memory.
+        """
+        return pkey_cache.get(self)
+
     def __str__(self):
         return self.name
 
@@ -38,9 +63,16 @@ class Server(models.Model):
     server_name = models.CharField(max_length=200)
     user = models.CharField(max_length=200)
     host = models.CharField(max_length=200)
+    port = models.PositiveIntegerField(default=22)
     ssh_key = models.ForeignKey(SSHKey, on_delete=models.CASCADE)
     proxy_server = models.ForeignKey("self", on_delete=models.SET_NULL, null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Order and keyset pagination of the server list
+            models.Index(fields=['site_name', 'server_name', 'id'], name='server_listing_idx'),
+        ]
+
     def __str__(self):
         return f"{self.site_name} - {self.server_name}"
 
@@ -57,3 +89,20 @@ class UserRole(models.Model):
 
     def __str__(self):
         return f"{self.user.username} - {', '.join([role.name for role in self.roles.all()])}"
+
+class UserServerAccess(models.Model):
+    """
+    The servers each user may open through their roles, one row per
+    (user, server). Maintained by permissions.sync_user_access().
+    """
+    user = models.ForeignKey('auth.User', on_delete=models.CASCADE, related_name='server_access')
+    server = models.ForeignKey(Server, on_delete=models.CASCADE, related_name='user_access')
+
+    class Meta:
+        constraints = [
+            # Also the index permission checks and per-user listings use
+            models.UniqueConstraint(fields=['user', 'server'], name='unique_user_server_access'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.server_id}"
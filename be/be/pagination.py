@@ -0,0 +1,92 @@
+"""
+Helpers for the listing endpoints: keyset pagination and ETags.
+
+Listings return {'results': [...], 'next': cursor}; pass the cursor back as
+?after=<cursor> for the next page, and ?limit= to change the page size. A
+keyset page is found through the ordering index however deep it is, unlike
+OFFSET, which reads and skips every row before the page.
+"""
+import base64
+import binascii
+import hashlib
+import json
+
+from django.db.models import Q
+from django.http import HttpResponse
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError) as e:
+        raise InvalidCursor(f"Invalid cursor: {e}")
+
+
+def keyset_page(request, queryset, ordering):
+    """
+    Returns (rows, next cursor) of the page of queryset after the ?after=
+    cursor. queryset yields dicts (values()) holding the ordering fields,
+    the last of which must be unique. next is None on the last page.
+    """
+    try:
+        limit = min(max(int(request.query_params.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = DEFAULT_PAGE_SIZE
+    after = request.query_params.get('after')
+    if after:
+        values = decode_cursor(after)
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise InvalidCursor("Invalid cursor.")
+        # (a, b, c) > (x, y, z): a > x, or a = x and b > y, or ...
+        condition = Q()
+        for index, field in enumerate(ordering):
+            equal = dict(zip(ordering[:index], values[:index]))
+            condition |= Q(**equal, **{f'{field}__gt': values[index]})
+        queryset = queryset.filter(condition)
+    rows = list(queryset.order_by(*ordering)[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    return rows[:limit], encode_cursor([rows[limit - 1][field] for field in ordering])
+
+
+def _etag_headers(request, etag):
+    # Browsers revalidate every time and get 304s for unchanged listings
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    return headers, etag in parse_etags(request.headers.get('If-None-Match', ''))
+
+
+def etag_response(request, data):
+    """
+    Responds with data and an ETag of its content, or 304 Not Modified when
+    the client already has it (If-None-Match).
+    """
+    etag = '"' + hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()[:32] + '"'
+    headers, not_modified = _etag_headers(request, etag)
+    if not_modified:
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(data, headers=headers)
+
+
+def etag_content_response(request, etag, content):
+    """
+    Like etag_response(), for JSON content already rendered (and cached)
+    along with its ETag.
+    """
+    headers, not_modified = _etag_headers(request, etag)
+    if not_modified:
+        return HttpResponse(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return HttpResponse(content, content_type='application/json', headers=headers)
@@ -0,0 +1,229 @@
+"""
+Who may open which server.
+
+A user may connect to a server when one of their roles grants it. Those
+grants are materialized in UserServerAccess, one row per (user, server),
+which sync_user_access() brings up to date whenever roles or what they grant
+change: the model signals at the end of this module call it for every
+change made through the ORM, whichever view, admin page or script makes
+it. Bulk queryset updates and changes made in the database directly send
+no signals, rebuild_access() catches up with those. Checking a permission is then a single unique-index EXISTS, and
+listing a user's servers doesn't touch the role tables at all.
+
+can_connect() answers and server_inventory() listings are also cached in
+the Django cache for PERMISSION_CACHE_TIMEOUT seconds. Syncing a user, or
+changing a server they may open, bumps a version number that is part of
+their cache keys instead of looking for the entries to delete.
+"""
+import hashlib
+import json
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .models import Role, Server, UserRole, UserServerAccess
+
+CACHE_PREFIX = 'be.permissions'
+
+
+def _version_key(user_id):
+    return f'{CACHE_PREFIX}.version.{user_id}'
+
+
+def _version(user_id):
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        # A fresh, never used version: entries written before the version
+        # key was evicted can't be read again
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def can_connect(user, server_id):
+    """
+    Returns whether user may open a terminal on server server_id.
+    """
+    if user is None or not user.is_authenticated:
+        return False
+    key = f'{CACHE_PREFIX}.{_version(user.id)}.{user.id}.{server_id}'
+    allowed = cache.get(key)
+    if allowed is None:
+        allowed = UserServerAccess.objects.filter(user_id=user.id, server_id=server_id).exists()
+        cache.set(key, allowed, settings.PERMISSION_CACHE_TIMEOUT)
+    return allowed
+
+
+def server_inventory(user_id):
+    """
+    Returns (etag, JSON content) of the servers user_id may open, grouped by
+    site: [{'site_name': ..., 'servers': [{'id': ..., 'server_name': ...}]}].
+    """
+    key = f'{CACHE_PREFIX}.{_version(user_id)}.{user_id}.inventory'
+    inventory = cache.get(key)
+    if inventory is None:
+        rows = (
+            Server.objects.filter(user_access__user_id=user_id)
+            .order_by('site_name', 'server_name').values_list('id', 'site_name', 'server_name')
+        )
+        data = []
+        for server_id, site_name, server_name in rows:
+            if not data or data[-1]['site_name'] != site_name:
+                data.append({'site_name': site_name, 'servers': []})
+            data[-1]['servers'].append({'id': server_id, 'server_name': server_name})
+        content = json.dumps(data, separators=(',', ':')).encode()
+        inventory = ('"' + hashlib.sha256(content).hexdigest()[:32] + '"', content)
+        cache.set(key, inventory, settings.PERMISSION_CACHE_TIMEOUT)
+    return inventory
+
+
+def invalidate_user(user_id):
+    """
+    Forgets the cached permissions of one user.
+    """
+    try:
+        cache.incr(_version_key(user_id))
+    except ValueError:
+        # Not set yet, the next check starts a fresh version anyway
+        pass
+
+
+def server_user_ids(server_ids):
+    """
+    Returns the ids of the users who may open any of the servers.
+    """
+    return set(UserServerAccess.objects.filter(server_id__in=server_ids).values_list('user_id', flat=True))
+
+
+def role_user_ids(role_ids):
+    """
+    Returns the ids of the users having any of the roles.
+    """
+    return set(UserRole.objects.filter(roles__id__in=role_ids).values_list('user_id', flat=True))
+
+
+def sync_user_access(user_ids):
+    """
+    Brings the UserServerAccess rows of the users in line with their roles:
+    one query reads what their roles grant, one what is materialized, and
+    only the difference is deleted and inserted. The signal receivers below
+    call it after roles, what they grant or who has them change.
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    granted = set(
+        UserRole.objects.filter(user_id__in=user_ids, roles__permissions__isnull=False)
+        .values_list('user_id', 'roles__permissions').distinct()
+    )
+    current = set(UserServerAccess.objects.filter(user_id__in=user_ids).values_list('user_id', 'server_id'))
+    revoked = defaultdict(list)
+    for user_id, server_id in current - granted:
+        revoked[user_id].append(server_id)
+    with transaction.atomic():
+        for user_id, server_ids in revoked.items():
+            UserServerAccess.objects.filter(user_id=user_id, server_id__in=server_ids).delete()
+        UserServerAccess.objects.bulk_create(
+            [UserServerAccess(user_id=user_id, server_id=server_id) for user_id, server_id in granted - current],
+            ignore_conflicts=True
+        )
+    for user_id in user_ids:
+        invalidate_user(user_id)
+
+
+def rebuild_access():
+    """
+    Recomputes UserServerAccess for every user, for changes made behind the
+    application's back (e.g. in the database directly).
+    """
+    sync_user_access(
+        set(UserRole.objects.values_list('user_id', flat=True))
+        | set(UserServerAccess.objects.values_list('user_id', flat=True).distinct())
+    )
+
+
+# Signal receivers. The users affected by a deletion are collected in
+# pre_delete, as the rows telling who they are go with the deleted object.
+
+@receiver(m2m_changed, sender=Role.permissions.through)
+def role_permissions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        # role.permissions changed
+        sync_user_access(role_user_ids([instance.pk]))
+    elif action == 'post_clear':
+        # server.role_set.clear(), whoever may open the server is concerned
+        sync_user_access(server_user_ids([instance.pk]))
+    else:
+        sync_user_access(role_user_ids(pk_set))
+
+
+@receiver(m2m_changed, sender=UserRole.roles.through)
+def user_roles_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        # user_role.roles changed
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            sync_user_access([instance.user_id])
+    elif action == 'pre_clear':
+        # role.userrole_set.clear() doesn't tell which user roles it clears
+        instance._access_user_ids = role_user_ids([instance.pk])
+    elif action == 'post_clear':
+        sync_user_access(instance.__dict__.pop('_access_user_ids', ()))
+    elif action in ('post_add', 'post_remove'):
+        sync_user_access(UserRole.objects.filter(pk__in=pk_set).values_list('user_id', flat=True))
+
+
+@receiver(pre_save, sender=UserRole)
+def user_role_saving(sender, instance, raw, **kwargs):
+    if instance.pk is not None and not raw:
+        instance._access_user_ids = set(UserRole.objects.filter(pk=instance.pk).values_list('user_id', flat=True))
+
+
+@receiver(post_save, sender=UserRole)
+def user_role_saved(sender, instance, created, raw, **kwargs):
+    # Moved to another user, the previous one loses the roles
+    previous = instance.__dict__.pop('_access_user_ids', set())
+    if not raw and previous - {instance.user_id}:
+        sync_user_access(previous | {instance.user_id})
+
+
+@receiver(post_delete, sender=UserRole)
+def user_role_deleted(sender, instance, **kwargs):
+    sync_user_access([instance.user_id])
+
+
+@receiver(pre_delete, sender=Role)
+def role_deleting(sender, instance, **kwargs):
+    instance._access_user_ids = role_user_ids([instance.pk])
+
+
+@receiver(post_delete, sender=Role)
+def role_deleted(sender, instance, **kwargs):
+    sync_user_access(instance.__dict__.pop('_access_user_ids', ()))
+
+
+@receiver(post_save, sender=Server)
+def server_saved(sender, instance, created, raw, **kwargs):
+    # Renamed servers change the cached inventories of who may open them
+    if not created and not raw:
+        for user_id in server_user_ids([instance.pk]):
+            invalidate_user(user_id)
+
+
+@receiver(pre_delete, sender=Server)
+def server_deleting(sender, instance, **kwargs):
+    instance._access_user_ids = server_user_ids([instance.pk])
+
+
+@receiver(post_delete, sender=Server)
+def server_deleted(sender, instance, **kwargs):
+    # Its UserServerAccess rows went with it, the cached inventories go too
+    for user_id in instance.__dict__.pop('_access_user_ids', ()):
+        invalidate_user(user_id)
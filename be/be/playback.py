@@ -0,0 +1,142 @@
+"""
+Reads recordings written by recording.Recorder for playback.
+
+Nothing is loaded whole: only the segment headers and the sparse seek
+indexes are read up front, and events are streamed line by line from a
+memory map of the segment (or by decompressing it, for gzip segments).
+"""
+import gzip
+import json
+import mmap
+import os
+
+from django.conf import settings
+
+from .recording import list_segments, segment_index_path
+
+# Salt of the signed tokens that authorize a playback WebSocket
+PLAYBACK_SALT = 'be.playback'
+# Playback tokens must be used within this many seconds
+PLAYBACK_TOKEN_MAX_AGE = 60
+
+
+class Segment:
+    def __init__(self, path, name):
+        self.path = os.path.join(path, name)
+        self.compressed = name.endswith('.gz')
+        with self.open() as f:
+            self.header = json.loads(f.readline())
+        # [(time, offset, kind)] from the segment's .idx file
+        self.index = []
+        try:
+            with open(segment_index_path(path, name)) as f:
+                for line in f:
+                    at, offset, kind = line.split()
+                    self.index.append((float(at), int(offset), kind))
+        except (FileNotFoundError, ValueError):
+            pass
+        # Seconds between the start of the recording and this segment's time base
+        self.time_offset = 0
+
+    def open(self):
+        return gzip.open(self.path, 'rb') if self.compressed else open(self.path, 'rb')
+
+    @property
+    def end_offset(self):
+        if self.index and self.index[-1][2] == 'e':
+            return self.index[-1][1]
+        if not self.compressed:
+            return os.path.getsize(self.path)
+        return self.index[-1][1] if self.index else 0
+
+    def lines(self, offset):
+        """
+        Yields the complete lines of the segment from a byte offset on.
+        """
+        if self.compressed:
+            with self.open() as f:
+                # gzip can't jump, seeking decompresses up to the offset
+                f.seek(offset)
+                for line in f:
+                    if line.endswith(b'\n'):
+                        yield line
+            return
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                position = offset
+                while True:
+                    end = mm.find(b'\n', position)
+                    if end == -1:
+                        # A partially written last line of a live recording
+                        return
+                    yield mm[position:end + 1]
+                    position = end + 1
+
+
+class RecordingReader:
+    def __init__(self, path):
+        self.segments = [Segment(path, name) for name in list_segments(path)]
+        if not self.segments:
+            raise FileNotFoundError(f"No recording in {path}.")
+        started = self.segments[0].header.get('timestamp', 0)
+        for segment in self.segments:
+            # Reconnecting to a session starts a new recorder with its own time base
+            segment.time_offset = segment.header.get('timestamp', started) - started
+        self.width = self.segments[0].header.get('width', 80)
+        self.height = self.segments[0].header.get('height', 24)
+
+    @property
+    def duration(self):
+        for segment in reversed(self.segments):
+            if segment.index:
+                return segment.time_offset + segment.index[-1][0]
+        return 0
+
+    def seek_point(self, at):
+        """
+        Returns (segment number, byte offset) to start reading from so that
+        the screen at time at can be rebuilt: the last keyframe before it, or
+        the earliest index entry at most TERMINAL_PLAYBACK_MAX_FAST_FORWARD
+        bytes before it.
+        """
+        entries = [
+            (number, offset, kind)
+            for number, segment in enumerate(self.segments)
+            for entry_at, offset, kind in segment.index
+            if kind != 'e' and segment.time_offset + entry_at <= at
+        ]
+        if not entries:
+            return 0, 0
+        point = entries[-1]
+        distance = 0
+        for previous in reversed(entries[:-1]):
+            if point[2] == 'k':
+                break
+            if previous[0] == point[0]:
+                distance += point[1] - previous[1]
+            else:
+                distance += point[1] + self.segments[previous[0]].end_offset - previous[1]
+            if distance > settings.TERMINAL_PLAYBACK_MAX_FAST_FORWARD:
+                break
+            point = previous
+        return point[0], point[1]
+
+    def events(self, at=0):
+        """
+        Yields (time, code, data) events from the seek point of time at on,
+        across segments. Events before at are meant to be fast-forwarded.
+        """
+        first, offset = self.seek_point(at)
+        for number in range(first, len(self.segments)):
+            segment = self.segments[number]
+            for line in segment.lines(offset if number == first else 0):
+                if line.startswith(b'{'):
+                    # Segment header
+                    continue
+                try:
+                    event_at, code, data = json.loads(line)
+                except ValueError:
+                    continue
+                yield segment.time_offset + event_at, code, data
@@ -0,0 +1,186 @@
+"""
+Shells opened ahead of their terminal WebSocket.
+
+connect_server hands out the WebSocket URL of a new session and, right then,
+starts connecting to the server and opening the shell on the SSH I/O
+executor, filed under the session's id. The browser needs a moment to open
+the WebSocket, and by then the shell is often ready: SSHConsumer adopts it
+instead of starting from scratch. What the shell prints meanwhile (banner,
+prompt) waits in the SSH channel until the session starts reading it.
+
+Only the user and server the shell was opened for can adopt it. Shells
+nobody adopts within TERMINAL_PREWARM_TIMEOUT seconds are closed; their
+connection stays pooled for the next terminal.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+from .ssh_io import executor
+from .ssh_pool import open_session, resolve_route, ssh_pool
+
+logger = logging.getLogger(__name__)
+
+# Shells a user can have waiting to be adopted; connect_server requests
+# beyond that aren't prewarmed
+MAX_PENDING_PER_USER = 4
+
+
+class WarmShell:
+    def __init__(self, session_id, server_id, user_id, size, timeout):
+        self.session_id = session_id
+        self.server_id = server_id
+        self.user_id = user_id
+        # (cols, rows) the shell is opened at
+        self.size = size
+        # Longest the shell may take to open
+        self.timeout = timeout
+        self.started = time.monotonic()
+        # Seconds spent in each connect phase, see metrics.observe_connect_phase
+        self.timings = {}
+        # concurrent.futures.Future of (client, channel)
+        self.future = None
+
+
+# Shells waiting to be adopted, by session_id
+_warm = {}
+_lock = threading.Lock()
+_reaper = None
+
+
+def open_shell(route, size, timings=None, deadline=None):
+    """
+    Returns (client, channel): a shell of size (cols, rows) on the pooled
+    connection at the end of route. Blocking; close both with close_shell().
+    Raises TimeoutError at deadline (a time.monotonic() value), also while
+    waiting for another caller's handshake to the same host, so a host that
+    is down doesn't hold SSH I/O threads past it.
+    """
+    client = ssh_pool.acquire_route(route, timings=timings, deadline=deadline)
+    try:
+        start = time.monotonic()
+        channel = open_session(
+            client,
+            lambda channel: (
+                channel.get_pty(term=settings.TERMINAL_TYPE, width=size[0], height=size[1]),
+                channel.invoke_shell(),
+            ),
+            deadline
+        )
+        metrics.observe_connect_phase('shell', time.monotonic() - start, timings)
+    except Exception:
+        ssh_pool.release(client)
+        raise
+    return client, channel
+
+
+def close_shell(opened):
+    client, channel = opened
+    try:
+        channel.close()
+    finally:
+        ssh_pool.release(client)
+
+
+def _close_when_open(future):
+    # Done callback closing a shell nobody is going to use
+    if not future.cancelled() and future.exception() is None:
+        executor.submit(close_shell, future.result())
+
+
+def prewarm(session_id, server, user_id, size):
+    """
+    Starts opening a shell of size (cols, rows) on server for the terminal
+    session session_id of user_id. Runs ORM queries, so call it from sync
+    code. Returns False when the user already has too many shells waiting.
+    """
+    start = time.monotonic()
+    route = resolve_route(server)
+    warm = WarmShell(
+        session_id, server.id, user_id, size,
+        settings.SSH_CONNECT_TIMEOUT * len(route) + settings.SSH_IO_TIMEOUT
+    )
+    metrics.observe_connect_phase('db_lookup', time.monotonic() - start, warm.timings)
+    # Counted and filed under the same lock, so concurrent requests of one
+    # user can't all pass the check before any of them is counted
+    with _lock:
+        if sum(pending.user_id == user_id for pending in _warm.values()) >= MAX_PENDING_PER_USER:
+            return False
+        warm.future = executor.submit(open_shell, route, size, warm.timings, warm.started + warm.timeout)
+        _warm[session_id] = warm
+        _start_reaper()
+    return True
+
+
+def claim(session_id, server_id, user_id):
+    """
+    Returns the WarmShell of session_id if it was opened for server_id and
+    user_id, and nobody can claim it again. Returns None otherwise.
+    """
+    with _lock:
+        warm = _warm.get(session_id)
+        if warm is None or warm.server_id != server_id or warm.user_id != user_id:
+            return None
+        del _warm[session_id]
+    metrics.terminal_prewarms.inc(result='adopted')
+    return warm
+
+
+async def adopt(warm):
+    """
+    Waits for a claimed shell to open and returns (client, channel). Raises
+    what opening it raised. When the wait times out or is cancelled, the
+    shell is closed as soon as it is open.
+    """
+    future = asyncio.wrap_future(warm.future)
+    remaining = warm.timeout - (time.monotonic() - warm.started)
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), max(remaining, 0.001))
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        warm.future.add_done_callback(_close_when_open)
+        raise
+
+
+def pending_count():
+    with _lock:
+        return len(_warm)
+
+
+def reap_expired():
+    """
+    Closes the shells that have waited TERMINAL_PREWARM_TIMEOUT seconds.
+    Returns how many.
+    """
+    now = time.monotonic()
+    with _lock:
+        expired = [warm for warm in _warm.values() if now - warm.started >= settings.TERMINAL_PREWARM_TIMEOUT]
+        for warm in expired:
+            del _warm[warm.session_id]
+    for warm in expired:
+        logger.info(f"Prewarm: Closing the unclaimed shell of session {warm.session_id}.")
+        metrics.terminal_prewarms.inc(result='expired')
+        warm.future.add_done_callback(_close_when_open)
+    return len(expired)
+
+
+def _start_reaper():
+    global _reaper
+    if _reaper is None:
+        _reaper = threading.Thread(target=_reap, name='prewarm-reaper', daemon=True)
+        _reaper.start()
+
+
+def _reap():
+    while True:
+        time.sleep(min(settings.TERMINAL_PREWARM_TIMEOUT, 5))
+        try:
+            reap_expired()
+        except Exception as e:
+            logger.error(f"Prewarm: Reaping failed: {e}", exc_info=True)
+
+
+metrics.register_gauge('webssh_terminal_prewarms_pending', 'Shells opened ahead of their WebSocket, not adopted yet.', pending_count)
@@ -0,0 +1,288 @@
+"""
+Terminal session recording in the asciicast v2 format.
+
+A recording lives in TERMINAL_RECORDING_DIR/<server_id>/<session_id>/ as
+numbered segments (000000.cast, 000001.cast, ... or .cast.gz). Every segment
+is a complete asciicast v2 file: a JSON header line followed by one
+[time, code, data] event per line, where code is "o" (output), "i" (input)
+or "r" (resize, "COLSxROWS"). Times are seconds since the recording started,
+so consecutive segments play back as one session. A "m" (marker) event
+"gap: N bytes not recorded" stands where input and output were dropped.
+
+Next to every segment, NNNNNN.idx is a sparse seek index with one
+"time offset kind" line per entry: the byte offset (uncompressed) of the
+event at that time. Kind "k" marks keyframes, events after which the screen
+can be rebuilt without what came before (the start of a recording and output
+that clears the screen), "p" marks periodic entries written every
+TERMINAL_RECORDING_INDEX_INTERVAL seconds and "e" the end of the segment.
+
+The terminal path only appends events to a queue; encoding, compression,
+writing, segment rotation and fsync happen on one background writer thread.
+Past MAX_QUEUED_BYTES of queued input and output, a slow disk costs the
+recording its events rather than the worker its memory.
+"""
+import atexit
+import codecs
+import gzip
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PATTERN = re.compile(r'^(\d{6})\.cast(\.gz)?$')
+# Input and output waiting for the writer beyond this many bytes is dropped
+MAX_QUEUED_BYTES = 16 * 1024 * 1024
+# Queued to stop the writer thread
+_STOP = object()
+# Output containing any of these redraws the whole screen: clear screen,
+# full reset, switching to the alternate screen
+CLEAR_SCREEN = ('\x1b[2J', '\x1bc', '\x1b[?1049h')
+
+
+def segment_index_path(path, segment_name):
+    return os.path.join(path, segment_name.split('.', 1)[0] + '.idx')
+
+
+def recording_dir(server_id, session_id):
+    return os.path.join(settings.TERMINAL_RECORDING_DIR, str(server_id), str(session_id))
+
+
+def list_segments(path):
+    """
+    Returns the segment file names of a recording directory in order.
+    """
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if SEGMENT_PATTERN.match(name))
+
+
+class Recorder:
+    """
+    Records one terminal session. The output(), input() and resize() calls
+    never block: they only timestamp the event and queue it for the writer.
+    """
+
+    def __init__(self, server_id, session_id, width=80, height=24):
+        self.server_id = server_id
+        self.session_id = session_id
+        self.path = recording_dir(server_id, session_id)
+        self.width = width
+        self.height = height
+        self.started = time.time()
+        self._start = time.monotonic()
+        # Writer thread state
+        self.file = None
+        self.index_file = None
+        self.segment = len(list_segments(self.path))
+        self.segment_bytes = 0
+        self.unsynced = False
+        self.last_index_at = None
+        self.last_at = 0.0
+        # Nothing was shown before the first event of a recording
+        self.keyframe = True
+        self.decoders = {
+            'o': codecs.getincrementaldecoder('utf-8')(errors='replace'),
+            'i': codecs.getincrementaldecoder('utf-8')(errors='replace'),
+        }
+        # Bytes dropped since the last event queued, and in all
+        self.gap_bytes = 0
+        self.dropped_bytes = 0
+        writer.submit(self, None, 'open', None)
+
+    def output(self, data):
+        writer.submit(self, time.monotonic() - self._start, 'o', data)
+
+    def input(self, data):
+        writer.submit(self, time.monotonic() - self._start, 'i', data)
+
+    def resize(self, cols, rows):
+        writer.submit(self, time.monotonic() - self._start, 'r', f"{cols}x{rows}")
+
+    def close(self):
+        # Timed for the gap marker of what was dropped last, if anything
+        writer.submit(self, time.monotonic() - self._start, 'close', None)
+
+    # Everything below runs on the writer thread
+
+    def header(self):
+        return {
+            'version': 2,
+            'width': self.width,
+            'height': self.height,
+            'timestamp': int(self.started),
+            'title': f"{self.server_id}/{self.session_id}",
+            'env': {'TERM': settings.TERMINAL_TYPE},
+        }
+
+    def open_segment(self):
+        os.makedirs(self.path, exist_ok=True)
+        name = f"{self.segment:06d}.cast"
+        if settings.TERMINAL_RECORDING_COMPRESS == 'gzip':
+            name += '.gz'
+            self.file = gzip.open(os.path.join(self.path, name), 'ab')
+        else:
+            self.file = open(os.path.join(self.path, name), 'ab')
+        self.index_file = open(segment_index_path(self.path, name), 'a')
+        self.segment_bytes = 0
+        self.last_index_at = None
+        self.write_line(self.header())
+
+    def close_segment(self):
+        if self.file is None:
+            return
+        self.index_file.write(f"{self.last_at:.6f} {self.segment_bytes} e\n")
+        self.sync()
+        self.file.close()
+        self.index_file.close()
+        self.file = None
+        self.index_file = None
+
+    def write_gap(self, at, size):
+        # What follows doesn't continue what came before
+        for decoder in self.decoders.values():
+            decoder.reset()
+        self.write_event(at, 'm', f"gap: {size} bytes not recorded")
+
+    def write_event(self, at, code, data):
+        if code in self.decoders:
+            data = self.decoders[code].decode(data)
+            if not data:
+                # Only part of a multi-byte character so far
+                return
+        if self.segment_bytes >= settings.TERMINAL_RECORDING_SEGMENT_BYTES:
+            self.close_segment()
+            self.segment += 1
+        if self.file is None:
+            self.open_segment()
+        if code == 'o' and any(sequence in data for sequence in CLEAR_SCREEN):
+            self.keyframe = True
+        if self.keyframe or self.last_index_at is None or at - self.last_index_at >= settings.TERMINAL_RECORDING_INDEX_INTERVAL:
+            self.index_file.write(f"{at:.6f} {self.segment_bytes} {'k' if self.keyframe else 'p'}\n")
+            self.last_index_at = at
+            self.keyframe = False
+        self.write_line([round(at, 6), code, data])
+        self.last_at = at
+
+    def write_line(self, value):
+        line = json.dumps(value, ensure_ascii=False).encode() + b'\n'
+        self.file.write(line)
+        self.segment_bytes += len(line)
+        self.unsynced = True
+
+    def sync(self):
+        if not self.unsynced:
+            return
+        self.file.flush()
+        fileobj = getattr(self.file, 'fileobj', None) or self.file
+        fileobj.flush()
+        os.fsync(fileobj.fileno())
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+        self.unsynced = False
+
+
+class RecordingWriter:
+    """
+    Background thread writing the events of every Recorder in this process.
+    Files are buffered and fsynced every TERMINAL_RECORDING_FSYNC_INTERVAL
+    seconds, and when a segment or recording is closed.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._queued_bytes = 0
+        self._recorders = set()
+
+    def submit(self, recorder, at, code, data):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='recording-writer', daemon=True)
+                self._thread.start()
+            if code in ('o', 'i'):
+                if self._queued_bytes >= MAX_QUEUED_BYTES:
+                    # The writer can't keep up, the terminal must not wait for it
+                    recorder.gap_bytes += len(data)
+                    recorder.dropped_bytes += len(data)
+                    metrics.recording_dropped_bytes.inc(len(data))
+                    return
+                self._queued_bytes += len(data)
+            if recorder.gap_bytes:
+                # Queued under the lock, so it lands between the events around the gap
+                self._queue.put((recorder, at, 'gap', recorder.gap_bytes))
+                recorder.gap_bytes = 0
+            self._queue.put((recorder, at, code, data))
+
+    def shutdown(self, timeout=5):
+        """
+        Writes out everything queued and closes all recordings.
+        """
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        next_sync = time.monotonic() + settings.TERMINAL_RECORDING_FSYNC_INTERVAL
+        while True:
+            try:
+                event = self._queue.get(timeout=max(0, next_sync - time.monotonic()))
+            except queue.Empty:
+                event = None
+            if event is _STOP:
+                for recorder in list(self._recorders):
+                    self._handle(recorder, None, 'close', None)
+                return
+            if event is not None:
+                recorder, at, code, data = event
+                if code in ('o', 'i'):
+                    with self._lock:
+                        self._queued_bytes -= len(data)
+                self._handle(recorder, at, code, data)
+            if time.monotonic() >= next_sync:
+                for recorder in list(self._recorders):
+                    self._call(recorder, recorder.sync)
+                next_sync = time.monotonic() + settings.TERMINAL_RECORDING_FSYNC_INTERVAL
+
+    def _handle(self, recorder, at, code, data):
+        if code == 'open':
+            self._recorders.add(recorder)
+        elif code == 'close':
+            self._recorders.discard(recorder)
+            self._call(recorder, recorder.close_segment)
+        elif code == 'gap':
+            if recorder in self._recorders:
+                self._call(recorder, recorder.write_gap, at, data)
+        elif recorder in self._recorders:
+            self._call(recorder, recorder.write_event, at, code, data)
+
+    def _call(self, recorder, method, *args):
+        try:
+            method(*args)
+        except Exception as e:
+            # A failing disk must never break the terminal, so stop recording it
+            logger.error(f"RecordingWriter: Recording {recorder.path} failed, stopping it: {e}", exc_info=True)
+            self._recorders.discard(recorder)
+            for file in (recorder.file, recorder.index_file):
+                try:
+                    if file is not None:
+                        file.close()
+                except Exception:
+                    pass
+            recorder.file = None
+            recorder.index_file = None
+
+
+writer = RecordingWriter()
+atexit.register(writer.shutdown)
@@ -4,4 +4,7 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/connect_server/(?P<server_id>\d+)/(?P<session_id>[0-9a-fA-F-]+)/$', consumers.SSHConsumer.as_asgi()),
+    re_path(r'ws/watch/(?P<token>[\w:.-]+)/$', consumers.TerminalViewerConsumer.as_asgi()),
+    re_path(r'ws/exec/(?P<token>[\w:.-]+)/$', consumers.ExecConsumer.as_asgi()),
+    re_path(r'ws/playback/(?P<token>[\w:.-]+)/$', consumers.PlaybackConsumer.as_asgi()),
 ]
\ No newline at end of file
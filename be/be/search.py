@@ -0,0 +1,357 @@
+"""
+Searchable scrollback of terminal sessions.
+
+Every terminal session gets a ScrollbackIndex: its output with the escape
+sequences stripped, split into numbered lines (the first line of a session
+is line 1) and kept in zlib-compressed blocks of up to BLOCK_LINES lines.
+What full-screen programs (vim, less, top) draw on the alternate screen is
+left out, as it is from the terminal's own scrollback.
+
+Like recordings, the terminal path only queues output; decoding, stripping,
+line splitting and compression happen on one background indexer thread. A
+session keeps TERMINAL_SEARCH_SESSION_BYTES of compressed blocks and drops
+its oldest lines beyond that. All the sessions of a worker together keep
+TERMINAL_SEARCH_WORKER_BYTES: past that, the sessions that have gone the
+longest without output or a search lose their lines first.
+
+A search decompresses one block at a time, newest first, and runs the
+pattern over the whole block at once instead of line by line. Queries are
+compiled with the regex module rather than re, as it can stop a match
+after a timeout: a search gives up after TERMINAL_SEARCH_TIMEOUT seconds,
+so a pattern with catastrophic backtracking can't hold a thread.
+"""
+import codecs
+import collections
+import logging
+import queue
+import re
+import threading
+import time
+import zlib
+
+import regex
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Lines per compressed block, and the most characters a block holds
+BLOCK_LINES = 4096
+BLOCK_CHARS = 512 * 1024
+# Longer lines are split, so output without newlines is indexed too
+MAX_LINE = 4096
+# zlib level of the blocks: smaller ones also decompress faster, but level
+# 6 and up cost several times the CPU to compress
+COMPRESS_LEVEL = 3
+# Output waiting for the indexer beyond this many bytes is dropped
+MAX_QUEUED_BYTES = 16 * 1024 * 1024
+# Longest query, most context lines around a match and most matches of a search
+SEARCH_MAX_QUERY = 256
+SEARCH_MAX_CONTEXT = 20
+SEARCH_MAX_RESULTS = 1000
+
+# Escape sequences: CSI (colors, cursor movement, modes), OSC (window title,
+# hyperlinks), DCS/SOS/PM/APC strings, and the short ESC sequences
+ESCAPE = re.compile(
+    r'\x1b\[[0-?]*[ -/]*[@-~]'
+    r'|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)'
+    r'|\x1b[PX^_][^\x1b]*\x1b\\'
+    r'|\x1b[ -/]*[0-OQ-WYZ\\`a-~]'
+)
+# Switching to (h) and back from (l) the alternate screen
+ALT_SCREEN = re.compile(r'\x1b\[\?(?:1049|1047|47)([hl])')
+# Control characters other than tab, newline and carriage return
+CONTROL = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+
+
+def overstrike(line):
+    """
+    Returns what a line containing carriage returns shows: every part is
+    written over the start of the ones before it (progress bars, spinners).
+    """
+    shown = ''
+    for part in line.rstrip('\r').split('\r'):
+        shown = part + shown[len(part):]
+    return shown
+
+
+def split_long(line):
+    return [line[start:start + MAX_LINE] for start in range(0, len(line), MAX_LINE)] or ['']
+
+
+def compile_query(query, is_regex=False, ignore_case=False):
+    """
+    Returns (pattern, lower) for ScrollbackIndex.search(). Plain text is
+    looked for in lowercased lines when ignoring case, which is faster.
+    Raises regex.error for an invalid regular expression.
+    """
+    if is_regex:
+        return regex.compile(query, regex.MULTILINE | (regex.IGNORECASE if ignore_case else 0)), False
+    return regex.compile(regex.escape(query.lower() if ignore_case else query)), ignore_case
+
+
+def block_hits(pattern, text, timeout=None):
+    """
+    Returns the numbers (from 0) of the lines of text where pattern matches,
+    ascending and without repeats. Raises TimeoutError after timeout seconds.
+    """
+    hits = []
+    line = pos = 0
+    # Matching releases the GIL, so a long search doesn't stall the others
+    for match in pattern.finditer(text, concurrent=True, timeout=timeout):
+        start = match.start()
+        line += text.count('\n', pos, start)
+        pos = start
+        if not hits or hits[-1] != line:
+            hits.append(line)
+    return hits
+
+
+class ScrollbackIndex:
+    """
+    Searchable scrollback of one terminal session. output() and close()
+    never block: they only queue the output for the indexer thread.
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.lock = threading.Lock()
+        # Shared with searches, under lock: compressed blocks as (number of
+        # their first line, compressed text) oldest first, the lines not yet
+        # compressed and the line being written
+        self.blocks = collections.deque()
+        self.open_lines = []
+        self.partial = ''
+        # Number of the oldest line kept, and of the next line to complete
+        self.first_line = 1
+        self.next_line = 1
+        self.compressed_bytes = 0
+        self.open_chars = 0
+        self.dropped_bytes = 0
+        # Indexer thread state
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.carry = ''
+        self.alternate = False
+
+    def output(self, data):
+        indexer.submit(self, data)
+
+    def close(self):
+        indexer.submit(self, None)
+
+    @property
+    def size(self):
+        return self.compressed_bytes + self.open_chars
+
+    # Everything up to search() runs on the indexer thread
+
+    def index(self, data):
+        text = self.carry + self.decoder.decode(data)
+        self.carry = ''
+        # An escape sequence cut in two by the chunk boundary is kept for
+        # the next chunk
+        start = text.rfind('\x1b')
+        if start >= 0 and len(text) - start < MAX_LINE and not ESCAPE.match(text, start):
+            text, self.carry = text[:start], text[start:]
+        if '\x1b' in text:
+            shown = []
+            for number, piece in enumerate(ALT_SCREEN.split(text)):
+                if number % 2:
+                    self.alternate = piece == 'h'
+                elif not self.alternate:
+                    shown.append(piece)
+            text = ESCAPE.sub('', ''.join(shown))
+        elif self.alternate:
+            return
+        text = CONTROL.sub('', text)
+        if not text:
+            return
+        pieces = text.split('\n')
+        pieces[0] = self.partial + pieces[0]
+        partial = pieces.pop()
+        lines = []
+        for line in pieces:
+            lines.extend(split_long(overstrike(line) if '\r' in line else line))
+        if len(partial) > MAX_LINE:
+            partial = overstrike(partial) if '\r' in partial else partial
+            while len(partial) > MAX_LINE:
+                lines.append(partial[:MAX_LINE])
+                partial = partial[MAX_LINE:]
+        with self.lock:
+            self.open_lines.extend(lines)
+            self.partial = partial
+            self.next_line += len(lines)
+            self.open_chars += sum(map(len, lines))
+        if len(self.open_lines) >= BLOCK_LINES or self.open_chars >= BLOCK_CHARS:
+            self.seal()
+
+    def seal(self):
+        """
+        Compresses the open lines into a block.
+        """
+        # Only this thread changes open_lines, searches read it under lock
+        compressed = zlib.compress('\n'.join(self.open_lines).encode(), COMPRESS_LEVEL)
+        with self.lock:
+            self.blocks.append((self.next_line - len(self.open_lines), compressed))
+            self.compressed_bytes += len(compressed)
+            self.open_lines = []
+            self.open_chars = 0
+        self.trim(settings.TERMINAL_SEARCH_SESSION_BYTES)
+
+    def trim(self, limit):
+        """
+        Drops the oldest blocks until the compressed blocks fit in limit bytes.
+        """
+        with self.lock:
+            while self.blocks and self.compressed_bytes > limit:
+                first, compressed = self.blocks.popleft()
+                self.compressed_bytes -= len(compressed)
+                self.first_line = self.blocks[0][0] if self.blocks else self.next_line - len(self.open_lines)
+
+    def search(self, pattern, context=0, limit=100, lower=False, timeout=None):
+        """
+        Returns the last limit lines matching pattern, a regular expression
+        compiled by compile_query(), with up to context lines before and after
+        each:
+        {'first_line': ..., 'last_line': ..., 'truncated': ..., 'matches':
+        [{'line': ..., 'text': ..., 'before': [...], 'after': [...]}]}.
+        truncated tells that older lines may match too. With lower, pattern
+        is matched against the lowercased lines, several times faster than
+        IGNORECASE for plain text queries. Raises TimeoutError when the search
+        takes longer than timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            blocks = list(self.blocks)
+            open_lines = self.open_lines + ([self.partial] if self.partial else [])
+            if open_lines:
+                blocks.append((self.next_line - len(self.open_lines), '\n'.join(open_lines)))
+            first_line = self.first_line
+            last_line = self.next_line - 1 + bool(self.partial)
+        indexer.touch(self)
+
+        found = []
+        # Matches still missing lines before them, in the next older block
+        pending = []
+        # First lines of the blocks newer than the current one
+        newer = []
+        truncated = False
+        for number in range(len(blocks) - 1, -1, -1):
+            if len(found) >= limit and not pending:
+                truncated = True
+                break
+            first, text = blocks[number]
+            if isinstance(text, bytes):
+                text = zlib.decompress(text).decode()
+            if pending:
+                tail = text.rsplit('\n', context)[-context:]
+                waiting = pending
+                pending = []
+                for match in waiting:
+                    match['before'][:0] = tail[len(tail) - min(len(tail), context - len(match['before'])):]
+                    if len(match['before']) < context and number:
+                        pending.append(match)
+            if len(found) < limit:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError('search timed out')
+                hits = block_hits(pattern, text.lower() if lower else text, remaining)
+                if len(hits) > limit - len(found):
+                    truncated = True
+                    hits = hits[len(hits) - (limit - len(found)):]
+                if hits:
+                    lines = text.split('\n')
+                    for hit in reversed(hits):
+                        match = {
+                            'line': first + hit,
+                            'text': lines[hit],
+                            'before': lines[max(0, hit - context):hit],
+                            'after': (lines[hit + 1:hit + 1 + context] + newer)[:context],
+                        }
+                        found.append(match)
+                        if len(match['before']) < context and number:
+                            pending.append(match)
+            if context:
+                newer = (text.split('\n', context)[:context] + newer)[:context]
+        found.reverse()
+        return {'first_line': first_line, 'last_line': last_line, 'truncated': truncated, 'matches': found}
+
+
+class ScrollbackIndexer:
+    """
+    Background thread indexing the output of every ScrollbackIndex in this
+    process, and keeping their total size within TERMINAL_SEARCH_WORKER_BYTES.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._queued_bytes = 0
+        # Open indexes, least recently used first
+        self._indexes = collections.OrderedDict()
+
+    def submit(self, index, data):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='scrollback-indexer', daemon=True)
+                self._thread.start()
+            if data is not None:
+                if self._queued_bytes >= MAX_QUEUED_BYTES:
+                    # The indexer can't keep up, the terminal must not wait for it
+                    index.dropped_bytes += len(data)
+                    return
+                self._queued_bytes += len(data)
+                self._indexes.setdefault(index, None)
+        self._queue.put((index, data))
+
+    def touch(self, index):
+        with self._lock:
+            if index in self._indexes:
+                self._indexes.move_to_end(index)
+
+    def total_bytes(self):
+        with self._lock:
+            indexes = list(self._indexes)
+        return sum(index.size for index in indexes)
+
+    def _run(self):
+        while True:
+            index, data = self._queue.get()
+            if data is None:
+                with self._lock:
+                    self._indexes.pop(index, None)
+                continue
+            with self._lock:
+                self._queued_bytes -= len(data)
+            try:
+                sealed = len(index.blocks)
+                index.index(data)
+                if len(index.blocks) != sealed:
+                    self._evict()
+            except Exception as e:
+                # Searching is best effort and must never break the terminal
+                logger.error(f"ScrollbackIndexer: Indexing session {index.session_id} failed: {e}", exc_info=True)
+            self.touch(index)
+
+    def _evict(self):
+        # The coldest sessions lose their oldest lines first
+        with self._lock:
+            indexes = list(self._indexes)
+        excess = sum(index.size for index in indexes) - settings.TERMINAL_SEARCH_WORKER_BYTES
+        for index in indexes:
+            if excess <= 0:
+                break
+            held = index.compressed_bytes
+            index.trim(max(0, held - excess))
+            excess -= held - index.compressed_bytes
+
+
+indexer = ScrollbackIndexer()
+
+metrics.register_gauge(
+    'webssh_terminal_search_bytes', 'Memory held by the searchable scrollback of terminal sessions.', indexer.total_bytes
+)
@@ -0,0 +1,602 @@
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+from . import terminal_protocol as protocol
+from .search import ScrollbackIndex
+from .ssh_io import executor, run_ssh_io
+from .ssh_pool import ssh_pool
+from .ssh_pump import pump
+
+logger = logging.getLogger(__name__)
+
+# Seconds before checking again whether a channel whose SSH window was full
+# takes input, doubling up to INPUT_RETRY_MAX while it stays full
+INPUT_RETRY_MIN = 0.005
+INPUT_RETRY_MAX = 0.2
+# Largest SSH packet paramiko sends
+INPUT_PACKET = 32768
+
+
+def send_available(channel, data):
+    """
+    Sends as much of data as the channel's SSH window takes without waiting
+    for it to open. Returns the number of bytes sent.
+    """
+    sent = 0
+    while sent < len(data) and channel.send_ready():
+        # send() takes at most a packet, so don't copy more than that
+        count = channel.send(data[sent:sent + INPUT_PACKET])
+        if not count:
+            # EOF was sent, the channel takes no more input
+            break
+        sent += count
+    return sent
+
+
+class TerminalSession:
+    """
+    State of one terminal session, shared between its WebSocket consumer
+    (event loop) and the channel pump thread.
+
+    The session owns the SSH channel, so it can outlive its WebSocket: when
+    the browser connection drops the session is detached and kept open for
+    TERMINAL_SESSION_GRACE seconds, while the most recent output is kept in
+    a scrollback ring buffer. A consumer reconnecting with the same
+    session_id attaches to it and gets the output it missed.
+
+    Other connections can watch the session (see TerminalViewerConsumer):
+    while it has viewers, its output is also encoded once per flush window
+    and sent to the viewer group, tagged with its offset in the output.
+    """
+
+    def __init__(self, session_id, server_id, flow_control, user_id=None):
+        self.session_id = session_id
+        self.server_id = server_id
+        # Only the user who opened the session can resume it
+        self.user_id = user_id
+        # Only clients that acknowledge output take part in flow control,
+        # for the others output counts as delivered once it is sent.
+        self.flow_control = flow_control
+        self.lock = threading.Lock()
+        self.pending_bytes = 0
+        self.paused = False
+        # Traffic counters, logged instead of the payloads themselves
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        # Counters and monotonic time of the last traffic sample logged
+        self.logged_traffic = (0, 0, 0, 0)
+        self.logged_at = time.monotonic()
+        # Monotonic time something was last typed or printed
+        self.last_activity = time.monotonic()
+        # Opt-in ring buffer of the most recent chunks for debugging. It holds
+        # whatever was typed, passwords included, so it is off by default.
+        self.capture = None
+        if settings.TERMINAL_DEBUG_CAPTURE:
+            self.capture = collections.deque(maxlen=settings.TERMINAL_DEBUG_CAPTURE)
+        # recording.Recorder when TERMINAL_RECORDING_DIR is set
+        self.recorder = None
+        # Searchable output, unless TERMINAL_SEARCH_SESSION_BYTES is 0
+        self.search_index = ScrollbackIndex(session_id) if settings.TERMINAL_SEARCH_SESSION_BYTES else None
+        self.ssh_client = None
+        self.channel = None
+        self.loop = None
+        # (cols, rows) of the PTY
+        self.size = None
+        # The attached SSHConsumer, None while detached
+        self.consumer = None
+        self.eof = False
+        self.closed = False
+        # Timer closing a detached session when its grace period is over
+        self.expiry = None
+        # Total bytes of output read from the channel, the last
+        # TERMINAL_SCROLLBACK_BYTES of which are kept in scrollback
+        self.read_offset = 0
+        self.scrollback = bytearray()
+        # Viewers from any worker: channel name -> loop time their lease ends.
+        # They renew it every TERMINAL_VIEWER_LEASE / 3 seconds.
+        self.viewers = {}
+        # Output not yet broadcast to the viewers, starting at broadcast_offset
+        self.broadcast_buffer = bytearray()
+        self.broadcast_offset = 0
+        self.broadcast_task = None
+        # Input not yet written to the channel, by the single input_task
+        self.input_buffer = bytearray()
+        self.input_task = None
+        # Whether input is being dropped because the buffer is full
+        self.input_dropped = False
+
+    def start(self, ssh_client, channel, consumer):
+        """
+        Takes over an open shell channel and starts reading it for consumer.
+        """
+        self.ssh_client = ssh_client
+        self.channel = channel
+        self.consumer = consumer
+        self.loop = asyncio.get_running_loop()
+        # Hand the SSH channel to the shared pump thread for reading
+        pump.register(channel, self.on_channel_data, self.on_channel_close)
+
+    def resumable(self):
+        return self.channel is not None and not self.eof and not self.closed
+
+    # Called on the pump thread whenever the SSH channel has output
+    def on_channel_data(self, data):
+        self.last_activity = time.monotonic()
+        with self.lock:
+            self.read_offset += len(data)
+            self.scrollback += data
+            excess = len(self.scrollback) - settings.TERMINAL_SCROLLBACK_BYTES
+            if excess > 0:
+                del self.scrollback[:excess]
+            if self.consumer is not None:
+                # The consumer lives in this process, so hand the bytes
+                # straight to its event loop instead of the channel layer
+                self.loop.call_soon_threadsafe(self.consumer.queue_output, data)
+            if self.viewers:
+                self.loop.call_soon_threadsafe(self.queue_broadcast, data, self.read_offset - len(data))
+        if self.recorder is not None:
+            self.recorder.output(data)
+        if self.search_index is not None:
+            self.search_index.output(data)
+        # Returning False pauses the channel until the client catches up
+        return self.output_read(len(data))
+
+    # Called on the pump thread once the SSH channel is closed
+    def on_channel_close(self):
+        self.eof = True
+        self.loop.call_soon_threadsafe(self.channel_closed)
+
+    def channel_closed(self):
+        if self.consumer is not None:
+            self.loop.create_task(self.consumer.close_after_output())
+        else:
+            self.loop.create_task(self.close())
+
+    def attach(self, consumer, offset=None):
+        """
+        Attaches a reconnected consumer and queues the output read since
+        offset (every byte the client has already received), or the whole
+        scrollback without one. Returns (previously attached consumer, offset
+        the replayed output starts at). Call on the event loop.
+        """
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
+        with self.lock:
+            previous = self.consumer
+            start = self.read_offset - len(self.scrollback)
+            if offset is not None and start <= offset <= self.read_offset:
+                start = offset
+            replay = bytes(self.scrollback[len(self.scrollback) - (self.read_offset - start):])
+            self.consumer = consumer
+            self.flow_control = consumer.binary
+            # Everything not yet delivered to this client is the replay
+            self.pending_bytes = len(replay)
+            resume = self.paused and self.pending_bytes <= settings.TERMINAL_FLOW_LOW_WATER
+            if resume:
+                self.paused = False
+        # Later output is queued through call_soon_threadsafe, so it can't
+        # overtake the replay queued here
+        consumer.queue_output(replay)
+        if resume:
+            pump.resume(self.channel)
+        if self.eof:
+            # The channel closed while the consumer was being attached
+            self.loop.create_task(consumer.close_after_output())
+        logger.info(f"TerminalSession: Session {self.session_id} reattached, replaying {len(replay)} bytes from offset {start}.")
+        return previous, start
+
+    def detach(self, consumer):
+        """
+        Detaches consumer and closes the session once it has been detached
+        for TERMINAL_SESSION_GRACE seconds. Call on the event loop.
+        """
+        with self.lock:
+            if self.consumer is not consumer:
+                return
+            self.consumer = None
+        logger.info(f"TerminalSession: Session {self.session_id} detached, closing in {settings.TERMINAL_SESSION_GRACE} seconds.")
+        self.expiry = self.loop.call_later(settings.TERMINAL_SESSION_GRACE, lambda: self.loop.create_task(self.close()))
+
+    async def close(self):
+        """
+        Closes the shell channel and gives the connection back to the pool.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
+        unregister_session(self)
+        if self.broadcast_task is not None:
+            self.broadcast_task.cancel()
+        if self.input_task is not None:
+            # Between two writes, none of which waits for the SSH window
+            self.input_task.cancel()
+        await self.broadcast({'type': 'viewer.end'})
+        if self.channel:
+            # Closing the channel releases the fd the pump selects on,
+            # so wait for the pump to drop it first.
+            await asyncio.wrap_future(pump.unregister(self.channel))
+            try:
+                await run_ssh_io(self.channel.close)
+                logger.info("TerminalSession: SSH channel closed.")
+            except Exception as e:
+                logger.error(f"TerminalSession: Error closing SSH channel: {e!r}")
+        if self.recorder:
+            self.recorder.close()
+        if self.search_index is not None:
+            self.search_index.close()
+        if self.ssh_client:
+            # Releasing may close a dead connection, which waits for its transport thread
+            await run_ssh_io(ssh_pool.release, self.ssh_client)
+            logger.info("TerminalSession: SSH client released to pool.")
+        logger.info(
+            f"TerminalSession: Session {self.session_id} finished: {self.bytes_in} bytes in "
+            f"{self.frames_in} frames, {self.bytes_out} bytes out in {self.frames_out} frames."
+        )
+
+    async def end(self, reason):
+        """
+        Closes the session and tells its client why, if one is attached.
+        """
+        if self.closed:
+            return
+        if self.consumer is not None:
+            await self.consumer.session_close({'reason': reason})
+        await self.close()
+
+    def is_dead(self):
+        """
+        Tells whether the SSH side of a started session is gone without the
+        pump having noticed, e.g. its connection was closed under it.
+        """
+        if self.channel is None or self.eof or self.closed:
+            return False
+        transport = self.ssh_client.get_transport()
+        return self.channel.closed or transport is None or not transport.is_active()
+
+    def output_read(self, size):
+        """
+        Accounts for output read from the SSH channel. Returns False once the
+        high-water mark is reached and the channel should stop being read.
+        """
+        with self.lock:
+            self.pending_bytes += size
+            if self.flow_control and self.pending_bytes >= settings.TERMINAL_FLOW_HIGH_WATER:
+                self.paused = True
+                return False
+            return True
+
+    def output_acked(self, size):
+        """
+        Accounts for output delivered to the client. Returns True when a
+        paused channel dropped below the low-water mark and should be read
+        again.
+        """
+        with self.lock:
+            self.pending_bytes = max(0, self.pending_bytes - size)
+            if self.paused and self.pending_bytes <= settings.TERMINAL_FLOW_LOW_WATER:
+                self.paused = False
+                return True
+            return False
+
+    def record_input(self, data):
+        """
+        Accounts for input sent to the SSH channel.
+        """
+        self.last_activity = time.monotonic()
+        self.bytes_in += len(data)
+        self.frames_in += 1
+        metrics.terminal_bytes.inc(len(data), direction='in')
+        metrics.terminal_frames.inc(direction='in')
+        if self.capture is not None:
+            self.capture.append((time.time(), 'in', bytes(data)))
+        if self.recorder is not None:
+            self.recorder.input(data)
+        self.log_traffic()
+
+    def write_input(self, data):
+        """
+        Queues input for the SSH channel. A single task writes it, so input
+        reaches the shell in the order it was typed, and neither the
+        consumer nor its acknowledgements wait on a host that is slow to
+        accept it. Call on the event loop.
+        """
+        if len(self.input_buffer) + len(data) > settings.TERMINAL_INPUT_BUFFER_BYTES:
+            if not self.input_dropped:
+                logger.warning(f"TerminalSession: Session {self.session_id} isn't accepting input, dropping input.")
+                self.input_dropped = True
+            return
+        self.record_input(data)
+        self.input_buffer += data
+        if self.input_task is None:
+            self.input_task = self.loop.create_task(self.write_queued_input())
+
+    async def write_queued_input(self):
+        # Only what the SSH window takes right away is sent, so a host that
+        # stops reading never holds an SSH I/O thread: the closes, resizes
+        # and input of every other terminal need them. A full window is
+        # checked again after a growing delay.
+        delay = INPUT_RETRY_MIN
+        try:
+            while self.input_buffer and not self.closed:
+                sent = await asyncio.wrap_future(executor.submit(send_available, self.channel, bytes(self.input_buffer)))
+                if sent:
+                    del self.input_buffer[:sent]
+                    self.input_dropped = False
+                    delay = INPUT_RETRY_MIN
+                else:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, INPUT_RETRY_MAX)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"TerminalSession: Writing input to session {self.session_id} failed: {e!r}")
+            self.input_buffer.clear()
+        finally:
+            self.input_task = None
+
+    def record_output(self, data):
+        """
+        Accounts for output sent to the client.
+        """
+        self.bytes_out += len(data)
+        self.frames_out += 1
+        metrics.terminal_bytes.inc(len(data), direction='out')
+        metrics.terminal_frames.inc(direction='out')
+        if self.capture is not None:
+            self.capture.append((time.time(), 'out', bytes(data)))
+        self.log_traffic()
+
+    def log_traffic(self):
+        """
+        At DEBUG, logs the traffic since the previous sample, at most once
+        every TERMINAL_LOG_SAMPLE_INTERVAL seconds: one line per session
+        however many frames go through it.
+        """
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        now = time.monotonic()
+        if now - self.logged_at < settings.TERMINAL_LOG_SAMPLE_INTERVAL:
+            return
+        traffic = (self.bytes_in, self.frames_in, self.bytes_out, self.frames_out)
+        bytes_in, frames_in, bytes_out, frames_out = (total - logged for total, logged in zip(traffic, self.logged_traffic))
+        logger.debug(
+            "TerminalSession: Session %s in the last %.1f s: %d bytes in %d frames in, %d bytes in %d frames out.",
+            self.session_id, now - self.logged_at, bytes_in, frames_in, bytes_out, frames_out
+        )
+        self.logged_traffic = traffic
+        self.logged_at = now
+
+    def record_resize(self, cols, rows):
+        if self.recorder is not None:
+            self.recorder.resize(cols, rows)
+        if self.viewers:
+            self.loop.create_task(self.broadcast({'type': 'viewer.resize', 'cols': cols, 'rows': rows}))
+
+    def add_viewer(self, channel_name):
+        """
+        Adds a viewer or renews its lease. Call on the event loop.
+        """
+        self.viewers[channel_name] = self.loop.time() + settings.TERMINAL_VIEWER_LEASE
+
+    def remove_viewer(self, channel_name):
+        self.viewers.pop(channel_name, None)
+
+    def snapshot(self):
+        """
+        Returns (offset, data): the last TERMINAL_VIEWER_SNAPSHOT_BYTES of
+        output, from which a viewer redraws the screen, and where they start.
+        """
+        with self.lock:
+            data = bytes(self.scrollback[-settings.TERMINAL_VIEWER_SNAPSHOT_BYTES:])
+            return self.read_offset - len(data), data
+
+    # Called on the event loop, in the order the pump read the output
+    def queue_broadcast(self, data, offset):
+        if len(self.broadcast_buffer) >= settings.TERMINAL_FLOW_HIGH_WATER:
+            # The channel layer can't keep up: drop what is buffered, the
+            # viewers notice the gap and ask for a snapshot
+            self.broadcast_buffer.clear()
+        if not self.broadcast_buffer:
+            self.broadcast_offset = offset
+        self.broadcast_buffer += data
+        if self.broadcast_task is None:
+            self.broadcast_task = self.loop.create_task(self.broadcast_output())
+
+    async def broadcast_output(self):
+        try:
+            while self.broadcast_buffer:
+                if len(self.broadcast_buffer) < settings.TERMINAL_OUTPUT_FLUSH_BYTES:
+                    await asyncio.sleep(settings.TERMINAL_OUTPUT_FLUSH_INTERVAL)
+                output = bytes(self.broadcast_buffer[:settings.TERMINAL_OUTPUT_FLUSH_BYTES])
+                del self.broadcast_buffer[:len(output)]
+                offset = self.broadcast_offset
+                self.broadcast_offset += len(output)
+                # Encoded once, every viewer forwards the same frame
+                await self.broadcast({
+                    'type': 'viewer.output',
+                    'offset': offset,
+                    'frame': protocol.encode_frame(protocol.OP_DATA, output),
+                })
+        finally:
+            self.broadcast_task = None
+
+    async def broadcast(self, message):
+        """
+        Sends message to the viewer group while the session has viewers.
+        Viewers whose channel is full miss it instead of slowing the session.
+        """
+        if not self.viewers:
+            # Also the case of sessions closed before they started
+            return
+        now = self.loop.time()
+        for channel_name, expires in list(self.viewers.items()):
+            if expires < now:
+                del self.viewers[channel_name]
+        if not self.viewers:
+            return
+        try:
+            await get_channel_layer().group_send(viewer_group(self.session_id), message)
+        except Exception as e:
+            logger.warning(f"TerminalSession: Broadcasting to the viewers of session {self.session_id} failed: {e!r}")
+
+    def captured(self):
+        """
+        Returns the chunks kept by the debug capture, oldest first.
+        """
+        if self.capture is None:
+            return []
+        return [
+            {'time': at, 'direction': direction, 'data': data.decode(errors='replace')}
+            for at, direction, data in list(self.capture)
+        ]
+
+    def stats(self):
+        return {
+            'session_id': self.session_id,
+            'server_id': self.server_id,
+            'user_id': self.user_id,
+            'flow_control': self.flow_control,
+            'pending_bytes': self.pending_bytes,
+            'paused': self.paused,
+            'attached': self.consumer is not None,
+            'read_offset': self.read_offset,
+            'viewers': len(self.viewers),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'idle_seconds': round(time.monotonic() - self.last_activity, 1),
+        }
+
+
+def session_group(session_id):
+    """
+    Channel layer group of a terminal session. The consumer owning the session
+    joins it, so any worker can reach the session through the shared channel
+    layer without knowing which process holds it.
+    """
+    return f"terminal.session.{session_id}"
+
+
+def viewer_group(session_id):
+    """
+    Channel layer group the output of a terminal session is broadcast to.
+    """
+    return f"terminal.viewers.{session_id}"
+
+
+# Salt of the signed tokens that authorize a viewer WebSocket
+VIEWER_SALT = 'be.viewer'
+# Viewer tokens must be used within this many seconds
+VIEWER_TOKEN_MAX_AGE = 60
+# What viewers may do: watch, or also type into the session
+VIEWER_MODES = ('view', 'drive')
+
+
+# Terminal sessions living in this worker process, by session_id
+_sessions = {}
+_sessions_lock = threading.Lock()
+_reaper = None
+
+# Seconds between two passes of the session reaper
+REAP_INTERVAL = 15
+
+
+def register_session(session):
+    with _sessions_lock:
+        _sessions[session.session_id] = session
+        _start_reaper()
+
+
+def unregister_session(session):
+    with _sessions_lock:
+        if _sessions.get(session.session_id) is session:
+            del _sessions[session.session_id]
+
+
+def get_session(session_id):
+    with _sessions_lock:
+        return _sessions.get(session_id)
+
+
+def list_sessions():
+    with _sessions_lock:
+        return list(_sessions.values())
+
+
+# Sessions found dead by the previous reaper pass
+_dead = set()
+
+
+def reap_sessions():
+    """
+    Ends the sessions of this worker where nothing was typed or printed for
+    TERMINAL_IDLE_TIMEOUT seconds, and those whose SSH side is gone. A
+    session is only taken for dead when two passes in a row find it so, as
+    the pump may be about to close it the usual way. Returns how many were
+    ended, by reason.
+    """
+    now = time.monotonic()
+    reaped = {'idle': 0, 'dead_peer': 0}
+    dead = set()
+    for session in list_sessions():
+        if session.loop is None or session.closed:
+            continue
+        if session.is_dead():
+            if session not in _dead:
+                dead.add(session)
+                continue
+            reason = 'dead_peer'
+        elif settings.TERMINAL_IDLE_TIMEOUT and now - session.last_activity >= settings.TERMINAL_IDLE_TIMEOUT:
+            reason = 'idle'
+        else:
+            continue
+        logger.info(f"TerminalSession: Reaping session {session.session_id} ({reason}).")
+        metrics.terminal_reaped.inc(reason=reason)
+        reaped[reason] += 1
+        asyncio.run_coroutine_threadsafe(
+            session.end('idle for too long' if reason == 'idle' else 'server connection lost'), session.loop
+        )
+    _dead.clear()
+    _dead.update(dead)
+    return reaped
+
+
+def _start_reaper():
+    global _reaper
+    if _reaper is None:
+        _reaper = threading.Thread(target=_reap, name='session-reaper', daemon=True)
+        _reaper.start()
+
+
+def _reap():
+    while True:
+        time.sleep(REAP_INTERVAL)
+        try:
+            reap_sessions()
+        except Exception as e:
+            logger.error(f"TerminalSession: Reaping failed: {e}", exc_info=True)
+
+
+metrics.register_gauge('webssh_terminal_sessions', 'Terminal sessions open in this worker.', lambda: len(list_sessions()))
+metrics.register_gauge(
+    'webssh_terminal_sessions_paused', 'Terminal sessions whose SSH channel is paused by flow control.',
+    lambda: sum(session.paused for session in list_sessions())
+)
+metrics.register_gauge(
+    'webssh_terminal_viewers', 'Connections watching terminal sessions of this worker.',
+    lambda: sum(len(session.viewers) for session in list_sessions())
+)
@@ -178,14 +178,175 @@ CORS_ALLOWED_ORIGINS = [
 ENCRYPTION_KEY = environ.get("ENCRYPTION_KEY","nq5Mi27z4MOXnyeDRjcoBfwVLmx5kvhhKICJhnuRZ3M=")
 
 # Channels
+## The in-memory layer only works within one process. To run several ASGI
+## workers (or hosts) behind a load balancer, point REDIS_URL at a Redis server
+## shared by all of them (install the redis extra: uv sync --extra redis), or set
+## CHANNEL_LAYER_BACKEND to any other channels layer backend.
+REDIS_URL = environ.get("REDIS_URL")
+CHANNEL_LAYER_BACKEND = environ.get(
+    "CHANNEL_LAYER_BACKEND",
+    'channels_redis.core.RedisChannelLayer' if REDIS_URL else 'channels.layers.InMemoryChannelLayer'
+)
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'BACKEND': CHANNEL_LAYER_BACKEND,
     },
 }
+if REDIS_URL:
+    CHANNEL_LAYERS['default']['CONFIG'] = {
+        'hosts': [REDIS_URL],
+    }
+
+# Cache
+## Holds the results of permission checks. With several workers, REDIS_URL
+## also shares the cache, so permission changes reach every worker at once;
+## with the per-process memory cache other workers catch up within
+## PERMISSION_CACHE_TIMEOUT seconds.
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+PERMISSION_CACHE_TIMEOUT = int(environ.get("PERMISSION_CACHE_TIMEOUT", "300"))
+
+# Terminal output coalescing
+## SSH output is merged into one WebSocket frame per flush interval (seconds),
+## or sooner once this many bytes are buffered
+TERMINAL_OUTPUT_FLUSH_INTERVAL = float(environ.get("TERMINAL_OUTPUT_FLUSH_INTERVAL", "0.002"))
+TERMINAL_OUTPUT_FLUSH_BYTES = int(environ.get("TERMINAL_OUTPUT_FLUSH_BYTES", str(64 * 1024)))
+
+# Terminal flow control
+## Once this many bytes of output are sent but not yet acknowledged by the
+## browser, the SSH channel stops being read until it drops below the low-water mark
+TERMINAL_FLOW_HIGH_WATER = int(environ.get("TERMINAL_FLOW_HIGH_WATER", str(1024 * 1024)))
+TERMINAL_FLOW_LOW_WATER = int(environ.get("TERMINAL_FLOW_LOW_WATER", str(256 * 1024)))
+## Input is written to the SSH channel by one task per session, in order. While a
+## slow host doesn't accept it, up to this many bytes are queued, then input is dropped
+TERMINAL_INPUT_BUFFER_BYTES = int(environ.get("TERMINAL_INPUT_BUFFER_BYTES", str(1024 * 1024)))
+
+# Terminal PTY
+## Terminal type requested for shells, matching what xterm.js emulates
+TERMINAL_TYPE = environ.get("TERMINAL_TYPE", "xterm-256color")
+## Terminal size changes are applied at most once per this many seconds
+TERMINAL_RESIZE_DEBOUNCE = float(environ.get("TERMINAL_RESIZE_DEBOUNCE", "0.1"))
+
+# Resumable terminal sessions
+## When the browser connection drops, the SSH shell stays open for
+## TERMINAL_SESSION_GRACE seconds (0 closes it right away) and keeps the last
+## TERMINAL_SCROLLBACK_BYTES of output for the client to catch up on when it reconnects
+TERMINAL_SESSION_GRACE = int(environ.get("TERMINAL_SESSION_GRACE", "120"))
+TERMINAL_SCROLLBACK_BYTES = int(environ.get("TERMINAL_SCROLLBACK_BYTES", str(1024 * 1024)))
+
+# Scrollback search
+## The output of every terminal session is kept, without escape sequences and
+## compressed, for searching: up to TERMINAL_SEARCH_SESSION_BYTES per session
+## (0 turns searching off) and TERMINAL_SEARCH_WORKER_BYTES for all the
+## sessions of a worker, the least recently used losing their oldest lines first
+TERMINAL_SEARCH_SESSION_BYTES = int(environ.get("TERMINAL_SEARCH_SESSION_BYTES", str(16 * 1024 * 1024)))
+TERMINAL_SEARCH_WORKER_BYTES = int(environ.get("TERMINAL_SEARCH_WORKER_BYTES", str(256 * 1024 * 1024)))
+## A search gives up after TERMINAL_SEARCH_TIMEOUT seconds, so a regular
+## expression that backtracks catastrophically can't hold a thread
+TERMINAL_SEARCH_TIMEOUT = float(environ.get("TERMINAL_SEARCH_TIMEOUT", "2"))
+
+# Terminal session viewers
+## Viewers that haven't renewed their lease for this many seconds stop
+## getting output; joining and resyncing viewers redraw their screen from the
+## last TERMINAL_VIEWER_SNAPSHOT_BYTES of output
+TERMINAL_VIEWER_LEASE = int(environ.get("TERMINAL_VIEWER_LEASE", "30"))
+TERMINAL_VIEWER_SNAPSHOT_BYTES = int(environ.get("TERMINAL_VIEWER_SNAPSHOT_BYTES", str(64 * 1024)))
+
+# Dead and idle terminals
+## The backend pings terminal WebSockets every TERMINAL_PING_INTERVAL seconds
+## and drops those that sent nothing, not even an answer, for TERMINAL_PING_TIMEOUT
+## seconds (0 turns pinging off). Sessions where nothing was typed or printed
+## for TERMINAL_IDLE_TIMEOUT seconds are closed (0 keeps them open)
+TERMINAL_PING_INTERVAL = int(environ.get("TERMINAL_PING_INTERVAL", "20"))
+TERMINAL_PING_TIMEOUT = int(environ.get("TERMINAL_PING_TIMEOUT", "60"))
+TERMINAL_IDLE_TIMEOUT = int(environ.get("TERMINAL_IDLE_TIMEOUT", "0"))
+
+# Terminal prewarming
+## connect_server starts opening the shell of a new terminal right away instead
+## of waiting for its WebSocket; shells not taken over by their WebSocket within
+## TERMINAL_PREWARM_TIMEOUT seconds are closed (0 turns prewarming off)
+TERMINAL_PREWARM_TIMEOUT = int(environ.get("TERMINAL_PREWARM_TIMEOUT", "30"))
+
+# SSH connection pool
+## Terminals to the same host/user/key share one authenticated connection with
+## up to SSH_POOL_MAX_CHANNELS shells; unused connections close after
+## SSH_POOL_IDLE_TIMEOUT seconds
+SSH_POOL_MAX_CHANNELS = int(environ.get("SSH_POOL_MAX_CHANNELS", "8"))
+SSH_POOL_IDLE_TIMEOUT = int(environ.get("SSH_POOL_IDLE_TIMEOUT", "300"))
+## Every connection is probed each SSH_KEEPALIVE_INTERVAL seconds (0 turns it
+## off) and closed, ending its terminals, once SSH_KEEPALIVE_COUNT_MAX probes
+## in a row went unanswered
+SSH_KEEPALIVE_INTERVAL = int(environ.get("SSH_KEEPALIVE_INTERVAL", "30"))
+SSH_KEEPALIVE_COUNT_MAX = int(environ.get("SSH_KEEPALIVE_COUNT_MAX", "3"))
+
+# SSH I/O
+## Blocking paramiko calls run on a dedicated pool of SSH_IO_WORKERS threads.
+## Establishing a connection (TCP, key exchange, auth, every proxy hop) may take
+## up to SSH_CONNECT_TIMEOUT seconds, any other call up to SSH_IO_TIMEOUT seconds
+SSH_IO_WORKERS = int(environ.get("SSH_IO_WORKERS", "64"))
+SSH_CONNECT_TIMEOUT = int(environ.get("SSH_CONNECT_TIMEOUT", "15"))
+SSH_IO_TIMEOUT = int(environ.get("SSH_IO_TIMEOUT", "10"))
+## Parsed private keys are cached in memory (never on disk) for this many SSH keys
+SSH_PKEY_CACHE_SIZE = int(environ.get("SSH_PKEY_CACHE_SIZE", "256"))
+
+# Command fan-out
+## Commands run on several servers at once use their own pool of
+## EXEC_FANOUT_CONCURRENCY threads per worker, one per host being run on. Each
+## host gets EXEC_FANOUT_TIMEOUT seconds to connect and finish, and the first
+## EXEC_FANOUT_MAX_OUTPUT bytes of its output are kept. One run selects at most
+## EXEC_FANOUT_MAX_HOSTS servers
+EXEC_FANOUT_CONCURRENCY = int(environ.get("EXEC_FANOUT_CONCURRENCY", "128"))
+EXEC_FANOUT_TIMEOUT = float(environ.get("EXEC_FANOUT_TIMEOUT", "30"))
+EXEC_FANOUT_MAX_OUTPUT = int(environ.get("EXEC_FANOUT_MAX_OUTPUT", str(64 * 1024)))
+EXEC_FANOUT_MAX_HOSTS = int(environ.get("EXEC_FANOUT_MAX_HOSTS", "2000"))
+
+# File transfers
+## SFTP uploads and downloads stream through the worker SFTP_BLOCK_SIZE bytes
+## at a time (about two blocks in memory per transfer). Each user can run
+## SFTP_MAX_TRANSFERS_PER_USER transfers at once per worker
+SFTP_BLOCK_SIZE = int(environ.get("SFTP_BLOCK_SIZE", str(2 * 1024 * 1024)))
+SFTP_MAX_TRANSFERS_PER_USER = int(environ.get("SFTP_MAX_TRANSFERS_PER_USER", "4"))
+
+# Terminal recording
+## When set, every terminal session is recorded (asciicast v2) below this
+## directory. Segments roll over after TERMINAL_RECORDING_SEGMENT_BYTES, are
+## fsynced every TERMINAL_RECORDING_FSYNC_INTERVAL seconds and gzip-compressed
+## when TERMINAL_RECORDING_COMPRESS=gzip
+TERMINAL_RECORDING_DIR = environ.get("TERMINAL_RECORDING_DIR", "")
+TERMINAL_RECORDING_COMPRESS = environ.get("TERMINAL_RECORDING_COMPRESS", "")
+TERMINAL_RECORDING_SEGMENT_BYTES = int(environ.get("TERMINAL_RECORDING_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+TERMINAL_RECORDING_FSYNC_INTERVAL = float(environ.get("TERMINAL_RECORDING_FSYNC_INTERVAL", "5"))
+## Seconds between seek index entries of a recording. Seeking fast-forwards
+## through at most TERMINAL_PLAYBACK_MAX_FAST_FORWARD bytes to rebuild the screen
+TERMINAL_RECORDING_INDEX_INTERVAL = float(environ.get("TERMINAL_RECORDING_INDEX_INTERVAL", "5"))
+TERMINAL_PLAYBACK_MAX_FAST_FORWARD = int(environ.get("TERMINAL_PLAYBACK_MAX_FAST_FORWARD", str(4 * 1024 * 1024)))
 
 STATIC_ROOT = path.join(BASE_DIR, 'static', )
 
+## /metrics serves Prometheus metrics to staff users only, and to scrapers sending
+## METRICS_TOKEN as "Authorization: Bearer <token>" when it is set.
+METRICS_TOKEN = environ.get("METRICS_TOKEN", "")
+
+## Log level of the terminal I/O path. At DEBUG each session logs its traffic
+## (sizes, never content) at most once every TERMINAL_LOG_SAMPLE_INTERVAL seconds.
+TERMINAL_LOG_LEVEL = environ.get("TERMINAL_LOG_LEVEL", "INFO")
+TERMINAL_LOG_SAMPLE_INTERVAL = float(environ.get("TERMINAL_LOG_SAMPLE_INTERVAL", "1"))
+## Keep the last TERMINAL_DEBUG_CAPTURE input/output chunks of each terminal in
+## memory, readable by admins at /api/terminal-sessions/<session_id>/capture/.
+## Captured chunks include anything typed (passwords too), so leave at 0 unless debugging.
+TERMINAL_DEBUG_CAPTURE = int(environ.get("TERMINAL_DEBUG_CAPTURE", "0"))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -200,6 +361,11 @@ LOGGING = {
             'class': 'logging.StreamHandler',
             'formatter': 'verbose'
         },
+        'terminal': {
+            'level': TERMINAL_LOG_LEVEL,
+            'class': 'logging.StreamHandler',
+            'formatter': 'verbose'
+        },
     },
     'loggers': {
         'be.views': {
@@ -207,5 +373,15 @@ LOGGING = {
             'level': 'INFO',
             'propagate': True,
         },
+        'be.consumers': {
+            'handlers': ['terminal'],
+            'level': TERMINAL_LOG_LEVEL,
+            'propagate': False,
+        },
+        'be.sessions': {
+            'handlers': ['terminal'],
+            'level': TERMINAL_LOG_LEVEL,
+            'propagate': False,
+        },
     },
 }
@@ -0,0 +1,230 @@
+"""
+File transfers over SFTP, on the same pooled, authenticated SSH connections
+as the terminals.
+
+Transfers stream through the worker block by block: downloads keep the read
+requests of the next block in flight while a block is sent on, uploads use
+pipelined writes that don't wait for each acknowledgement, and at most a
+couple of SFTP_BLOCK_SIZE blocks per transfer are held in memory whatever
+the file size. Each user can run SFTP_MAX_TRANSFERS_PER_USER transfers at
+once per worker.
+"""
+import asyncio
+import collections
+import contextlib
+import re
+import stat
+import threading
+import time
+
+import paramiko
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from . import metrics
+from .models import Server
+from .ssh_io import run_ssh_io
+from .ssh_pool import connect_timeout, open_session, resolve_route, ssh_pool
+
+SFTP_SALT = 'be.sftp'
+# Seconds a download URL stays valid, also for resuming with Range requests
+SFTP_TOKEN_MAX_AGE = 3600
+# Largest read the SFTP protocol guarantees servers accept
+READ_SIZE = 32768
+
+# user id -> transfers running in this worker
+_transfers = collections.Counter()
+_transfers_lock = threading.Lock()
+
+metrics.register_gauge('webssh_sftp_transfers', 'SFTP uploads and downloads running.', lambda: sum(_transfers.values()))
+
+
+def start_transfer(user_id):
+    """
+    Takes one of user_id's transfer slots, returns False when they're all in use.
+    """
+    with _transfers_lock:
+        if _transfers[user_id] >= settings.SFTP_MAX_TRANSFERS_PER_USER:
+            return False
+        _transfers[user_id] += 1
+        return True
+
+
+def end_transfer(user_id):
+    with _transfers_lock:
+        _transfers[user_id] -= 1
+        if _transfers[user_id] <= 0:
+            del _transfers[user_id]
+
+
+async def request_user(request):
+    """
+    Returns the user of the request's JWT Authorization header, or None.
+    For the plain (async) Django views, which DRF doesn't authenticate.
+    """
+    try:
+        authenticated = await sync_to_async(JWTAuthentication().authenticate)(request)
+    except AuthenticationFailed:
+        return None
+    return authenticated[0] if authenticated else None
+
+
+def server_route(server_id):
+    return resolve_route(Server.objects.select_related('ssh_key').get(pk=server_id))
+
+
+def open_sftp(route, deadline=None):
+    """
+    Returns (client, SFTPClient) opened on the pooled connection at the end
+    of route. Blocking, raising TimeoutError at deadline (a time.monotonic()
+    value); give them back with close_sftp().
+    """
+    client = ssh_pool.acquire_route(route, deadline=deadline)
+    try:
+        channel = open_session(client, lambda channel: channel.invoke_subsystem('sftp'), deadline)
+        try:
+            channel.settimeout(connect_timeout(deadline))
+            sftp = paramiko.SFTPClient(channel)
+        except Exception:
+            channel.close()
+            raise
+        # Blocking SFTP calls give up instead of hanging on a dead server
+        channel.settimeout(settings.SSH_IO_TIMEOUT)
+    except Exception:
+        ssh_pool.release(client)
+        raise
+    return client, sftp
+
+
+def close_sftp(client, sftp):
+    try:
+        sftp.close()
+    finally:
+        ssh_pool.release(client)
+
+
+@contextlib.asynccontextmanager
+async def sftp_session(server_id):
+    """
+    Async context manager opening an SFTP session to server_id.
+    """
+    route = await sync_to_async(server_route)(server_id)
+    timeout = settings.SSH_CONNECT_TIMEOUT * len(route)
+    client, sftp = await run_ssh_io(
+        open_sftp, route, time.monotonic() + timeout,
+        timeout=timeout, on_abandoned=lambda opened: close_sftp(*opened)
+    )
+    try:
+        yield sftp
+    finally:
+        await run_ssh_io(close_sftp, client, sftp)
+
+
+def describe(name, attrs):
+    return {
+        'name': name,
+        'size': attrs.st_size,
+        'mtime': attrs.st_mtime,
+        'is_dir': stat.S_ISDIR(attrs.st_mode or 0),
+    }
+
+
+def list_path(sftp, path):
+    """
+    Returns the entries of directory path, directories first, or the
+    attributes of path when it is a file. Blocking.
+    """
+    path = sftp.normalize(path)
+    attrs = sftp.stat(path)
+    if not stat.S_ISDIR(attrs.st_mode or 0):
+        return {'path': path, **describe(path.rsplit('/', 1)[-1], attrs)}
+    entries = [describe(entry.filename, entry) for entry in sftp.listdir_attr(path)]
+    entries.sort(key=lambda entry: (not entry['is_dir'], entry['name']))
+    return {'path': path, 'is_dir': True, 'entries': entries}
+
+
+def parse_range(header, size):
+    """
+    Returns the (start, end) byte range, end excluded, asked for by a Range
+    header, or None to send the whole file. Only single ranges are served;
+    raises ValueError for one that lies outside the file.
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', (header or '').strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # The last bytes of the file
+        start, end = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+    if start >= size or start >= end:
+        raise ValueError(f"Range {header} is outside the file.")
+    return start, end
+
+
+def read_blocks(sftp_file, start, end):
+    """
+    Yields the bytes of sftp_file from start to end, SFTP_BLOCK_SIZE at a
+    time. The read requests of the next block all go out before a block is
+    handed over, so the link stays busy while it is sent on, and no more
+    than two blocks are held in memory. Blocking; drive it with next().
+    """
+    block_size = settings.SFTP_BLOCK_SIZE
+
+    def request(offset):
+        size = min(block_size, end - offset)
+        pieces = sftp_file.readv([
+            (piece, min(READ_SIZE, offset + size - piece)) for piece in range(offset, offset + size, READ_SIZE)
+        ])
+        # Sends every read request of the block, and waits for the first piece
+        return size, next(pieces), pieces
+
+    pending = request(start) if start < end else None
+    offset = start
+    while pending is not None:
+        size, first, pieces = pending
+        offset += size
+        pending = request(offset) if offset < end else None
+        block = first + b''.join(pieces)
+        if len(block) != size:
+            raise OSError(f"{sftp_file} changed while it was being read.")
+        yield block
+
+
+def write_block(source, sftp_file):
+    """
+    Copies the next SFTP_BLOCK_SIZE bytes at most of source to sftp_file and
+    returns how many it copied. Blocking.
+    """
+    data = source.read(settings.SFTP_BLOCK_SIZE)
+    if data:
+        sftp_file.write(data)
+    return len(data)
+
+
+class DownloadStream:
+    """
+    Streaming content of a download response: the blocks of a remote file,
+    after which everything on stack (the file, its SFTP session, the
+    transfer slot) is closed. Django closes the content when the response
+    is done with, so this also happens when it never gets to be sent.
+    """
+
+    def __init__(self, stack, sftp_file, start, end):
+        self.stack = stack
+        self.blocks = read_blocks(sftp_file, start, end)
+        self.loop = asyncio.get_running_loop()
+
+    async def __aiter__(self):
+        async with self.stack:
+            while (block := await run_ssh_io(next, self.blocks, None)) is not None:
+                metrics.sftp_bytes.inc(len(block), direction='down')
+                yield block
+
+    def close(self):
+        # Called from a sync thread; closing twice does nothing
+        asyncio.run_coroutine_threadsafe(self.stack.aclose(), self.loop)
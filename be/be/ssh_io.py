@@ -0,0 +1,37 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import metrics
+
+# Dedicated, bounded thread pool for blocking paramiko calls, so a slow or
+# unreachable host never blocks the event loop or starves the threads that
+# sync_to_async uses for the ORM.
+executor = ThreadPoolExecutor(max_workers=settings.SSH_IO_WORKERS, thread_name_prefix='ssh-io')
+
+metrics.register_gauge('webssh_ssh_io_threads', 'Threads started by the SSH I/O executor.', lambda: len(executor._threads))
+metrics.register_gauge('webssh_ssh_io_queued', 'SSH calls waiting for a free SSH I/O thread.', lambda: executor._work_queue.qsize())
+
+
+async def run_ssh_io(func, *args, timeout=None, on_abandoned=None, **kwargs):
+    """
+    Runs a blocking SSH call on the SSH I/O executor and waits at most
+    timeout seconds (SSH_IO_TIMEOUT by default) for it.
+
+    On timeout asyncio.TimeoutError is raised. The call itself can't be
+    interrupted and finishes in the background; if it still succeeds, its
+    result is passed to on_abandoned(), on the executor, so it can be cleaned
+    up. The same happens when the waiting task is cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout or settings.SSH_IO_TIMEOUT)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        if on_abandoned is not None:
+            future.add_done_callback(
+                lambda f: f.cancelled() or f.exception() or executor.submit(on_abandoned, f.result())
+            )
+        raise
@@ -0,0 +1,428 @@
+import hashlib
+import logging
+import threading
+import time
+
+import paramiko
+from django.conf import settings
+from paramiko.common import cMSG_GLOBAL_REQUEST
+
+from . import metrics
+from .models import Server
+from .ssh_io import executor
+
+logger = logging.getLogger(__name__)
+
+
+def connection_key(server, ssh_key):
+    """
+    Identifies the SSH connections that can be shared: same host, port, login
+    user and key. The key's stored (encrypted) content is part of it, so
+    replacing a key's content never reuses a connection made with the old one.
+    """
+    digest = hashlib.sha256(ssh_key.key_content.encode()).hexdigest()
+    return (server.host, server.port, server.user, ssh_key.id, digest)
+
+
+def resolve_route(server, proxies=None):
+    """
+    Returns the hops needed to reach server as a list of (server, ssh_key),
+    from the outermost proxy server down to server itself, following the
+    proxy_server chain. Runs ORM queries, so call it from sync code. Pass the
+    same proxies dict when resolving many servers, so each proxy server is
+    only loaded once.
+    """
+    if proxies is None:
+        proxies = {}
+    route = [(server, server.ssh_key)]
+    seen = {server.id}
+    while server.proxy_server_id:
+        if server.proxy_server_id in seen:
+            raise ValueError(f"Proxy server chain of {route[-1][0]} loops back to itself.")
+        seen.add(server.proxy_server_id)
+        if server.proxy_server_id not in proxies:
+            proxies[server.proxy_server_id] = Server.objects.select_related('ssh_key').get(pk=server.proxy_server_id)
+        server = proxies[server.proxy_server_id]
+        route.insert(0, (server, server.ssh_key))
+    return route
+
+
+class TimedSSHClient(paramiko.SSHClient):
+    """
+    SSHClient that measures its authentication, so the time spent in
+    connect() can be split into TCP + key exchange and auth.
+    """
+    auth_seconds = 0.0
+
+    def _auth(self, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return super()._auth(*args, **kwargs)
+        finally:
+            self.auth_seconds = time.monotonic() - start
+
+
+class ProbedTransport(paramiko.Transport):
+    """
+    Transport that can tell whether its peer is still there, like OpenSSH's
+    ServerAliveInterval: probe() sends a keepalive@openssh.com request that
+    asks for an answer (paramiko's own keepalives don't, so they never notice
+    a half-open connection), and waiting_since is the monotonic time of the
+    oldest probe still unanswered. Any answer, even a refusal, proves the
+    peer alive.
+    """
+    waiting_since = None
+
+    def probe(self):
+        if self.waiting_since is None:
+            self.waiting_since = time.monotonic()
+        m = paramiko.Message()
+        m.add_byte(cMSG_GLOBAL_REQUEST)
+        m.add_string('keepalive@openssh.com')
+        m.add_boolean(True)
+        self._send_user_message(m)
+
+    def _parse_request_success(self, m):
+        self.waiting_since = None
+        super()._parse_request_success(m)
+
+    def _parse_request_failure(self, m):
+        self.waiting_since = None
+        super()._parse_request_failure(m)
+
+
+def connect_timeout(deadline=None):
+    """
+    Returns the seconds a connect step may take: SSH_CONNECT_TIMEOUT, or
+    less to end by deadline (a time.monotonic() value). Raises TimeoutError
+    once the deadline passed.
+    """
+    if deadline is None:
+        return settings.SSH_CONNECT_TIMEOUT
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError('timed out')
+    return min(remaining, settings.SSH_CONNECT_TIMEOUT)
+
+
+def open_client(server, ssh_key, sock=None, timings=None, deadline=None):
+    """
+    Connects and authenticates a new SSHClient to server with ssh_key. Adds
+    the time spent in each phase to the timings dict when given. Each phase
+    waits at most SSH_CONNECT_TIMEOUT seconds, and not past deadline.
+    """
+    timeout = connect_timeout(deadline)
+    start = time.monotonic()
+    pkey = ssh_key.load_pkey()
+    metrics.observe_connect_phase('key_decrypt', time.monotonic() - start, timings)
+    client = TimedSSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    start = time.monotonic()
+    client.connect(
+        server.host, port=server.port, username=server.user, pkey=pkey, sock=sock,
+        timeout=timeout,
+        banner_timeout=timeout,
+        auth_timeout=timeout,
+        transport_factory=ProbedTransport,
+    )
+    metrics.observe_connect_phase('tcp_kex', time.monotonic() - start - client.auth_seconds, timings)
+    metrics.observe_connect_phase('auth', client.auth_seconds, timings)
+    return client
+
+
+def open_session(client, request, deadline=None):
+    """
+    Opens a session channel on client and makes request(channel) on it (a
+    pty and shell, a subsystem), neither waiting past deadline: paramiko
+    waits for the answer to a channel request forever, so the channel is
+    closed under a request still waiting then. Returns the channel; raises
+    TimeoutError.
+    """
+    channel = client.get_transport().open_session(timeout=connect_timeout(deadline))
+    expired = threading.Event()
+
+    def expire():
+        expired.set()
+        channel.close()
+
+    timer = threading.Timer(connect_timeout(deadline), expire)
+    timer.start()
+    try:
+        request(channel)
+    except Exception as e:
+        channel.close()
+        if expired.is_set():
+            raise TimeoutError('timed out') from e
+        raise
+    finally:
+        timer.cancel()
+    if expired.is_set():
+        raise TimeoutError('timed out')
+    return channel
+
+
+def describe(key):
+    # user@host:port of the last hop of a pool key
+    host, port, user = key[-1][:3]
+    return f"{user}@{host}:{port}"
+
+
+class PooledConnection:
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.refcount = 0
+        self.idle_since = time.monotonic()
+
+    def is_active(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+
+class SSHConnectionPool:
+    """
+    Process-wide pool of authenticated SSH connections.
+
+    Every terminal to the same host, user and key opens its own session
+    channel over a shared connection instead of paying for a new key exchange
+    and authentication. Connections are reference counted and closed once
+    they have been unused for SSH_POOL_IDLE_TIMEOUT seconds. Every
+    SSH_KEEPALIVE_INTERVAL seconds each connection is probed, and those whose
+    peer stopped answering are closed along with their channels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> [PooledConnection]
+        self._connections = {}
+        # key -> [lock held while connecting, callers holding or waiting on
+        # it], so concurrent terminals to the same host wait for one
+        # handshake instead of each doing their own. Dropped once unused.
+        self._connect_locks = {}
+        # SSHClient -> PooledConnection
+        self._by_client = {}
+        # SSHClient -> pooled client of the proxy server it tunnels through
+        self._upstreams = {}
+        self._sweeper = None
+        self._prober = None
+
+    def acquire_route(self, route, max_channels=-1, timings=None, deadline=None):
+        """
+        Returns a connected SSHClient for the last hop of a route built by
+        resolve_route(). Every proxy server in the route is itself a pooled
+        connection shared by all servers behind it, and each hop is reached
+        through a direct-tcpip channel opened on the previous one. The
+        handshakes of new connections add their phases to timings. With a
+        deadline (a time.monotonic() value), waiting for and making the
+        connections stops there with a TimeoutError.
+        """
+        *hops, (server, ssh_key) = route
+        key = tuple(connection_key(*hop) for hop in route)
+        if not hops:
+            return self.acquire(
+                key, lambda: open_client(server, ssh_key, timings=timings, deadline=deadline), max_channels, deadline
+            )
+
+        def connect():
+            # Proxy servers only carry direct-tcpip channels, which don't
+            # count against sshd's MaxSessions, so don't cap them.
+            upstream = self.acquire_route(hops, max_channels=None, timings=timings, deadline=deadline)
+            try:
+                sock = upstream.get_transport().open_channel(
+                    'direct-tcpip', (server.host, server.port), ('127.0.0.1', 0),
+                    timeout=connect_timeout(deadline)
+                )
+                client = open_client(server, ssh_key, sock=sock, timings=timings, deadline=deadline)
+            except Exception:
+                self.release(upstream)
+                raise
+            with self._lock:
+                self._upstreams[client] = upstream
+            return client
+
+        return self.acquire(key, connect, max_channels, deadline)
+
+    def acquire(self, key, connect, max_channels=-1, deadline=None):
+        """
+        Returns a connected SSHClient for key, calling connect() to create one
+        if no pooled connection has a free channel slot (at most
+        SSH_POOL_MAX_CHANNELS by default, unlimited for None). Blocking, and
+        raises TimeoutError if another caller's handshake is still going at
+        deadline; every acquire must be paired with a release().
+        """
+        if max_channels == -1:
+            max_channels = settings.SSH_POOL_MAX_CHANNELS
+        with self._lock:
+            connect_lock = self._connect_locks.setdefault(key, [threading.Lock(), 0])
+            connect_lock[1] += 1
+        try:
+            if not connect_lock[0].acquire(timeout=-1 if deadline is None else max(0, deadline - time.monotonic())):
+                raise TimeoutError('timed out')
+            try:
+                with self._lock:
+                    conn = self._find(key, max_channels)
+                    if conn is not None:
+                        conn.refcount += 1
+                        logger.info(f"SSHConnectionPool: Reusing connection to {describe(key)} ({conn.refcount} in use).")
+                        return conn.client
+
+                client = connect()
+                with self._lock:
+                    conn = PooledConnection(key, client)
+                    conn.refcount = 1
+                    self._connections.setdefault(key, []).append(conn)
+                    self._by_client[client] = conn
+                    self._start_sweeper()
+                    self._start_prober()
+                logger.info(f"SSHConnectionPool: Opened new connection to {describe(key)}.")
+                return client
+            finally:
+                connect_lock[0].release()
+        finally:
+            with self._lock:
+                connect_lock[1] -= 1
+                self._drop_connect_lock(key)
+
+    def release(self, client):
+        """
+        Gives back a client returned by acquire(). Dead connections are closed
+        right away, live ones stay pooled until they have been idle too long.
+        """
+        with self._lock:
+            conn = self._by_client.get(client)
+            if conn is None:
+                return
+            conn.refcount -= 1
+            if conn.refcount > 0:
+                return
+            conn.idle_since = time.monotonic()
+            if conn.is_active():
+                return
+            self._remove(conn)
+        self._close(conn)
+
+    def evict_idle(self):
+        """
+        Closes connections that are unused past the idle timeout or dead.
+        Returns how many were closed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                conn
+                for conns in self._connections.values()
+                for conn in conns
+                if conn.refcount == 0 and (now - conn.idle_since >= settings.SSH_POOL_IDLE_TIMEOUT or not conn.is_active())
+            ]
+            for conn in expired:
+                self._remove(conn)
+        for conn in expired:
+            logger.info(f"SSHConnectionPool: Closing idle connection to {describe(conn.key)}.")
+            self._close(conn)
+        return len(expired)
+
+    def probe_all(self):
+        """
+        Probes every live connection, and closes those that left their probes
+        unanswered for SSH_KEEPALIVE_COUNT_MAX intervals: their peer is gone
+        even if TCP hasn't noticed. Their channels close with them, which ends
+        the terminals on them. Returns how many were closed.
+        """
+        now = time.monotonic()
+        deadline = settings.SSH_KEEPALIVE_INTERVAL * settings.SSH_KEEPALIVE_COUNT_MAX
+        with self._lock:
+            conns = list(self._by_client.values())
+        dead = []
+        for conn in conns:
+            transport = conn.client.get_transport()
+            if transport is None or not transport.is_active():
+                # Closed already, release() or evict_idle() drop it
+                continue
+            if transport.waiting_since is not None and now - transport.waiting_since >= deadline:
+                dead.append(conn)
+            else:
+                # Sending waits out a key exchange or a full socket buffer,
+                # so it mustn't hold up the probes of other connections
+                executor.submit(self._send_probe, conn)
+        for conn in dead:
+            logger.warning(f"SSHConnectionPool: {describe(conn.key)} stopped answering keepalives, closing the connection.")
+            metrics.ssh_dead_connections.inc()
+            # Users of the connection release it once their channel closes
+            conn.client.close()
+        return len(dead)
+
+    def _send_probe(self, conn):
+        try:
+            conn.client.get_transport().probe()
+        except Exception as e:
+            logger.warning(f"SSHConnectionPool: Probing {describe(conn.key)} failed: {e!r}")
+
+    def connection_count(self):
+        with self._lock:
+            return [
+                ((in_use,), sum(1 for conn in self._by_client.values() if (conn.refcount > 0) == (in_use == 'true')))
+                for in_use in ('true', 'false')
+            ]
+
+    def _find(self, key, max_channels):
+        for conn in self._connections.get(key, []):
+            if (max_channels is None or conn.refcount < max_channels) and conn.is_active():
+                return conn
+        return None
+
+    def _close(self, conn):
+        conn.client.close()
+        with self._lock:
+            upstream = self._upstreams.pop(conn.client, None)
+        if upstream is not None:
+            self.release(upstream)
+
+    def _remove(self, conn):
+        conns = self._connections.get(conn.key, [])
+        if conn in conns:
+            conns.remove(conn)
+        if not conns:
+            self._connections.pop(conn.key, None)
+            self._drop_connect_lock(conn.key)
+        self._by_client.pop(conn.client, None)
+
+    def _drop_connect_lock(self, key):
+        # Only once no connection is left and no caller holds or waits on the
+        # lock: a caller arriving later would otherwise make a new lock and
+        # connect in parallel with the one still holding the old lock.
+        connect_lock = self._connect_locks.get(key)
+        if connect_lock is not None and connect_lock[1] == 0 and key not in self._connections:
+            del self._connect_locks[key]
+
+    def _start_sweeper(self):
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep, name='ssh-pool-sweeper', daemon=True)
+            self._sweeper.start()
+
+    def _start_prober(self):
+        if self._prober is None and settings.SSH_KEEPALIVE_INTERVAL > 0:
+            self._prober = threading.Thread(target=self._probe, name='ssh-pool-prober', daemon=True)
+            self._prober.start()
+
+    def _probe(self):
+        while True:
+            time.sleep(settings.SSH_KEEPALIVE_INTERVAL)
+            try:
+                self.probe_all()
+            except Exception as e:
+                logger.error(f"SSHConnectionPool: Probing failed: {e}", exc_info=True)
+
+    def _sweep(self):
+        while True:
+            time.sleep(min(settings.SSH_POOL_IDLE_TIMEOUT, 30))
+            try:
+                self.evict_idle()
+            except Exception as e:
+                logger.error(f"SSHConnectionPool: Eviction failed: {e}", exc_info=True)
+
+
+ssh_pool = SSHConnectionPool()
+metrics.register_gauge(
+    'webssh_ssh_pool_connections', 'Pooled SSH connections, in use or idle (proxy hops included).',
+    ssh_pool.connection_count, labelnames=('in_use',)
+)
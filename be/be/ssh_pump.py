@@ -0,0 +1,176 @@
+import logging
+import os
+import selectors
+import threading
+from concurrent.futures import Future
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Bytes requested from paramiko per recv() call.
+READ_SIZE = 32 * 1024
+# Upper bound of buffered output drained from one channel per wakeup, so a
+# flooding channel can't starve the others.
+MAX_DRAIN_SIZE = 64 * 1024
+
+
+class ChannelPump:
+    """
+    Reads every registered paramiko channel from one shared daemon thread.
+
+    Instead of polling recv_ready() in a thread per terminal, the pump waits
+    on each channel's fileno() with a selector and only wakes up when a
+    channel has data or has been closed.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._commands = []
+        self._lock = threading.Lock()
+        self._thread = None
+        # fileno -> (channel, on_data, on_close) of channels not being read
+        self._paused = {}
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+    def register(self, channel, on_data, on_close):
+        """
+        Starts pumping a channel. on_data(bytes) is called for every read and
+        on_close() once when the channel reaches EOF or fails; both run on
+        the pump thread and must not block.
+
+        When on_data returns False the channel is paused: the pump stops
+        reading it, so paramiko stops extending the SSH window and the remote
+        side is throttled, until resume() is called.
+        """
+        fileno = channel.fileno()
+        self._submit(lambda: self._selector.register(fileno, selectors.EVENT_READ, (channel, on_data, on_close)))
+
+    def unregister(self, channel):
+        """
+        Stops pumping a channel without calling its on_close callback.
+
+        Returns a Future that resolves once the pump has let go of the
+        channel; wait for it before closing the channel, since close()
+        releases the file descriptor the pump is watching.
+        """
+        fileno = channel.fileno()
+        done = Future()
+
+        def forget():
+            try:
+                self._forget(fileno, channel)
+            finally:
+                done.set_result(None)
+
+        self._submit(forget)
+        return done
+
+    def thread_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def channel_count(self):
+        # Approximate when read off the pump thread, good enough for metrics
+        return len(self._selector.get_map()) - 1 + len(self._paused)
+
+    def resume(self, channel):
+        """
+        Starts reading a channel paused by its on_data callback again.
+        """
+        fileno = channel.fileno()
+        self._submit(lambda: self._resume(fileno, channel))
+
+    def _submit(self, command):
+        with self._lock:
+            self._commands.append(command)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ssh-channel-pump', daemon=True)
+                self._thread.start()
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            # The wakeup pipe is already full, the pump will wake up anyway.
+            pass
+
+    def _forget(self, fileno, channel):
+        # The descriptor may already belong to another channel if this one
+        # was closed in the meantime, so only drop our own registration.
+        if fileno in self._paused and self._paused[fileno][0] is channel:
+            del self._paused[fileno]
+            return
+        try:
+            key = self._selector.get_key(fileno)
+        except KeyError:
+            return
+        if key.data is not None and key.data[0] is channel:
+            self._selector.unregister(fileno)
+
+    def _pause(self, fileno, channel):
+        key = self._selector.get_map().get(fileno)
+        if key is not None and key.data[0] is channel:
+            self._selector.unregister(fileno)
+            self._paused[fileno] = key.data
+
+    def _resume(self, fileno, channel):
+        if fileno in self._paused and self._paused[fileno][0] is channel:
+            self._selector.register(fileno, selectors.EVENT_READ, self._paused.pop(fileno))
+
+    def _run(self):
+        logger.info("ChannelPump: Pump thread started.")
+        while True:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    self._run_commands()
+                elif self._selector.get_map().get(key.fd) is key:
+                    # Skip channels unregistered earlier in this same batch.
+                    self._pump(key.fd, *key.data)
+
+    def _run_commands(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            commands, self._commands = self._commands, []
+        for command in commands:
+            try:
+                command()
+            except Exception as e:
+                logger.error(f"ChannelPump: Command failed: {e}", exc_info=True)
+
+    def _pump(self, fileno, channel, on_data, on_close):
+        try:
+            # Drain whatever is already buffered in one go, so a flood turns
+            # into a few large chunks rather than many small ones.
+            chunks = []
+            size = 0
+            while size < MAX_DRAIN_SIZE and channel.recv_ready():
+                chunk = channel.recv(READ_SIZE)
+                chunks.append(chunk)
+                size += len(chunk)
+            while size < MAX_DRAIN_SIZE and channel.recv_stderr_ready():
+                chunk = channel.recv_stderr(READ_SIZE)
+                chunks.append(chunk)
+                size += len(chunk)
+            if size:
+                if on_data(b''.join(chunks)) is False:
+                    self._pause(fileno, channel)
+                return
+        except Exception as e:
+            logger.error(f"ChannelPump: Error reading from channel: {e}", exc_info=True)
+        # The channel woke us up without data, so it has been closed (or the
+        # read above failed): stop watching it and let the owner clean up.
+        self._forget(fileno, channel)
+        try:
+            on_close()
+        except Exception as e:
+            logger.error(f"ChannelPump: Close callback failed: {e}", exc_info=True)
+
+
+pump = ChannelPump()
+metrics.register_gauge('webssh_pump_threads_alive', 'Channel pump threads running.', lambda: int(pump.thread_alive()))
+metrics.register_gauge('webssh_pump_channels', 'SSH channels watched by the channel pump, paused ones included.', pump.channel_count)
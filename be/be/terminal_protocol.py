@@ -0,0 +1,69 @@
+"""
+Binary WebSocket protocol for terminal I/O.
+
+Clients that offer the SUBPROTOCOL when opening the WebSocket exchange
+binary frames made of a one-byte opcode followed by the payload:
+
+- OP_DATA:    raw terminal bytes (keystrokes in, SSH output out)
+- OP_RESIZE:  terminal size as two unsigned 16-bit big-endian ints (cols, rows)
+- OP_CONTROL: a UTF-8 JSON object for everything else (errors, status, ...)
+- OP_ACK:     bytes of output the client has processed, an unsigned 32-bit
+              big-endian int, used for flow control
+
+Clients that don't offer it keep using the JSON text messages.
+"""
+import json
+import struct
+
+SUBPROTOCOL = 'webssh.binary.v1'
+
+OP_DATA = 0x00
+OP_RESIZE = 0x01
+OP_CONTROL = 0x02
+OP_ACK = 0x03
+
+_RESIZE = struct.Struct('>HH')
+_ACK = struct.Struct('>I')
+
+
+def encode_frame(opcode, payload=b''):
+    return bytes((opcode,)) + payload
+
+
+def decode_frame(frame):
+    """
+    Splits a binary frame into its opcode and payload.
+    """
+    if not frame:
+        raise ValueError("Empty frame.")
+    return frame[0], frame[1:]
+
+
+def encode_control(message):
+    return encode_frame(OP_CONTROL, json.dumps(message).encode())
+
+
+def decode_control(payload):
+    return json.loads(payload.decode())
+
+
+def encode_resize(cols, rows):
+    return encode_frame(OP_RESIZE, _RESIZE.pack(cols, rows))
+
+
+def decode_resize(payload):
+    """
+    Returns the (cols, rows) carried by a resize frame.
+    """
+    return _RESIZE.unpack(payload)
+
+
+def encode_ack(size):
+    return encode_frame(OP_ACK, _ACK.pack(size))
+
+
+def decode_ack(payload):
+    """
+    Returns the byte count acknowledged by an ack frame.
+    """
+    return _ACK.unpack(payload)[0]
@@ -0,0 +1,64 @@
+"""
+Terminal tests against the SSH stand-in of the benchmarks (bench/sshd.py).
+"""
+import asyncio
+import io
+import uuid
+
+import paramiko
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from rest_framework_simplejwt.tokens import AccessToken
+
+from be import routing
+from be import terminal_protocol as protocol
+from be.models import Server, SSHKey, UserServerAccess
+from be.ws_auth import JWTAuthMiddleware
+from bench.sshd import SSHStandIn
+
+application = JWTAuthMiddleware(URLRouter(routing.websocket_urlpatterns))
+
+
+class StandInMixin:
+    """
+    Starts an SSH stand-in and creates a server on it that a user may open.
+    For TransactionTestCase, as the consumers read the database from other
+    threads.
+    """
+    standin_options = {}
+
+    def setUp(self):
+        super().setUp()
+        self.standin = SSHStandIn(**self.standin_options).start()
+        pkey = paramiko.RSAKey.generate(2048)
+        buffer = io.StringIO()
+        pkey.write_private_key(buffer)
+        key = SSHKey.objects.create(name='test', key_content=buffer.getvalue())
+        self.server = Server.objects.create(
+            site_name='test', server_name='standin', host='127.0.0.1', port=self.standin.port,
+            user=f'user{uuid.uuid4().hex[:8]}', ssh_key=key
+        )
+        self.user = User.objects.create(username='test')
+        UserServerAccess.objects.create(user=self.user, server=self.server)
+        self.token = str(AccessToken.for_user(self.user))
+
+    def tearDown(self):
+        self.standin.stop()
+        super().tearDown()
+
+    def terminal(self, session_id, binary=True, query=''):
+        return WebsocketCommunicator(
+            application, f'/ws/connect_server/{self.server.id}/{session_id}/?token={self.token}{query}',
+            subprotocols=[protocol.SUBPROTOCOL] if binary else None,
+        )
+
+    async def read_frame(self, communicator, timeout=30):
+        """
+        Returns (opcode, payload) of the next frame, or (None, close code).
+        communicator.receive_output() would cancel the consumer on timeout.
+        """
+        message = await asyncio.wait_for(communicator.output_queue.get(), timeout)
+        if message['type'] == 'websocket.close':
+            return None, message.get('code')
+        return protocol.decode_frame(message['bytes'])
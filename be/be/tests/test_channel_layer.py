@@ -0,0 +1,96 @@
+import asyncio
+import os
+import unittest
+import uuid
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.test import TransactionTestCase, override_settings
+
+from be import terminal_protocol as protocol
+from be.sessions import session_group
+
+from .standin import StandInMixin
+
+
+class SharedMemoryChannelLayer(InMemoryChannelLayer):
+    """
+    In-memory channel layer whose instances with the same name share their
+    channels and groups, like the workers connected to one Redis server.
+    """
+    shared = {}
+
+    def __init__(self, name='shared', **kwargs):
+        super().__init__(**kwargs)
+        self.channels, self.groups = self.shared.setdefault(name, ({}, {}))
+
+
+def two_workers(backend, config):
+    # The consumers use the 'default' layer, the tests send through 'other'
+    return override_settings(CHANNEL_LAYERS={
+        alias: {'BACKEND': backend, 'CONFIG': config} for alias in ('default', 'other')
+    })
+
+
+class CrossWorkerMixin(StandInMixin):
+    """
+    A terminal session held by one worker, and messages to its group sent by
+    another worker's channel layer instance.
+    """
+
+    async def open_session(self):
+        session_id = uuid.uuid4().hex
+        terminal = self.terminal(session_id)
+        connected, _ = await terminal.connect(30)
+        self.assertTrue(connected)
+        await self.read_until(terminal, b'$ ')
+        return session_id, terminal
+
+    async def read_until(self, terminal, marker, timeout=10):
+        output = b''
+        # Pings keep read_frame() from timing out by itself
+        async with asyncio.timeout(timeout):
+            while marker not in output:
+                opcode, payload = await self.read_frame(terminal)
+                self.assertIsNotNone(opcode, f"Closed with {payload}")
+                if opcode == protocol.OP_DATA:
+                    output += payload
+
+    async def test_layer_instances_differ(self):
+        self.assertIsNot(get_channel_layer('default'), get_channel_layer('other'))
+
+    async def test_input_from_other_worker(self):
+        session_id, terminal = await self.open_session()
+        await get_channel_layer('other').group_send(session_group(session_id), {
+            'type': 'session.viewer_input', 'data': b'from-other-worker',
+        })
+        await self.read_until(terminal, b'from-other-worker')
+        await terminal.disconnect(code=1000)
+
+    async def test_close_from_other_worker(self):
+        session_id, terminal = await self.open_session()
+        await get_channel_layer('other').group_send(session_group(session_id), {
+            'type': 'session.close', 'reason': 'closed by admin',
+        })
+        errors = []
+        async with asyncio.timeout(10):
+            while True:
+                opcode, payload = await self.read_frame(terminal)
+                if opcode is None:
+                    break
+                if opcode == protocol.OP_CONTROL and 'error' in protocol.decode_control(payload):
+                    errors.append(protocol.decode_control(payload)['error'])
+        self.assertEqual(errors, ["Session closed: closed by admin"])
+        await terminal.disconnect(code=1000)
+
+
+@two_workers(f'{__name__}.SharedMemoryChannelLayer', {'name': 'cross-worker'})
+class SharedLayerTests(CrossWorkerMixin, TransactionTestCase):
+    def setUp(self):
+        SharedMemoryChannelLayer.shared.clear()
+        super().setUp()
+
+
+@unittest.skipUnless(os.environ.get('REDIS_URL'), "Set REDIS_URL to run against Redis")
+@two_workers('channels_redis.core.RedisChannelLayer', {'hosts': [os.environ.get('REDIS_URL')]})
+class RedisLayerTests(CrossWorkerMixin, TransactionTestCase):
+    pass
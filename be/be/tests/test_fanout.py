@@ -0,0 +1,60 @@
+import asyncio
+import json
+import time
+from unittest import mock
+
+from channels.testing import WebsocketCommunicator
+from django.core import signing
+from django.db import OperationalError
+from django.test import TransactionTestCase, override_settings
+
+from be.fanout import EXEC_SALT
+from be.tests.standin import StandInMixin, application
+
+
+class ExecTests(StandInMixin, TransactionTestCase):
+    standin_options = {'exec_delay': (0.5, 0.5)}
+
+    def exec(self, command):
+        token = signing.dumps({
+            'user_id': self.user.id,
+            'username': self.user.username,
+            'command': command,
+            'site_name': self.server.site_name,
+            'server_ids': None,
+        }, salt=EXEC_SALT, compress=True)
+        return WebsocketCommunicator(application, f'/ws/exec/{token}/')
+
+    async def read_messages(self, communicator):
+        # Until the consumer closes; receive_from() would cancel it on timeout
+        messages = []
+        while True:
+            message = await asyncio.wait_for(communicator.output_queue.get(), 30)
+            if message['type'] == 'websocket.close':
+                return messages
+            messages.append(json.loads(message['text']))
+
+    async def test_runs_command(self):
+        communicator = self.exec('uptime')
+        await communicator.connect()
+        started, result, finished = await self.read_messages(communicator)
+        self.assertEqual(started['servers'], [{'id': self.server.id, 'site_name': 'test', 'server_name': 'standin'}])
+        self.assertEqual((result['server_id'], result['exit_status'], result['output']), (self.server.id, 0, 'out:uptime\n'))
+        self.assertEqual(finished['results'], {'ok': 1})
+
+    @override_settings(EXEC_FANOUT_TIMEOUT=0.2)
+    async def test_timeout(self):
+        communicator = self.exec('uptime')
+        began = time.monotonic()
+        await communicator.connect()
+        _, result, finished = await self.read_messages(communicator)
+        self.assertEqual(result['error'], 'Timed out.')
+        self.assertEqual(finished['results'], {'timeout': 1})
+        self.assertLess(time.monotonic() - began, 0.5)
+
+    async def test_selection_failure(self):
+        with mock.patch('be.consumers.select_servers', side_effect=OperationalError('database is locked')):
+            communicator = self.exec('uptime')
+            await communicator.connect()
+            messages = await self.read_messages(communicator)
+        self.assertEqual(messages, [{'type': 'exec_error', 'error': 'Failed to select the servers.'}])
@@ -0,0 +1,139 @@
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from be.key_cache import PKeyCache, parse_private_key, pkey_cache
+from be.models import SSHKey
+
+
+def private_key_text(pkey):
+    buffer = io.StringIO()
+    pkey.write_private_key(buffer)
+    return buffer.getvalue()
+
+
+def ed25519_key_text():
+    # paramiko can read Ed25519 keys but not generate them
+    return ed25519.Ed25519PrivateKey.generate().private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH, serialization.NoEncryption()
+    ).decode()
+
+
+class FakeSSHKey:
+    """
+    What PKeyCache needs of an SSHKey, counting decryptions.
+    """
+
+    def __init__(self, key_id, text, delay=0):
+        self.id = key_id
+        self.key_content = f'encrypted {key_id} {text}'
+        self.text = text
+        self.delay = delay
+        self.decrypted = 0
+
+    def decrypt_key(self):
+        self.decrypted += 1
+        time.sleep(self.delay)
+        return self.text
+
+
+class ParsePrivateKeyTests(SimpleTestCase):
+    def test_key_types(self):
+        for text, key_class in (
+            (private_key_text(paramiko.RSAKey.generate(2048)), paramiko.RSAKey),
+            (ed25519_key_text(), paramiko.Ed25519Key),
+            (private_key_text(paramiko.ECDSAKey.generate()), paramiko.ECDSAKey),
+        ):
+            with self.subTest(key_class=key_class.__name__):
+                self.assertIsInstance(parse_private_key(text), key_class)
+
+    def test_invalid_key(self):
+        with self.assertRaisesMessage(paramiko.SSHException, "Unsupported or invalid private key."):
+            parse_private_key('not a key')
+
+
+class PKeyCacheTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.text = private_key_text(paramiko.ECDSAKey.generate())
+
+    def setUp(self):
+        self.cache = PKeyCache()
+
+    def test_hit(self):
+        key = FakeSSHKey(1, self.text)
+        pkey = self.cache.get(key)
+        self.assertIs(self.cache.get(key), pkey)
+        self.assertEqual(key.decrypted, 1)
+
+    def test_changed_content_missed(self):
+        key = FakeSSHKey(1, self.text)
+        self.cache.get(key)
+        key.key_content += ' changed'
+        self.cache.get(key)
+        self.assertEqual(key.decrypted, 2)
+
+    @override_settings(SSH_PKEY_CACHE_SIZE=2)
+    def test_least_recently_used_evicted(self):
+        keys = [FakeSSHKey(key_id, self.text) for key_id in range(3)]
+        self.cache.get(keys[0])
+        self.cache.get(keys[1])
+        self.cache.get(keys[0])
+        self.cache.get(keys[2])
+        self.assertEqual(len(self.cache._keys), 2)
+        # keys[1] was used least recently
+        self.cache.get(keys[0])
+        self.cache.get(keys[2])
+        self.assertEqual([key.decrypted for key in keys], [1, 1, 1])
+        self.cache.get(keys[1])
+        self.assertEqual([key.decrypted for key in keys], [1, 2, 1])
+
+    def test_concurrent_misses_decrypt_once(self):
+        key = FakeSSHKey(1, self.text, delay=0.2)
+        start = threading.Barrier(8)
+
+        def get():
+            start.wait()
+            return self.cache.get(key)
+
+        with ThreadPoolExecutor(8) as pool:
+            pkeys = list(pool.map(lambda _: get(), range(8)))
+        self.assertEqual(key.decrypted, 1)
+        self.assertTrue(all(pkey is pkeys[0] for pkey in pkeys))
+        self.assertEqual(self.cache._loading, {})
+
+    def test_failed_load_not_cached(self):
+        key = FakeSSHKey(1, 'not a key')
+        for _ in range(2):
+            with self.assertRaises(paramiko.SSHException):
+                self.cache.get(key)
+        self.assertEqual(key.decrypted, 2)
+        self.assertEqual((self.cache._keys, self.cache._loading), ({}, {}))
+
+
+class SSHKeyInvalidationTests(TestCase):
+    def cached(self, key):
+        return [cache_key for cache_key in pkey_cache._keys if cache_key[0] == key.id]
+
+    def test_save_and_delete_invalidate(self):
+        key = SSHKey.objects.create(name='test', key_content=ed25519_key_text())
+        pkey = key.load_pkey()
+        self.assertIsInstance(pkey, paramiko.Ed25519Key)
+        self.assertEqual(len(self.cached(key)), 1)
+
+        key.key_content = private_key_text(paramiko.ECDSAKey.generate())
+        key.save()
+        self.assertEqual(self.cached(key), [])
+        self.assertIsInstance(key.load_pkey(), paramiko.ECDSAKey)
+        self.assertIsInstance(SSHKey.objects.get(pk=key.pk).load_pkey(), paramiko.ECDSAKey)
+
+        key_id = key.id
+        key.delete()
+        self.assertEqual([cache_key for cache_key in pkey_cache._keys if cache_key[0] == key_id], [])
@@ -0,0 +1,55 @@
+import io
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import LiveServerTestCase, TestCase, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from be import metrics
+from be.sessions import list_sessions
+
+
+class MetricsViewTests(TestCase):
+    def test_denied_by_default(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code, 401)
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'webssh_terminal_sessions', response.content)
+
+    def test_staff_only(self):
+        user = User.objects.create(username='user')
+        staff = User.objects.create(username='staff', is_staff=True)
+        response = self.client.get('/metrics', headers={'Authorization': f'Bearer {AccessToken.for_user(user)}'})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get('/metrics', headers={'Authorization': f'Bearer {AccessToken.for_user(staff)}'})
+        self.assertEqual(response.status_code, 200)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+class TerminalStatusTests(LiveServerTestCase):
+    @override_settings(METRICS_TOKEN='secret')
+    def test_reports_worker_counts(self):
+        metrics.terminal_reaped.inc(reason='idle')
+        reaped = metrics.terminal_reaped._values[('idle',)]
+        output = io.StringIO()
+        call_command('terminal_status', self.live_server_url, stdout=output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], self.live_server_url)
+        counts = dict(line.rsplit(':', 1) for line in lines[1:])
+        self.assertEqual(len(counts), 9)
+        self.assertEqual(int(counts['  Reaped: idle sessions']), reaped)
+        self.assertEqual(int(counts['  Terminal sessions']), len(list_sessions()))
+
+    def test_needs_metrics_token(self):
+        with self.assertRaisesMessage(CommandError, "Set METRICS_TOKEN"):
+            call_command('terminal_status', self.live_server_url)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_unreachable_worker(self):
+        with self.assertRaisesMessage(CommandError, "Could not read the metrics of http://127.0.0.1:1"):
+            call_command('terminal_status', 'http://127.0.0.1:1', stdout=io.StringIO())
@@ -0,0 +1,66 @@
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+
+from be.models import Server, SSHKey
+from be.pagination import InvalidCursor, decode_cursor, encode_cursor
+
+
+class CursorTests(SimpleTestCase):
+    def test_round_trip(self):
+        values = ['site é', 'web-01', 42]
+        self.assertEqual(decode_cursor(encode_cursor(values)), values)
+
+    def test_invalid(self):
+        for cursor in ('not base64!', encode_cursor([1])[:-3] + '%%%', 'bm90IGpzb24='):
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(cursor)
+
+
+class ServerListingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        key = SSHKey.objects.create(name='key', key_content='unused')
+        # Duplicate site and server names across sites, so the cursor needs every ordering field
+        for site in ('b', 'a', 'c'):
+            for number in range(5):
+                Server.objects.create(
+                    site_name=site, server_name=f'web{number % 3}', user='root', host=f'{site}{number}', ssh_key=key
+                )
+        cls.user = User.objects.create(username='user')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_pages_cover_every_server_once_in_order(self):
+        seen = []
+        url = '/api/servers/?limit=4'
+        while True:
+            data = self.client.get(url).json()
+            self.assertLessEqual(len(data['results']), 4)
+            seen += [(row['site_name'], row['server_name'], row['id']) for row in data['results']]
+            if data['next'] is None:
+                break
+            url = f"/api/servers/?limit=4&after={data['next']}"
+        self.assertEqual(seen, sorted(seen))
+        self.assertEqual(len(seen), Server.objects.count())
+
+    def test_each_page_is_one_query(self):
+        with self.assertNumQueries(1):
+            self.client.get('/api/servers/?limit=4&after=' + encode_cursor(['a', 'web1', 0]))
+
+    def test_limit_is_clamped(self):
+        self.assertEqual(len(self.client.get('/api/servers/?limit=0').json()['results']), 1)
+        self.assertEqual(len(self.client.get('/api/servers/?limit=x').json()['results']), 15)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/api/servers/?after=' + encode_cursor([1])).status_code, 400)
+        self.assertEqual(self.client.get('/api/servers/?after=%%%').status_code, 400)
+
+    def test_etag(self):
+        response = self.client.get('/api/servers/')
+        etag = response['ETag']
+        self.assertEqual(self.client.get('/api/servers/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Server.objects.filter(site_name='a').update(host='changed')
+        self.assertEqual(self.client.get('/api/servers/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
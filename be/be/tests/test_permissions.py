@@ -0,0 +1,109 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from be.models import Role, Server, SSHKey, UserRole, UserServerAccess
+from be.permissions import can_connect, rebuild_access, server_inventory
+
+
+class AccessSyncTests(TestCase):
+    """
+    UserServerAccess follows every change to roles, made through the ORM.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        key = SSHKey.objects.create(name='key', key_content='unused')
+        cls.web, cls.db, cls.mail = (
+            Server.objects.create(site_name='site', server_name=name, user='root', host=name, ssh_key=key)
+            for name in ('web', 'db', 'mail')
+        )
+        cls.alice = User.objects.create(username='alice')
+        cls.bob = User.objects.create(username='bob')
+        cls.admin = User.objects.create(username='admin', is_staff=True)
+
+    def setUp(self):
+        cache.clear()
+        self.ops = Role.objects.create(name='ops')
+        self.ops.permissions.set([self.web, self.db])
+        self.alice_roles = UserRole.objects.create(user=self.alice)
+        self.alice_roles.roles.add(self.ops)
+
+    def access(self):
+        return set(UserServerAccess.objects.values_list('user__username', 'server__server_name'))
+
+    def assert_consistent(self):
+        # What the signals maintained is what a full rebuild computes
+        access = self.access()
+        rebuild_access()
+        self.assertEqual(self.access(), access)
+
+    def test_role_servers(self):
+        self.assertEqual(self.access(), {('alice', 'web'), ('alice', 'db')})
+        self.assertTrue(can_connect(self.alice, self.db.id))
+        self.ops.permissions.remove(self.db)
+        self.assertFalse(can_connect(self.alice, self.db.id))
+        self.mail.role_set.add(self.ops)
+        self.assertEqual(self.access(), {('alice', 'web'), ('alice', 'mail')})
+        self.web.role_set.clear()
+        self.assertEqual(self.access(), {('alice', 'mail')})
+        self.ops.permissions.clear()
+        self.assertEqual(self.access(), set())
+        self.assert_consistent()
+
+    def test_user_roles(self):
+        bob_roles = UserRole.objects.create(user=self.bob)
+        self.ops.userrole_set.add(bob_roles)
+        self.assertTrue(can_connect(self.bob, self.web.id))
+        self.alice_roles.roles.remove(self.ops)
+        self.assertFalse(can_connect(self.alice, self.web.id))
+        self.ops.userrole_set.clear()
+        self.assertFalse(can_connect(self.bob, self.web.id))
+        self.assertEqual(self.access(), set())
+        self.assert_consistent()
+
+    def test_user_role_moved_to_another_user(self):
+        self.alice_roles.user = self.bob
+        self.alice_roles.save()
+        self.assertEqual(self.access(), {('bob', 'web'), ('bob', 'db')})
+        self.assert_consistent()
+
+    def test_deletions(self):
+        other = Role.objects.create(name='other')
+        other.permissions.add(self.mail)
+        bob_roles = UserRole.objects.create(user=self.bob)
+        bob_roles.roles.set([self.ops, other])
+        self.ops.delete()
+        self.assertEqual(self.access(), {('bob', 'mail')})
+        UserRole.objects.filter(user=self.bob).delete()
+        self.assertEqual(self.access(), set())
+        self.assert_consistent()
+
+    def test_server_changes_refresh_cached_inventories(self):
+        _, content = server_inventory(self.alice.id)
+        self.assertIn(b'"web"', content)
+        self.web.server_name = 'www'
+        self.web.save()
+        _, content = server_inventory(self.alice.id)
+        self.assertIn(b'"www"', content)
+        self.assertTrue(can_connect(self.alice, self.db.id))
+        self.db.delete()
+        self.assertNotIn(b'"db"', server_inventory(self.alice.id)[1])
+        self.assertFalse(can_connect(self.alice, self.db.id))
+
+    def test_api(self):
+        client = APIClient()
+        client.force_authenticate(self.admin)
+        response = client.post(f'/api/roles/{self.ops.id}/update_permissions/', {'server_ids': [self.mail.id]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.access(), {('alice', 'mail')})
+        response = client.post(f'/api/users/{self.bob.id}/update_roles/', {'role_ids': [self.ops.id]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.access(), {('alice', 'mail'), ('bob', 'mail')})
+        response = client.delete(f'/api/user-roles/{self.alice_roles.id}/delete/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.access(), {('bob', 'mail')})
+        response = client.delete(f'/api/roles/{self.ops.id}/delete/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.access(), set())
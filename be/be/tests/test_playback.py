@@ -0,0 +1,118 @@
+import gzip
+import json
+import os
+import tempfile
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core import signing
+from django.test import SimpleTestCase, override_settings
+
+from be import routing
+from be.playback import PLAYBACK_SALT, RecordingReader
+from be.recording import recording_dir
+
+application = URLRouter(routing.websocket_urlpatterns)
+
+
+def write_segment(path, number, events, timestamp=1000, compress=False, kinds=None):
+    """
+    Writes a segment and its index like recording.Recorder: a keyframe entry
+    for the first event and those whose kind is given as 'k' in kinds, a
+    periodic entry for 'p', and the end.
+    """
+    os.makedirs(path, exist_ok=True)
+    name = f"{number:06d}.cast" + ('.gz' if compress else '')
+    lines = [json.dumps({'version': 2, 'width': 80, 'height': 24, 'timestamp': timestamp}).encode() + b'\n']
+    index = []
+    offset = len(lines[0])
+    for position, (at, code, data) in enumerate(events):
+        kind = 'k' if position == 0 else (kinds or {}).get(position)
+        if kind:
+            index.append(f"{at:.6f} {offset} {kind}\n")
+        line = json.dumps([at, code, data]).encode() + b'\n'
+        lines.append(line)
+        offset += len(line)
+    index.append(f"{events[-1][0]:.6f} {offset} e\n")
+    opener = gzip.open if compress else open
+    with opener(os.path.join(path, name), 'wb') as file:
+        file.write(b''.join(lines))
+    with open(os.path.join(path, f"{number:06d}.idx"), 'w') as file:
+        file.writelines(index)
+
+
+class RecordingReaderTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+
+    def test_events_across_segments(self):
+        write_segment(self.path, 0, [(0.0, 'o', 'a'), (1.0, 'o', 'b')])
+        # Written by the recorder of a reconnected session, 10 seconds later
+        write_segment(self.path, 1, [(0.5, 'r', '100x30'), (2.0, 'o', 'c')], timestamp=1010, compress=True)
+        reader = RecordingReader(self.path)
+        self.assertEqual(
+            list(reader.events()), [(0.0, 'o', 'a'), (1.0, 'o', 'b'), (10.5, 'r', '100x30'), (12.0, 'o', 'c')]
+        )
+        self.assertEqual(reader.duration, 12.0)
+        self.assertEqual((reader.width, reader.height), (80, 24))
+
+    def test_seek_from_last_keyframe(self):
+        events = [(float(at), 'o', str(at)) for at in range(10)]
+        write_segment(self.path, 0, events, kinds={4: 'k', 6: 'p'})
+        reader = RecordingReader(self.path)
+        # The screen at 7 s is rebuilt from the screen clear at 4 s on
+        self.assertEqual([data for _, _, data in reader.events(7)], [str(at) for at in range(4, 10)])
+
+    def test_seek_fast_forward_is_bounded(self):
+        events = [(float(at), 'o', 'x' * 100) for at in range(10)]
+        write_segment(self.path, 0, events, kinds={at: 'p' for at in range(1, 10)})
+        reader = RecordingReader(self.path)
+        with override_settings(TERMINAL_PLAYBACK_MAX_FAST_FORWARD=250):
+            self.assertEqual([at for at, _, _ in reader.events(8)], [6.0, 7.0, 8.0, 9.0])
+        with override_settings(TERMINAL_PLAYBACK_MAX_FAST_FORWARD=10 ** 6):
+            self.assertEqual(len(list(reader.events(8))), 10)
+
+    def test_live_recording(self):
+        write_segment(self.path, 0, [(0.0, 'o', 'a')])
+        # The writer is in the middle of a line
+        with open(os.path.join(self.path, '000000.cast'), 'ab') as file:
+            file.write(b'[0.5, "o", "b')
+        self.assertEqual(list(RecordingReader(self.path).events()), [(0.0, 'o', 'a')])
+
+    def test_no_recording(self):
+        with self.assertRaises(FileNotFoundError):
+            RecordingReader(self.path)
+
+
+class PlaybackConsumerTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = override_settings(TERMINAL_RECORDING_DIR=directory.name)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        write_segment(recording_dir(1, 'abc'), 0, [(0.0, 'o', 'a'), (0.01, 'o', 'b'), (0.02, 'r', '100x30')])
+
+    async def receive(self, communicator):
+        return json.loads(await communicator.receive_from(5))
+
+    async def test_plays_to_the_end(self):
+        token = signing.dumps({'server_id': 1, 'session_id': 'abc'}, salt=PLAYBACK_SALT)
+        communicator = WebsocketCommunicator(application, f'/ws/playback/{token}/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(await self.receive(communicator), {'type': 'playback_info', 'duration': 0.02, 'cols': 80, 'rows': 24})
+        messages = []
+        while not messages or messages[-1].get('type') != 'playback_end':
+            messages.append(await self.receive(communicator))
+        self.assertEqual(messages[0], {'type': 'reset'})
+        self.assertEqual(''.join(message.get('output', '') for message in messages), 'ab')
+        self.assertIn({'type': 'resize', 'cols': 100, 'rows': 30}, messages)
+        await communicator.disconnect()
+
+    async def test_invalid_token(self):
+        communicator = WebsocketCommunicator(application, '/ws/playback/forged:token/')
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
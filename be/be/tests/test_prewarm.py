@@ -0,0 +1,46 @@
+import threading
+import time
+import types
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from be import prewarm
+
+
+class PrewarmLimitTests(SimpleTestCase):
+    def setUp(self):
+        # Shells open instantly, with nothing to close
+        patchers = [
+            mock.patch('be.prewarm.resolve_route', side_effect=self.resolve_route),
+            mock.patch('be.prewarm.open_shell', side_effect=lambda *args: (None, None)),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(prewarm._warm.clear)
+
+    def resolve_route(self, server):
+        # Stands in for the database queries, long enough for the requests
+        # to overlap
+        time.sleep(0.05)
+        return [(server, None)]
+
+    def test_concurrent_requests_respect_limit(self):
+        server = types.SimpleNamespace(id=1)
+        results = []
+        barrier = threading.Barrier(10)
+
+        def request(number):
+            barrier.wait()
+            results.append(prewarm.prewarm(f'session{number}', server, 7, (80, 24)))
+
+        threads = [threading.Thread(target=request, args=(number,)) for number in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results.count(True), prewarm.MAX_PENDING_PER_USER)
+        self.assertEqual(prewarm.pending_count(), prewarm.MAX_PENDING_PER_USER)
+        # Other users have their own allowance
+        self.assertTrue(prewarm.prewarm('other', server, 8, (80, 24)))
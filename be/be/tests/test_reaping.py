@@ -0,0 +1,209 @@
+import asyncio
+import time
+import uuid
+
+from django.test import TransactionTestCase, override_settings
+
+from be import metrics
+from be import terminal_protocol as protocol
+from be.models import Server, UserServerAccess
+from be.sessions import get_session, reap_sessions
+from be.ssh_pool import connection_key, ssh_pool
+from be.ssh_pump import pump
+from bench.sshd import SSHStandIn
+
+from .standin import StandInMixin
+
+
+class DeadTerminalMixin(StandInMixin):
+    async def open_terminal(self, server=None, query=''):
+        if server is not None:
+            self.server = server
+        session_id = uuid.uuid4().hex
+        terminal = self.terminal(session_id, query=query)
+        connected, _ = await terminal.connect(30)
+        self.assertTrue(connected)
+        await self.read_until(terminal, b'$ ')
+        return session_id, terminal
+
+    async def read_until(self, terminal, marker, timeout=10):
+        output = b''
+        async with asyncio.timeout(timeout):
+            while marker not in output:
+                opcode, payload = await self.read_frame(terminal)
+                self.assertIsNotNone(opcode, f"Closed with {payload}")
+                if opcode == protocol.OP_DATA:
+                    output += payload
+
+    async def read_until_closed(self, terminal, timeout=10):
+        """
+        Returns the errors the terminal was sent, and its close code.
+        """
+        errors = []
+        async with asyncio.timeout(timeout):
+            while True:
+                opcode, payload = await self.read_frame(terminal)
+                if opcode is None:
+                    return errors, payload
+                if opcode == protocol.OP_CONTROL and 'error' in protocol.decode_control(payload):
+                    errors.append(protocol.decode_control(payload)['error'])
+
+    async def wait_closed(self, session):
+        # Closed once its connection went back to the pool
+        for _ in range(100):
+            conn = ssh_pool._by_client.get(session.ssh_client)
+            if session.closed and (conn is None or conn.refcount == 0):
+                return
+            await asyncio.sleep(0.05)
+        self.fail(f"Session {session.session_id} still open")
+
+
+class ReapTests(DeadTerminalMixin, TransactionTestCase):
+    async def test_dead_transport_reaped_on_second_pass(self):
+        session_id, terminal = await self.open_terminal()
+        session = get_session(session_id)
+        # The connection goes away without the pump noticing
+        await asyncio.wrap_future(pump.unregister(session.channel))
+        session.ssh_client.get_transport().close()
+        reaped = metrics.terminal_reaped._values.get(('dead_peer',), 0)
+
+        self.assertEqual(reap_sessions(), {'idle': 0, 'dead_peer': 0})
+        self.assertFalse(session.closed)
+        self.assertEqual(reap_sessions(), {'idle': 0, 'dead_peer': 1})
+        errors, _ = await self.read_until_closed(terminal)
+        self.assertEqual(errors, ["Session closed: server connection lost"])
+        await self.wait_closed(session)
+        self.assertEqual(metrics.terminal_reaped._values[('dead_peer',)], reaped + 1)
+        self.assertEqual(reap_sessions(), {'idle': 0, 'dead_peer': 0})
+        await terminal.disconnect(code=1000)
+
+    async def test_live_session_not_reaped(self):
+        session_id, terminal = await self.open_terminal()
+        self.assertEqual(reap_sessions(), {'idle': 0, 'dead_peer': 0})
+        self.assertEqual(reap_sessions(), {'idle': 0, 'dead_peer': 0})
+        self.assertFalse(get_session(session_id).closed)
+        await terminal.disconnect(code=1000)
+
+    @override_settings(TERMINAL_IDLE_TIMEOUT=60)
+    async def test_idle_session_closed(self):
+        session_id, terminal = await self.open_terminal()
+        session = get_session(session_id)
+        self.assertEqual(reap_sessions(), {'idle': 0, 'dead_peer': 0})
+        # Typing and output count as activity
+        session.last_activity -= 61
+        await terminal.send_to(bytes_data=protocol.encode_frame(protocol.OP_DATA, b'still here'))
+        await self.read_until(terminal, b'still here')
+        self.assertEqual(reap_sessions(), {'idle': 0, 'dead_peer': 0})
+
+        session.last_activity -= 61
+        self.assertEqual(reap_sessions(), {'idle': 1, 'dead_peer': 0})
+        errors, _ = await self.read_until_closed(terminal)
+        self.assertEqual(errors, ["Session closed: idle for too long"])
+        await self.wait_closed(session)
+        self.assertIsNone(get_session(session_id))
+        await terminal.disconnect(code=1000)
+
+
+@override_settings(TERMINAL_PING_INTERVAL=0.1, TERMINAL_PING_TIMEOUT=0.5, TERMINAL_SESSION_GRACE=30)
+class PingTimeoutTests(DeadTerminalMixin, TransactionTestCase):
+    async def test_silent_client_dropped_and_session_kept(self):
+        session_id, terminal = await self.open_terminal()
+        dropped = metrics.terminal_reaped._values.get(('ping_timeout',), 0)
+        await terminal.send_to(bytes_data=protocol.encode_control({'type': 'pong'}))
+        started = time.monotonic()
+        errors, code = await self.read_until_closed(terminal)
+        self.assertEqual(code, 4408)
+        self.assertGreaterEqual(time.monotonic() - started, 0.5)
+        self.assertEqual(errors, [])
+        self.assertEqual(metrics.terminal_reaped._values[('ping_timeout',)], dropped + 1)
+        await terminal.disconnect(code=4408)
+
+        # Kept for the client to resume
+        session = get_session(session_id)
+        self.assertIsNotNone(session)
+        self.assertIsNone(session.consumer)
+        self.assertFalse(session.closed)
+        resumed = self.terminal(session_id, query='&offset=0')
+        connected, _ = await resumed.connect(30)
+        self.assertTrue(connected)
+        await resumed.send_to(bytes_data=protocol.encode_frame(protocol.OP_DATA, b'back'))
+        await self.read_until(resumed, b'back')
+        self.assertIs(get_session(session_id), session)
+        await resumed.disconnect(code=1000)
+
+    async def test_client_never_answering_pings_kept(self):
+        session_id, terminal = await self.open_terminal()
+        await asyncio.sleep(1)
+        await terminal.send_to(bytes_data=protocol.encode_frame(protocol.OP_DATA, b'still here'))
+        await self.read_until(terminal, b'still here')
+        await terminal.disconnect(code=1000)
+
+
+@override_settings(SSH_KEEPALIVE_INTERVAL=0.2, SSH_KEEPALIVE_COUNT_MAX=5)
+class KeepaliveTests(DeadTerminalMixin, TransactionTestCase):
+    """
+    A proxy server that stops answering, with a terminal reached through it,
+    and a terminal on a server reached directly that keeps answering.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.hung = SSHStandIn(answer_keepalives=False).start()
+        self.addCleanup(self.hung.stop)
+        self.direct = self.server
+        self.proxy = Server.objects.create(
+            site_name='test', server_name='proxy', host='127.0.0.1', port=self.hung.port,
+            user='proxy', ssh_key=self.direct.ssh_key
+        )
+        self.proxied = Server.objects.create(
+            site_name='test', server_name='proxied', host='127.0.0.1', port=self.standin.port,
+            user='proxied', ssh_key=self.direct.ssh_key, proxy_server=self.proxy
+        )
+        UserServerAccess.objects.create(user=self.user, server=self.proxied)
+
+    def pooled(self, *route):
+        key = tuple(connection_key(server, server.ssh_key) for server in route)
+        conns = ssh_pool._connections.get(key, [])
+        self.assertEqual(len(conns), 1)
+        return conns[0].client.get_transport()
+
+    async def test_unanswered_probes_close_connection_and_proxied_terminals(self):
+        proxied_id, proxied = await self.open_terminal(self.proxied)
+        direct_id, direct = await self.open_terminal(self.direct)
+        proxy_transport = self.pooled(self.proxy)
+        proxied_transport = self.pooled(self.proxy, self.proxied)
+        direct_transport = self.pooled(self.direct)
+        closed = metrics.ssh_dead_connections._values.get((), 0)
+
+        self.assertEqual(ssh_pool.probe_all(), 0)
+        # Probes are sent on the SSH I/O threads
+        async with asyncio.timeout(5):
+            while proxy_transport.waiting_since is None:
+                await asyncio.sleep(0.01)
+        waiting_since = proxy_transport.waiting_since
+        # Unanswered, but for fewer than SSH_KEEPALIVE_COUNT_MAX intervals
+        await asyncio.sleep(0.3)
+        self.assertEqual(ssh_pool.probe_all(), 0)
+        self.assertTrue(proxy_transport.is_active())
+        async with asyncio.timeout(5):
+            while proxy_transport.is_active():
+                ssh_pool.probe_all()
+                await asyncio.sleep(0.05)
+        self.assertGreaterEqual(time.monotonic() - waiting_since, 1.0)
+        self.assertGreater(metrics.ssh_dead_connections._values[()], closed)
+
+        # The terminal behind the proxy ends with its connection
+        async with asyncio.timeout(5):
+            while proxied_transport.is_active():
+                await asyncio.sleep(0.05)
+        errors, _ = await self.read_until_closed(proxied)
+        self.assertEqual(errors, [])
+        await proxied.disconnect(code=1000)
+        self.assertIsNone(get_session(proxied_id))
+
+        # The connection that answers stays, and so does its terminal
+        self.assertTrue(direct_transport.is_active())
+        await direct.send_to(bytes_data=protocol.encode_frame(protocol.OP_DATA, b'still here'))
+        await self.read_until(direct, b'still here')
+        self.assertIsNotNone(get_session(direct_id))
+        await direct.disconnect(code=1000)
@@ -0,0 +1,134 @@
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from unittest import mock
+
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from be import metrics, recording
+from be import terminal_protocol as protocol
+from be.recording import Recorder, RecordingWriter, list_segments, segment_index_path
+from be.ssh_pool import ssh_pool
+
+from .standin import StandInMixin
+
+
+class RecorderTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        patcher = override_settings(TERMINAL_RECORDING_DIR=self.directory.name)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        # A writer of our own, so shutdown() writes everything out
+        self.writer = RecordingWriter()
+        patcher = mock.patch.object(recording, 'writer', self.writer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def record(self, *events, width=80, height=24):
+        recorder = Recorder(1, 'abc', width=width, height=height)
+        for method, *args in events:
+            getattr(recorder, method)(*args)
+        recorder.close()
+        self.writer.shutdown()
+        return recorder.path
+
+    def read_segment(self, path, name):
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(os.path.join(path, name), 'rt') as file:
+            return [json.loads(line) for line in file]
+
+    def test_events(self):
+        path = self.record(('output', b'$ '), ('input', b'ls\r'), ('resize', 100, 30), width=90, height=20)
+        segments = list_segments(path)
+        self.assertEqual(segments, ['000000.cast'])
+        header, *events = self.read_segment(path, segments[0])
+        self.assertEqual((header['version'], header['width'], header['height']), (2, 90, 20))
+        self.assertEqual([event[1:] for event in events], [['o', '$ '], ['i', 'ls\r'], ['r', '100x30']])
+        with open(segment_index_path(path, segments[0])) as index:
+            kinds = [line.split()[2] for line in index]
+        self.assertEqual((kinds[0], kinds[-1]), ('k', 'e'))
+
+    def test_split_characters(self):
+        data = 'héllo'.encode()
+        path = self.record(('output', data[:2]), ('output', data[2:]))
+        _, *events = self.read_segment(path, '000000.cast')
+        self.assertEqual(''.join(event[2] for event in events), 'héllo')
+
+    @override_settings(TERMINAL_RECORDING_SEGMENT_BYTES=100, TERMINAL_RECORDING_COMPRESS='gzip')
+    def test_segments(self):
+        path = self.record(*[('output', b'x' * 60) for _ in range(5)])
+        segments = list_segments(path)
+        self.assertGreater(len(segments), 1)
+        self.assertTrue(all(name.endswith('.cast.gz') for name in segments))
+        outputs = [event[2] for name in segments for event in self.read_segment(path, name)[1:]]
+        self.assertEqual(outputs, ['x' * 60] * 5)
+
+    @mock.patch.object(recording, 'MAX_QUEUED_BYTES', 100)
+    def test_gap_when_writer_falls_behind(self):
+        # The writer thread is held back until everything was queued
+        self.writer._thread = object()
+        dropped = metrics.recording_dropped_bytes._values.get((), 0)
+        recorder = Recorder(1, 'abc')
+        for data in (b'a' * 60, b'b' * 60, b'c' * 60, 'dé'.encode()[:2]):
+            recorder.output(data)
+        recorder.resize(100, 30)
+        self.assertEqual(self.writer._queued_bytes, 120)
+        self.writer._thread = threading.Thread(target=self.writer._run, daemon=True)
+        self.writer._thread.start()
+        for _ in range(100):
+            if self.writer._queued_bytes == 0:
+                break
+            time.sleep(0.01)
+        recorder.output('é'.encode()[1:] + b'e')
+        recorder.input(b'f' * 200)
+        recorder.close()
+        self.writer.shutdown()
+
+        _, *events = self.read_segment(recorder.path, '000000.cast')
+        self.assertEqual([event[1:] for event in events], [
+            ['o', 'a' * 60], ['o', 'b' * 60], ['m', 'gap: 62 bytes not recorded'], ['r', '100x30'],
+            ['o', '\ufffde'], ['i', 'f' * 200],
+        ])
+        self.assertEqual(recorder.dropped_bytes, 62)
+        self.assertEqual(metrics.recording_dropped_bytes._values[()], dropped + 62)
+
+    @mock.patch.object(recording, 'MAX_QUEUED_BYTES', 100)
+    def test_gap_before_close(self):
+        self.writer._thread = object()
+        recorder = Recorder(1, 'abc')
+        recorder.output(b'a' * 100)
+        recorder.output(b'b' * 10)
+        recorder.close()
+        self.writer._thread = threading.Thread(target=self.writer._run, daemon=True)
+        self.writer._thread.start()
+        self.writer.shutdown()
+        _, *events = self.read_segment(recorder.path, '000000.cast')
+        self.assertEqual([event[1:] for event in events], [['o', 'a' * 100], ['m', 'gap: 10 bytes not recorded']])
+
+    def test_nothing_recorded_leaves_no_files(self):
+        path = self.record()
+        self.assertFalse(os.path.exists(path))
+
+
+class RecordingFailureTests(StandInMixin, TransactionTestCase):
+    async def test_shell_closed_when_recording_cannot_start(self):
+        # A file where the recording directory should be
+        with tempfile.NamedTemporaryFile() as file, override_settings(TERMINAL_RECORDING_DIR=file.name):
+            communicator = self.terminal(uuid.uuid4().hex)
+            await communicator.connect(30)
+            errors = []
+            while True:
+                opcode, payload = await self.read_frame(communicator)
+                if opcode is None:
+                    break
+                if opcode == protocol.OP_CONTROL and 'error' in protocol.decode_control(payload):
+                    errors.append(protocol.decode_control(payload)['error'])
+        self.assertEqual(len(errors), 1)
+        # The shell's pooled connection was given back
+        self.assertEqual(dict(ssh_pool.connection_count())[('true',)], 0)
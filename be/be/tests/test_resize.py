@@ -0,0 +1,75 @@
+import asyncio
+import uuid
+
+from django.test import TransactionTestCase, override_settings
+
+from be import terminal_protocol as protocol
+from be.sessions import get_session
+
+from .standin import StandInMixin
+
+
+@override_settings(TERMINAL_RESIZE_DEBOUNCE=0.2)
+class ResizeTests(StandInMixin, TransactionTestCase):
+    async def open_terminal(self, query=''):
+        session_id = uuid.uuid4().hex
+        terminal = self.terminal(session_id, query=query)
+        connected, _ = await terminal.connect(30)
+        self.assertTrue(connected)
+        output = b''
+        while b'$ ' not in output:
+            opcode, payload = await self.read_frame(terminal)
+            if opcode == protocol.OP_DATA:
+                output += payload
+        return get_session(session_id), terminal
+
+    async def settle(self, session):
+        # Until the consumer took the sizes sent, applied the last one and
+        # waited out the debounce, by which time the stand-in got it too
+        async with asyncio.timeout(10):
+            while session.consumer.resize_task is None:
+                await asyncio.sleep(0.01)
+            while session.consumer.resize_task is not None:
+                await asyncio.sleep(0.01)
+
+    async def test_initial_size(self):
+        for query, size in (
+            ('', (80, 24)),
+            ('&cols=120&rows=40', (120, 40)),
+            ('&cols=5000&rows=0', (1000, 1)),
+            ('&cols=abc&rows=-5', (80, 24)),
+            ('&cols=&rows=30', (80, 30)),
+        ):
+            with self.subTest(query=query):
+                session, terminal = await self.open_terminal(query)
+                self.assertEqual(self.standin.ptys[-1], ('xterm-256color', *size))
+                self.assertEqual(session.size, size)
+                await terminal.disconnect(code=1000)
+        self.assertEqual(self.standin.resizes, [])
+
+    async def test_burst_gives_first_and_last(self):
+        session, terminal = await self.open_terminal('&cols=80&rows=24')
+        for cols in range(100, 120):
+            await terminal.send_to(bytes_data=protocol.encode_resize(cols, 30))
+        await self.settle(session)
+        self.assertEqual(self.standin.resizes, [(100, 30), (119, 30)])
+        self.assertEqual(session.size, (119, 30))
+
+        # Clamped like the initial size
+        await terminal.send_to(bytes_data=protocol.encode_control({'type': 'resize', 'cols': 5000, 'rows': 0}))
+        await self.settle(session)
+        self.assertEqual(self.standin.resizes[-1], (1000, 1))
+        await terminal.disconnect(code=1000)
+
+    async def test_same_size_not_sent(self):
+        session, terminal = await self.open_terminal('&cols=100&rows=30')
+        for _ in range(3):
+            await terminal.send_to(bytes_data=protocol.encode_resize(100, 30))
+            await self.settle(session)
+        # A burst that ends where it started
+        await terminal.send_to(bytes_data=protocol.encode_resize(100, 30))
+        await terminal.send_to(bytes_data=protocol.encode_resize(90, 30))
+        await terminal.send_to(bytes_data=protocol.encode_resize(100, 30))
+        await self.settle(session)
+        self.assertEqual(self.standin.resizes, [])
+        await terminal.disconnect(code=1000)
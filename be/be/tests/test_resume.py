@@ -0,0 +1,44 @@
+import asyncio
+import json
+import uuid
+
+from django.test import TransactionTestCase, override_settings
+
+from be import terminal_protocol as protocol
+from be.sessions import get_session
+
+from .standin import StandInMixin
+
+
+@override_settings(TERMINAL_FLOW_HIGH_WATER=64 * 1024, TERMINAL_FLOW_LOW_WATER=16 * 1024, TERMINAL_SESSION_GRACE=30)
+class ResumeTests(StandInMixin, TransactionTestCase):
+    async def test_text_client_resumes_session_paused_by_binary_client(self):
+        session_id = uuid.uuid4().hex
+        binary = self.terminal(session_id)
+        await binary.connect(30)
+        while True:
+            opcode, payload = await self.read_frame(binary)
+            if opcode == protocol.OP_DATA and b'$ ' in payload:
+                break
+        session = get_session(session_id)
+        # Output is never acknowledged, so the flood pauses the channel
+        await binary.send_to(bytes_data=protocol.encode_frame(protocol.OP_DATA, b'flood 500'))
+        for _ in range(500):
+            if session.paused:
+                break
+            await asyncio.sleep(0.01)
+        self.assertTrue(session.paused)
+        # The connection drops without a close
+        await binary.disconnect(code=1006)
+
+        text = self.terminal(session_id, binary=False, query='&offset=0&cols=120&rows=40')
+        await text.connect(30)
+        # Typed after the flood, so echoed once all of it was read
+        await text.send_to(text_data=json.dumps({'message': 'done'}))
+        output = ''
+        while 'done' not in output:
+            message = json.loads((await asyncio.wait_for(text.output_queue.get(), 10))['text'])
+            output += message.get('output', '')
+        self.assertFalse(session.paused)
+        self.assertEqual(session.size, (120, 40))
+        await text.disconnect(code=1000)
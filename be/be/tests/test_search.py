@@ -0,0 +1,96 @@
+import time
+import types
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from be.search import ScrollbackIndex, compile_query
+
+
+def make_index(*chunks):
+    index = ScrollbackIndex('session')
+    # Indexed in place instead of on the indexer thread
+    for chunk in chunks:
+        index.index(chunk)
+    return index
+
+
+class ScrollbackIndexTests(SimpleTestCase):
+    def search(self, index, query, **options):
+        pattern, lower = compile_query(query, options.pop('is_regex', False), options.pop('ignore_case', False))
+        return index.search(pattern, lower=lower, **options)
+
+    def test_strips_terminal_output(self):
+        index = make_index(
+            b'\x1b[1;31mred\x1b[0m text\r\n',
+            b'\x1b[?1049hin vim\r\n\x1b[?1049l',
+            b'10%\r50%\r100%\r\n',
+            # An escape sequence and a character split across chunks
+            b'caf\xc3', b'\xa9 \x1b[3', b'2mgreen\r\n',
+        )
+        lines = [match['text'] for match in self.search(index, '', is_regex=True, limit=10)['matches']]
+        self.assertEqual(lines, ['red text', '100%', 'café green'])
+        self.assertEqual(self.search(index, 'vim')['matches'], [])
+
+    def test_most_recent_matches_with_context_across_blocks(self):
+        with mock.patch('be.search.BLOCK_LINES', 4):
+            index = make_index(*(f'line {number}\n'.encode() for number in range(1, 21)))
+        self.assertGreater(len(index.blocks), 3)
+        result = self.search(index, r'line 1\d$', is_regex=True, context=2, limit=3)
+        self.assertTrue(result['truncated'])
+        self.assertEqual([match['line'] for match in result['matches']], [17, 18, 19])
+        first = result['matches'][0]
+        self.assertEqual((first['before'], first['after']), (['line 15', 'line 16'], ['line 18', 'line 19']))
+        self.assertEqual((result['first_line'], result['last_line']), (1, 20))
+
+    def test_ignore_case(self):
+        index = make_index(b'Error: A.B\nerror: AxB\n')
+        self.assertEqual(len(self.search(index, 'error: a.b', ignore_case=True)['matches']), 1)
+        self.assertEqual(len(self.search(index, 'error: a.b', is_regex=True, ignore_case=True)['matches']), 2)
+
+    def test_timeout(self):
+        index = make_index(b'x' * 4000 + b'\n')
+        pattern, _ = compile_query('(x+x+)+y', True)
+        started = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            index.search(pattern, timeout=0.1)
+        self.assertLess(time.monotonic() - started, 1)
+
+
+class SearchViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(username='owner')
+        cls.other = User.objects.create(username='other')
+
+    def setUp(self):
+        session = types.SimpleNamespace(user_id=self.owner.id, search_index=make_index(b'x' * 4000 + b'\nfound\n'))
+        patcher = mock.patch('be.views.get_session', return_value=session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, user, **params):
+        headers = {'Authorization': f'Bearer {AccessToken.for_user(user)}'} if user else {}
+        return self.client.get('/api/terminal-sessions/abc/search/', params, headers=headers)
+
+    def test_search(self):
+        response = self.get(self.owner, q='FOUND', ignore_case=1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['matches'][0]['line'], 2)
+
+    def test_access(self):
+        self.assertEqual(self.get(None, q='found').status_code, 401)
+        self.assertEqual(self.get(self.other, q='found').status_code, 404)
+
+    def test_invalid_regex(self):
+        self.assertEqual(self.get(self.owner, q='(', regex=1).status_code, 400)
+
+    @override_settings(TERMINAL_SEARCH_TIMEOUT=0.1)
+    def test_slow_pattern_times_out(self):
+        started = time.monotonic()
+        response = self.get(self.owner, q='(x+x+)+y', regex=1)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('took longer', response.json()['error'])
+        self.assertLess(time.monotonic() - started, 1)
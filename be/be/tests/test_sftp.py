@@ -0,0 +1,165 @@
+import asyncio
+import os
+import tempfile
+
+from django.core import signing
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from be import sftp
+from be.sftp import SFTP_SALT, parse_range
+
+from .standin import StandInMixin
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_ranges(self):
+        self.assertEqual(parse_range('bytes=10-19', 100), (10, 20))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 100))
+        # The last bytes, at most the whole file
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 100))
+        self.assertEqual(parse_range('bytes=-500', 100), (0, 100))
+        # An end past the file stops at its end
+        self.assertEqual(parse_range('bytes=50-500', 100), (50, 100))
+
+    def test_whole_file(self):
+        for header in (None, '', 'bytes=-', 'items=0-5', 'bytes=0-5,10-15'):
+            self.assertIsNone(parse_range(header, 100))
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=100-', 'bytes=150-200', 'bytes=20-10', 'bytes=-0'):
+            with self.assertRaises(ValueError):
+                parse_range(header, 100)
+
+
+@override_settings(SFTP_BLOCK_SIZE=64 * 1024, SFTP_MAX_TRANSFERS_PER_USER=1)
+class SFTPViewTests(StandInMixin, TransactionTestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.standin_options = {'sftp_root': self.root.name}
+        super().setUp()
+        self.headers = {'Authorization': f'Bearer {self.token}'}
+        # Not a multiple of the block or read size
+        self.content = os.urandom(300 * 1024 + 123)
+        with open(os.path.join(self.root.name, 'file.bin'), 'wb') as local:
+            local.write(self.content)
+
+    def download_url(self, path='file.bin'):
+        token = signing.dumps({'user_id': self.user.id, 'server_id': self.server.id, 'path': path}, salt=SFTP_SALT)
+        return f'/api/files/{token}/'
+
+    async def read(self, response):
+        blocks = [block async for block in response.streaming_content]
+        return blocks
+
+    async def wait_for_slots(self):
+        # Slots of streamed downloads are given back on the event loop
+        for _ in range(100):
+            if not sftp._transfers:
+                return
+            await asyncio.sleep(0.01)
+        self.fail(f"Transfer slots still taken: {dict(sftp._transfers)}")
+
+    async def test_list_files(self):
+        response = await self.async_client.get(f'/api/servers/{self.server.id}/files/', {'path': '/'}, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        entries = response.json()['entries']
+        self.assertEqual([(entry['name'], entry['size']) for entry in entries], [('file.bin', len(self.content))])
+
+    async def test_download_streams_blocks(self):
+        response = await self.async_client.get(self.download_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        blocks = await self.read(response)
+        self.assertEqual(b''.join(blocks), self.content)
+        self.assertEqual([len(block) for block in blocks], [64 * 1024] * 4 + [len(self.content) - 4 * 64 * 1024])
+        await self.wait_for_slots()
+
+    async def test_ranges(self):
+        response = await self.async_client.get(self.download_url(), headers={'Range': 'bytes=-1000'})
+        self.assertEqual(response.status_code, 206)
+        size = len(self.content)
+        self.assertEqual(response['Content-Range'], f'bytes {size - 1000}-{size - 1}/{size}')
+        self.assertEqual(b''.join(await self.read(response)), self.content[-1000:])
+        await self.wait_for_slots()
+
+        response = await self.async_client.get(self.download_url(), headers={'Range': 'bytes=100000-'})
+        self.assertEqual(b''.join(await self.read(response)), self.content[100000:])
+        await self.wait_for_slots()
+
+        response = await self.async_client.get(self.download_url(), headers={'Range': f'bytes={size}-'})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{size}')
+        await self.wait_for_slots()
+
+    async def test_if_range_and_head(self):
+        response = await self.async_client.head(self.download_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(response.content, b'')
+        last_modified = response['Last-Modified']
+        await self.wait_for_slots()
+
+        # Same file: the range is served
+        response = await self.async_client.head(
+            self.download_url(), headers={'Range': 'bytes=0-9', 'If-Range': last_modified}
+        )
+        self.assertEqual((response.status_code, response['Content-Length']), (206, '10'))
+        await self.wait_for_slots()
+
+        # Changed since: the whole file is sent instead
+        response = await self.async_client.get(
+            self.download_url(), headers={'Range': 'bytes=0-9', 'If-Range': 'Thu, 01 Jan 1970 00:00:00 GMT'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(await self.read(response)), self.content)
+        await self.wait_for_slots()
+
+    async def test_upload_and_resume(self):
+        url = f'/api/servers/{self.server.id}/files/upload/'
+        response = await self.async_client.put(
+            f'{url}?path=up.bin', self.content[:100000], content_type='application/octet-stream', headers=self.headers
+        )
+        self.assertEqual(response.json(), {'path': 'up.bin', 'size': 100000})
+
+        response = await self.async_client.put(
+            f'{url}?path=up.bin&offset=5000', b'x', content_type='application/octet-stream', headers=self.headers
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['size'], 100000)
+
+        response = await self.async_client.put(
+            f'{url}?path=up.bin&offset=100000', self.content[100000:],
+            content_type='application/octet-stream', headers=self.headers
+        )
+        self.assertEqual(response.json()['size'], len(self.content))
+        with open(os.path.join(self.root.name, 'up.bin'), 'rb') as local:
+            self.assertEqual(local.read(), self.content)
+        self.assertFalse(sftp._transfers)
+
+    async def test_transfer_limit(self):
+        running = await self.async_client.get(self.download_url())
+        self.assertEqual(running.status_code, 200)
+        response = await self.async_client.get(self.download_url())
+        self.assertEqual(response.status_code, 429)
+        response = await self.async_client.put(
+            f'/api/servers/{self.server.id}/files/upload/?path=up.bin', b'x',
+            content_type='application/octet-stream', headers=self.headers
+        )
+        self.assertEqual(response.status_code, 429)
+
+        # Aborted after the first block, the download gives its slot back
+        blocks = running.streaming_content.__aiter__()
+        await blocks.__anext__()
+        await blocks.aclose()
+        running.close()
+        await self.wait_for_slots()
+
+        # Failed transfers give theirs back too
+        response = await self.async_client.get(self.download_url('missing.bin'))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(sftp._transfers)
+        response = await self.async_client.get(self.download_url())
+        self.assertEqual(response.status_code, 200)
+        await self.read(response)
+        await self.wait_for_slots()
@@ -0,0 +1,133 @@
+import threading
+import time
+
+import paramiko
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from be.prewarm import open_shell
+from be.ssh_io import executor
+from be.ssh_pool import SSHConnectionPool, resolve_route
+
+from .standin import StandInMixin
+
+
+class FakeTransport:
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+
+class FakeClient:
+    def __init__(self):
+        self.transport = FakeTransport()
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.transport.active = False
+
+
+class SSHConnectionPoolTests(SimpleTestCase):
+    key = (('host', 22, 'user', 'fingerprint'),)
+
+    def setUp(self):
+        self.pool = SSHConnectionPool()
+        # Keep the sweeper and prober threads out of the tests
+        self.pool._sweeper = self.pool._prober = object()
+
+    def test_reuses_connection(self):
+        client = self.pool.acquire(self.key, FakeClient)
+        self.assertIs(self.pool.acquire(self.key, FakeClient), client)
+
+    def test_dead_connection_is_replaced(self):
+        client = self.pool.acquire(self.key, FakeClient)
+        client.close()
+        self.pool.release(client)
+        self.assertIsNot(self.pool.acquire(self.key, FakeClient), client)
+        self.assertEqual(self.pool._connect_locks[self.key][1], 0)
+
+    def test_connect_lock_dropped_once_unused(self):
+        client = self.pool.acquire(self.key, FakeClient)
+        client.close()
+        self.pool.release(client)
+        self.assertNotIn(self.key, self.pool._connect_locks)
+
+    def test_one_handshake_while_last_connection_is_removed(self):
+        # A connects while B waits on the connect lock. The last pooled
+        # connection is then removed: C must still wait on the same lock
+        # instead of connecting in parallel with A.
+        old = self.pool.acquire(self.key, FakeClient)
+        old.close()
+        connecting = threading.Event()
+        proceed = threading.Event()
+        lock = threading.Lock()
+        running = []
+        overlaps = []
+
+        def connect():
+            with lock:
+                running.append(1)
+                overlaps.append(len(running))
+            connecting.set()
+            proceed.wait(5)
+            with lock:
+                running.pop()
+            return FakeClient()
+
+        threads = [threading.Thread(target=self.pool.acquire, args=(self.key, connect))]
+        threads[0].start()
+        connecting.wait(5)
+        threads.append(threading.Thread(target=self.pool.acquire, args=(self.key, connect)))
+        threads[1].start()
+        self.pool.release(old)
+        threads.append(threading.Thread(target=self.pool.acquire, args=(self.key, connect)))
+        threads[2].start()
+        proceed.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(max(overlaps), 1)
+        # B and C reuse the connection A opened
+        self.assertEqual(len(overlaps), 1)
+
+    def test_deadline_while_waiting_for_a_handshake(self):
+        connecting = threading.Event()
+        proceed = threading.Event()
+
+        def connect():
+            connecting.set()
+            proceed.wait(5)
+            return FakeClient()
+
+        thread = threading.Thread(target=self.pool.acquire, args=(self.key, connect))
+        thread.start()
+        connecting.wait(5)
+        started = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            self.pool.acquire(self.key, FakeClient, deadline=started + 0.1)
+        self.assertLess(time.monotonic() - started, 1)
+        proceed.set()
+        thread.join(5)
+        self.assertEqual(self.pool._connect_locks[self.key][1], 0)
+
+
+class StalledHostTests(StandInMixin, TestCase):
+    """
+    Terminals to a host that accepts connections and never answers give up
+    at their deadline, instead of each retrying the handshake in turn.
+    """
+    standin_options = {'stall': True}
+
+    @override_settings(SSH_CONNECT_TIMEOUT=5)
+    def test_ssh_io_threads_come_back_at_deadline(self):
+        route = resolve_route(self.server)
+        started = time.monotonic()
+        futures = [executor.submit(open_shell, route, (80, 24), None, started + 0.5) for _ in range(4)]
+        for future in futures:
+            with self.assertRaises((TimeoutError, paramiko.SSHException)):
+                future.result(5)
+        self.assertLess(time.monotonic() - started, 2)
+        # Those waiting on the first one's handshake timed out
+        self.assertGreaterEqual(sum(isinstance(future.exception(), TimeoutError) for future in futures), 3)
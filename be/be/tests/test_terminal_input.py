@@ -0,0 +1,126 @@
+import asyncio
+import time
+import uuid
+
+from django.conf import settings
+from django.test import TransactionTestCase
+
+from be import terminal_protocol as protocol
+from be.sessions import TerminalSession, get_session
+from be.ssh_io import run_ssh_io
+
+from .standin import StandInMixin
+
+
+class SlowHostInputTests(StandInMixin, TransactionTestCase):
+    """
+    Typing into a host that stops reading its input must not stall the
+    consumer: the SSH stand-in's shells never read, so the SSH window fills
+    up and the channel stops taking input.
+    """
+    standin_options = {'read_input': False}
+
+    async def test_blocked_input_keeps_event_loop_and_acks_flowing(self):
+        session_id = uuid.uuid4().hex
+        communicator = self.terminal(session_id)
+        connected, _ = await communicator.connect(30)
+        self.assertTrue(connected)
+        # The session is registered once the shell is open and prompting
+        while True:
+            opcode, payload = await self.read_frame(communicator)
+            if opcode == protocol.OP_DATA and b'$ ' in payload:
+                break
+        session = get_session(session_id)
+
+        lags = []
+
+        async def measure_lag():
+            while True:
+                start = time.monotonic()
+                await asyncio.sleep(0.005)
+                lags.append(time.monotonic() - start - 0.005)
+
+        ticker = asyncio.create_task(measure_lag())
+        try:
+            # Far more than the SSH window and socket buffers hold
+            chunk = b'x' * 65536
+            for _ in range(64):
+                await communicator.send_to(bytes_data=protocol.encode_frame(protocol.OP_DATA, chunk))
+            await asyncio.sleep(0.5)
+            self.assertIsNotNone(session.input_task, "the host should still be blocking input")
+
+            # Output acknowledgements still get through and resume the channel
+            with session.lock:
+                session.pending_bytes = settings.TERMINAL_FLOW_HIGH_WATER
+                session.paused = True
+            await communicator.send_to(bytes_data=protocol.encode_ack(settings.TERMINAL_FLOW_HIGH_WATER))
+            for _ in range(100):
+                if not session.paused:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertFalse(session.paused)
+            self.assertLess(max(lags), 0.1)
+        finally:
+            ticker.cancel()
+            await communicator.disconnect(code=1000)
+            await session.close()
+
+    async def test_input_is_written_in_order(self):
+        written = []
+
+        class Channel:
+            def send_ready(self):
+                return True
+
+            def send(self, data):
+                # Slow enough that later input queues up behind it
+                time.sleep(0.01)
+                written.append(bytes(data))
+                return len(data)
+
+        session = TerminalSession(uuid.uuid4().hex, self.server.id, flow_control=False)
+        session.loop = asyncio.get_running_loop()
+        session.channel = Channel()
+        for number in range(50):
+            session.write_input(b'%d,' % number)
+            await asyncio.sleep(0.001)
+        while session.input_task is not None:
+            await asyncio.sleep(0.01)
+        self.assertEqual(b''.join(written), b''.join(b'%d,' % number for number in range(50)))
+        # Queued input is written in a few calls rather than one per keystroke
+        self.assertLess(len(written), 50)
+
+    async def test_blocked_hosts_hold_no_ssh_io_threads(self):
+        class Channel:
+            # A host that has stopped reading: its SSH window stays full
+            ready = False
+            written = b''
+
+            def send_ready(self):
+                return self.ready
+
+            def send(self, data):
+                self.written += data
+                return len(data)
+
+        sessions = []
+        for _ in range(settings.SSH_IO_WORKERS + 1):
+            session = TerminalSession(uuid.uuid4().hex, self.server.id, flow_control=False)
+            session.loop = asyncio.get_running_loop()
+            session.channel = Channel()
+            session.write_input(b'typed')
+            sessions.append(session)
+        await asyncio.sleep(0.1)
+        # Closes, resizes and other terminals' input still get a thread
+        self.assertEqual(await run_ssh_io(lambda: 'ran', timeout=1), 'ran')
+        self.assertTrue(all(session.input_task is not None for session in sessions))
+
+        # Once the window opens, the input goes through
+        sessions[0].channel.ready = True
+        for _ in range(100):
+            if sessions[0].input_task is None:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(sessions[0].channel.written, b'typed')
+        for session in sessions[1:]:
+            session.input_task.cancel()
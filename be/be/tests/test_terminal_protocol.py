@@ -0,0 +1,39 @@
+import struct
+
+from django.test import SimpleTestCase
+
+from be import terminal_protocol as protocol
+
+
+class TerminalProtocolTests(SimpleTestCase):
+    def test_data_frames_keep_bytes_intact(self):
+        # A multi-byte character split across two frames must survive as is
+        payload = 'é'.encode()[:1]
+        opcode, decoded = protocol.decode_frame(protocol.encode_frame(protocol.OP_DATA, payload))
+        self.assertEqual(opcode, protocol.OP_DATA)
+        self.assertEqual(decoded, payload)
+
+    def test_resize_round_trip(self):
+        opcode, payload = protocol.decode_frame(protocol.encode_resize(132, 43))
+        self.assertEqual(opcode, protocol.OP_RESIZE)
+        self.assertEqual(payload, b'\x00\x84\x00\x2b')
+        self.assertEqual(protocol.decode_resize(payload), (132, 43))
+
+    def test_ack_round_trip(self):
+        opcode, payload = protocol.decode_frame(protocol.encode_ack(2 ** 32 - 1))
+        self.assertEqual(opcode, protocol.OP_ACK)
+        self.assertEqual(protocol.decode_ack(payload), 2 ** 32 - 1)
+
+    def test_control_round_trip(self):
+        message = {'type': 'status', 'message': 'Connexion établie'}
+        opcode, payload = protocol.decode_frame(protocol.encode_control(message))
+        self.assertEqual(opcode, protocol.OP_CONTROL)
+        self.assertEqual(protocol.decode_control(payload), message)
+
+    def test_malformed_frames_are_rejected(self):
+        with self.assertRaises(ValueError):
+            protocol.decode_frame(b'')
+        with self.assertRaises(struct.error):
+            protocol.decode_resize(b'\x00')
+        with self.assertRaises(struct.error):
+            protocol.decode_ack(b'\x00\x01')
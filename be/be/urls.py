@@ -26,11 +26,16 @@ from django.conf import settings
 # Added get_user_roles, update_user_roles
 from .views import (
     get_user_data, upload_ssh_key, list_ssh_keys, delete_ssh_key,
-    add_server, list_servers, delete_server,
+    add_server, list_servers, list_my_servers, delete_server,
     list_roles, create_role, delete_role, get_role, update_permissions,
     list_user_roles, add_user_to_role, remove_user_from_role,
     list_users, get_user_roles, update_user_roles, get_server,
-    connect_server # Added connect_server
+    connect_server, # Added connect_server
+    start_exec,
+    list_files, upload_file, start_download, download_file,
+    list_terminal_sessions, get_terminal_session_capture, search_terminal_session, close_terminal_session,
+    watch_terminal_session,
+    metrics_view, list_recordings, start_playback
 )
 
 urlpatterns = [
@@ -43,6 +48,7 @@ urlpatterns = [
     path('api/ssh-keys/<int:pk>/delete/', delete_ssh_key, name='delete_ssh_key'),
     path('api/servers/add/', add_server, name='add_server'),
     path('api/servers/', list_servers, name='list_servers'),
+    path('api/my-servers/', list_my_servers, name='list_my_servers'),
     path('api/servers/<int:pk>/delete/', delete_server, name='delete_server'),
     path('api/roles/', list_roles, name='list_roles'),
     path('api/roles/create/', create_role, name='create_role'),
@@ -58,5 +64,18 @@ urlpatterns = [
     path('api/users/<int:user_id>/update_roles/', update_user_roles, name='update_user_roles'),
     path('api/server/<str:site_name>/<str:server_name>/', get_server, name='get_server'),
     path('api/connect_server', connect_server, name='connect_server'), # Added connect_server URL
+    path('api/exec/', start_exec, name='start_exec'),
+    path('api/servers/<int:server_id>/files/', list_files, name='list_files'),
+    path('api/servers/<int:server_id>/files/upload/', upload_file, name='upload_file'),
+    path('api/servers/<int:server_id>/files/download/', start_download, name='start_download'),
+    path('api/files/<str:token>/', download_file, name='download_file'),
+    path('api/terminal-sessions/', list_terminal_sessions, name='list_terminal_sessions'),
+    path('api/terminal-sessions/<str:session_id>/capture/', get_terminal_session_capture, name='get_terminal_session_capture'),
+    path('api/terminal-sessions/<str:session_id>/search/', search_terminal_session, name='search_terminal_session'),
+    path('api/terminal-sessions/<str:session_id>/close/', close_terminal_session, name='close_terminal_session'),
+    path('api/terminal-sessions/<str:session_id>/watch/', watch_terminal_session, name='watch_terminal_session'),
+    path('api/recordings/', list_recordings, name='list_recordings'),
+    path('api/recordings/playback/', start_playback, name='start_playback'),
+    path('metrics', metrics_view, name='metrics'),
 
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
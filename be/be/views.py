@@ -4,10 +4,42 @@ from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import IsAdminUser
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header, http_date
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from django.utils.crypto import constant_time_compare
+from django.core import signing
+from django.db.models import Q
 from .models import SSHKey, Server, Role, UserRole
+from . import metrics
+from .pagination import InvalidCursor, etag_content_response, etag_response, keyset_page
+from .permissions import can_connect, server_inventory
+from .consumers import clamp_size
+from .fanout import EXEC_MAX_COMMAND, EXEC_SALT, select_servers
+from .playback import PLAYBACK_SALT, RecordingReader
+from .prewarm import prewarm
+from .sftp import (
+    SFTP_SALT, SFTP_TOKEN_MAX_AGE, DownloadStream, end_transfer, list_path, parse_range, request_user,
+    sftp_session, start_transfer, write_block
+)
+from .recording import recording_dir
+from .search import SEARCH_MAX_CONTEXT, SEARCH_MAX_QUERY, SEARCH_MAX_RESULTS, compile_query
+from .sessions import VIEWER_MODES, VIEWER_SALT, get_session, list_sessions, session_group
+from .ssh_io import run_ssh_io
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
 import traceback
 import uuid
+import re
+import regex
+import asyncio
+import contextlib
 import logging
+import os
+import posixpath
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -47,9 +79,16 @@ def upload_ssh_key(request):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def list_ssh_keys(request):
-    ssh_keys = SSHKey.objects.all()
-    data = [{'id': key.id, 'name': key.name, 'key': key.decrypt_key()} for key in ssh_keys]
-    return Response(data)
+    # Names only: listing keys never decrypts them
+    ssh_keys = SSHKey.objects.values('id', 'name')
+    search = request.query_params.get('search')
+    if search:
+        ssh_keys = ssh_keys.filter(name__icontains=search)
+    try:
+        results, next_cursor = keyset_page(request, ssh_keys, ('name', 'id'))
+    except InvalidCursor as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return etag_response(request, {'results': results, 'next': next_cursor})
 
 @api_view(['DELETE'])
 @permission_classes([IsAdminUser])
@@ -70,12 +109,20 @@ def add_server(request):
     server_name = request.data.get('server_name')
     user = request.data.get('user')
     host = request.data.get('host')
+    port = request.data.get('port') or 22
     ssh_key_id = request.data.get('ssh_key')
     proxy_server_id = request.data.get('proxy_server')
 
     if not site_name or not server_name or not user or not host or not ssh_key_id:
         return Response({'error': 'All fields are required.'}, status=status.HTTP_400_BAD_REQUEST)
 
+    try:
+        port = int(port)
+        if not 0 < port < 65536:
+            raise ValueError
+    except (TypeError, ValueError):
+        return Response({'error': 'Port must be a number between 1 and 65535.'}, status=status.HTTP_400_BAD_REQUEST)
+
     try:
         ssh_key = SSHKey.objects.get(pk=ssh_key_id)
         # Decrypt the SSH key
@@ -94,7 +141,7 @@ def add_server(request):
     if Server.objects.filter(site_name=site_name, server_name=server_name).exists():
         return Response({'error': f'Server name "{server_name}" already exists in site "{site_name}".'}, status=status.HTTP_400_BAD_REQUEST)
 
-    server = Server(site_name=site_name, server_name=server_name, user=user, host=host, ssh_key=ssh_key, proxy_server=proxy_server)
+    server = Server(site_name=site_name, server_name=server_name, user=user, host=host, port=port, ssh_key=ssh_key, proxy_server=proxy_server)
     server.save()
 
     logger.info(f"User {request.user.username} added server {site_name}-{server_name}")
@@ -103,9 +150,27 @@ def add_server(request):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def list_servers(request):
-    servers = Server.objects.all()
-    data = [{'id': server.id, 'site_name': server.site_name, 'server_name': server.server_name, 'user': server.user, 'host': server.host, 'ssh_key_name': server.ssh_key.name, 'proxy_server_name': f"{server.proxy_server.site_name} - {server.proxy_server.server_name}" if server.proxy_server else None} for server in servers]
-    return Response(data)
+    # One query joining the SSH key and proxy server names, no model instances
+    servers = Server.objects.values(
+        'id', 'site_name', 'server_name', 'user', 'host', 'port', 'ssh_key__name',
+        'proxy_server__site_name', 'proxy_server__server_name'
+    )
+    site_name = request.query_params.get('site_name')
+    if site_name:
+        servers = servers.filter(site_name=site_name)
+    search = request.query_params.get('search')
+    if search:
+        servers = servers.filter(Q(site_name__icontains=search) | Q(server_name__icontains=search) | Q(host__icontains=search))
+    try:
+        rows, next_cursor = keyset_page(request, servers, ('site_name', 'server_name', 'id'))
+    except InvalidCursor as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    results = [{
+        'id': row['id'], 'site_name': row['site_name'], 'server_name': row['server_name'], 'user': row['user'],
+        'host': row['host'], 'port': row['port'], 'ssh_key_name': row['ssh_key__name'],
+        'proxy_server_name': f"{row['proxy_server__site_name']} - {row['proxy_server__server_name']}" if row['proxy_server__site_name'] is not None else None
+    } for row in rows]
+    return etag_response(request, {'results': results, 'next': next_cursor})
 
 @api_view(['DELETE'])
 @permission_classes([IsAdminUser])
@@ -119,6 +184,13 @@ def delete_server(request, pk):
     server.delete()
     return Response({'message': 'Server deleted successfully.'}, status=status.HTTP_204_NO_CONTENT)
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def list_my_servers(request):
+    # The servers the caller may open, grouped by site
+    etag, content = server_inventory(request.user.id)
+    return etag_content_response(request, etag, content)
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def list_roles(request):
@@ -215,7 +287,7 @@ def delete_permission(request, pk):
 def get_server(request, site_name, server_name):
     try:
         server = Server.objects.get(site_name=site_name, server_name=server_name)
-        data = {'id': server.id, 'site_name': server.site_name, 'server_name': server.server_name, 'user': server.user, 'host': server.host, 'ssh_key_name': server.ssh_key.name}
+        data = {'id': server.id, 'site_name': server.site_name, 'server_name': server.server_name, 'user': server.user, 'host': server.host, 'port': server.port, 'ssh_key_name': server.ssh_key.name}
         return Response(data)
     except Server.DoesNotExist:
         return Response({'error': 'Server not found.'}, status=status.HTTP_404_NOT_FOUND)
@@ -261,12 +333,8 @@ def update_user_roles(request, user_id):
     # Get or create the UserRole object
     user_role, created = UserRole.objects.get_or_create(user=user)
 
-    # Clear existing roles
-    user_role.roles.clear()
-
-    # Add new roles
-    for role_id in valid_role_ids:
-        user_role.roles.add(role_id)
+    # Replace the existing roles, in one removal and one addition
+    user_role.roles.set(valid_role_ids)
 
     logger.info(f"User {request.user.username} updated roles for user {user.username} to {valid_role_ids}")
     return Response({'message': 'User roles updated successfully.'}, status=status.HTTP_200_OK)
@@ -379,7 +447,7 @@ def connect_server(request):
         return Response({'error': 'Server ID is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        server = Server.objects.get(pk=server_id)
+        server = Server.objects.select_related('ssh_key').get(pk=server_id)
         # We don't need to decrypt the key here, the consumer will do it.
         # We also don't establish the SSH connection here.
     except Server.DoesNotExist:
@@ -387,15 +455,7 @@ def connect_server(request):
 
     # Check user permissions
     user = request.user
-    user_roles = UserRole.objects.filter(user=user)
-    has_permission = False
-    for user_role in user_roles:
-        for role in user_role.roles.all():
-            if server in role.permissions.all():
-                has_permission = True
-                break
-        if has_permission:
-            break
+    has_permission = can_connect(user, server.id)
 
     # Check if a proxy server is specified
     if server.proxy_server:
@@ -420,14 +480,361 @@ def connect_server(request):
         # Log successful connection
         logger.info(f"User {user.username} requested connection to server {server.site_name}-{server.server_name}")
 
+        # Start opening the shell while the browser opens the WebSocket, at
+        # the size of the browser's terminal when given
+        if settings.TERMINAL_PREWARM_TIMEOUT:
+            size = tuple(
+                clamp_size(int(value)) if str(value).isdigit() else default
+                for value, default in ((request.data.get('cols'), 80), (request.data.get('rows'), 24))
+            )
+            try:
+                prewarm(session_id, server, user.id, size)
+            except Exception as e:
+                # The WebSocket connects the usual way and reports the error
+                logger.warning(f"Prewarming session {session_id} failed: {e!r}")
+
         # Generate WebSocket URL with the unique session ID
         websocket_url = f'{scheme}://{host}/ws/connect_server/{server_id}/{session_id}/'
 
         logger.info(f"Generated WebSocket URL: {websocket_url}")
 
-        return Response({'websocket_url': websocket_url}, status=status.HTTP_200_OK)
+        return Response({'websocket_url': websocket_url, 'session_id': session_id}, status=status.HTTP_200_OK)
 
     except Exception as e:
         # Log the full traceback for debugging
         logger.error("Error in connect_server view:", exc_info=True)
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def start_exec(request):
+    # Runs one command on the servers of a site and/or a list of server IDs
+    # the user may open; results stream over the returned WebSocket URL
+    command = request.data.get('command')
+    site_name = request.data.get('site_name') or None
+    server_ids = request.data.get('server_ids')
+    if not isinstance(command, str) or not command.strip() or len(command) > EXEC_MAX_COMMAND:
+        return Response({'error': f'A command of at most {EXEC_MAX_COMMAND} characters is required.'}, status=status.HTTP_400_BAD_REQUEST)
+    if server_ids is not None and (not isinstance(server_ids, list) or not all(isinstance(server_id, int) for server_id in server_ids)):
+        return Response({'error': 'server_ids must be a list of server IDs.'}, status=status.HTTP_400_BAD_REQUEST)
+    if not site_name and not server_ids:
+        return Response({'error': 'site_name or server_ids is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    count = select_servers(request.user.id, site_name, server_ids).count()
+    if not count:
+        return Response({'error': 'None of the selected servers may be opened.'}, status=status.HTTP_403_FORBIDDEN)
+    if count > settings.EXEC_FANOUT_MAX_HOSTS:
+        return Response({'error': f'At most {settings.EXEC_FANOUT_MAX_HOSTS} servers can be selected.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    token = signing.dumps({
+        'user_id': request.user.id,
+        'username': request.user.username,
+        'command': command,
+        'site_name': site_name,
+        'server_ids': server_ids,
+    }, salt=EXEC_SALT, compress=True)
+    scheme = 'wss' if request.is_secure() else 'ws'
+    websocket_url = f'{scheme}://{request.get_host()}/ws/exec/{token}/'
+    logger.info(f"User {request.user.username} started {command!r} on {count} servers")
+    return Response({'websocket_url': websocket_url, 'servers': count}, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def list_terminal_sessions(request):
+    # Terminal sessions of this worker process, with their output queue depth
+    data = [session.stats() for session in list_sessions()]
+    return Response(data)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def get_terminal_session_capture(request, session_id):
+    # Only sessions of this worker process, and only with TERMINAL_DEBUG_CAPTURE enabled
+    session = get_session(session_id)
+    if session is None:
+        return Response({'error': 'Session not found on this worker.'}, status=status.HTTP_404_NOT_FOUND)
+    if session.capture is None:
+        return Response({'error': 'Debug capture is disabled.'}, status=status.HTTP_404_NOT_FOUND)
+    logger.warning(f"User {request.user.username} read the debug capture of terminal session {session_id}")
+    return Response(session.captured())
+
+@require_http_methods(['GET'])
+async def search_terminal_session(request, session_id):
+    # Searches the scrollback of a session of this worker, for its owner and
+    # admins. Async, with the search on another thread and limited to
+    # TERMINAL_SEARCH_TIMEOUT seconds, so a slow pattern holds no worker
+    user = await request_user(request)
+    if user is None:
+        return JsonResponse({'error': 'Authentication required.'}, status=status.HTTP_401_UNAUTHORIZED)
+    session = get_session(session_id)
+    if session is None or (session.user_id != user.id and not user.is_staff):
+        return JsonResponse({'error': 'Session not found on this worker.'}, status=status.HTTP_404_NOT_FOUND)
+    if session.search_index is None:
+        return JsonResponse({'error': 'Scrollback search is disabled.'}, status=status.HTTP_404_NOT_FOUND)
+    query = request.GET.get('q', '')
+    if not query or len(query) > SEARCH_MAX_QUERY:
+        return JsonResponse({'error': f'q must have 1 to {SEARCH_MAX_QUERY} characters.'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        pattern, lower = compile_query(
+            query, request.GET.get('regex') in ('1', 'true'), request.GET.get('ignore_case') in ('1', 'true')
+        )
+        context = min(max(int(request.GET.get('context', 2)), 0), SEARCH_MAX_CONTEXT)
+        limit = min(max(int(request.GET.get('limit', 100)), 1), SEARCH_MAX_RESULTS)
+    except (regex.error, ValueError) as e:
+        return JsonResponse({'error': f'Invalid search: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        result = await sync_to_async(session.search_index.search, thread_sensitive=False)(
+            pattern, context, limit, lower, settings.TERMINAL_SEARCH_TIMEOUT
+        )
+    except TimeoutError:
+        logger.warning(f"User {user.username} searched session {session_id} for {query!r}, which timed out")
+        return JsonResponse(
+            {'error': f'The search took longer than {settings.TERMINAL_SEARCH_TIMEOUT:g} seconds, try a simpler pattern.'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    return JsonResponse(result)
+
+@api_view(['DELETE'])
+@permission_classes([IsAdminUser])
+def close_terminal_session(request, session_id):
+    if not re.fullmatch(r'[0-9a-fA-F-]+', session_id):
+        return Response({'error': 'Invalid session ID.'}, status=status.HTTP_400_BAD_REQUEST)
+    # Routed through the channel layer, so it reaches the session on whichever worker holds it
+    async_to_sync(get_channel_layer().group_send)(session_group(session_id), {
+        'type': 'session.close',
+        'reason': f'closed by {request.user.username}'
+    })
+    # A detached session on this worker has no consumer in the group
+    session = get_session(session_id)
+    if session is not None and session.consumer is None and session.loop is not None:
+        asyncio.run_coroutine_threadsafe(session.close(), session.loop)
+    logger.info(f"User {request.user.username} closed terminal session {session_id}")
+    return Response({'message': 'Session close requested.'}, status=status.HTTP_202_ACCEPTED)
+
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def watch_terminal_session(request, session_id):
+    # Joins a running session as a viewer; mode 'drive' may also type into it
+    mode = request.data.get('mode', 'view')
+    if not re.fullmatch(r'[0-9a-fA-F-]+', session_id) or mode not in VIEWER_MODES:
+        return Response({'error': 'Invalid session ID or mode.'}, status=status.HTTP_400_BAD_REQUEST)
+    # The session may live on another worker, the viewer finds it through the channel layer
+    token = signing.dumps({'session_id': session_id, 'mode': mode}, salt=VIEWER_SALT)
+    scheme = 'wss' if request.is_secure() else 'ws'
+    websocket_url = f'{scheme}://{request.get_host()}/ws/watch/{token}/'
+    logger.info(f"User {request.user.username} joined terminal session {session_id} ({mode})")
+    return Response({'websocket_url': websocket_url}, status=status.HTTP_200_OK)
+
+async def metrics_view(request):
+    # Plain Django view for Prometheus scrapers. The metrics tell hosts and
+    # traffic apart, so they are only served for METRICS_TOKEN or to staff.
+    if settings.METRICS_TOKEN and constant_time_compare(
+        request.headers.get('Authorization', ''), f'Bearer {settings.METRICS_TOKEN}'
+    ):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    user = await request_user(request) or await request.auser()
+    if not user.is_authenticated:
+        return HttpResponse('Unauthorized', status=401, content_type='text/plain')
+    if not (user.is_active and user.is_staff):
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def list_recordings(request):
+    # Recorded sessions below TERMINAL_RECORDING_DIR/<server_id>/<session_id>/
+    if not settings.TERMINAL_RECORDING_DIR or not os.path.isdir(settings.TERMINAL_RECORDING_DIR):
+        return Response([])
+    servers = {str(server.id): server for server in Server.objects.only('id', 'site_name', 'server_name')}
+    data = []
+    for server_id in os.listdir(settings.TERMINAL_RECORDING_DIR):
+        server_dir = os.path.join(settings.TERMINAL_RECORDING_DIR, server_id)
+        if not server_id.isdigit() or not os.path.isdir(server_dir):
+            continue
+        for session_id in os.listdir(server_dir):
+            try:
+                reader = RecordingReader(recording_dir(server_id, session_id))
+            except (OSError, ValueError):
+                continue
+            server = servers.get(server_id)
+            data.append({
+                'server_id': int(server_id),
+                'session_id': session_id,
+                'site_name': server.site_name if server else None,
+                'server_name': server.server_name if server else None,
+                'started': reader.segments[0].header.get('timestamp'),
+                'duration': reader.duration,
+                'size': sum(os.path.getsize(segment.path) for segment in reader.segments),
+            })
+    data.sort(key=lambda recording: recording['started'] or 0, reverse=True)
+    return Response(data)
+
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def start_playback(request):
+    server_id = request.data.get('server_id')
+    session_id = request.data.get('session_id')
+    if not str(server_id).isdigit() or not re.fullmatch(r'[0-9a-fA-F-]+', str(session_id)):
+        return Response({'error': 'Server ID and session ID are required.'}, status=status.HTTP_400_BAD_REQUEST)
+    if not os.path.isdir(recording_dir(server_id, session_id)):
+        return Response({'error': 'Recording not found.'}, status=status.HTTP_404_NOT_FOUND)
+    # Signed and short-lived, so any worker can check it without shared state
+    token = signing.dumps({'server_id': int(server_id), 'session_id': session_id}, salt=PLAYBACK_SALT)
+    scheme = 'wss' if request.is_secure() else 'ws'
+    websocket_url = f'{scheme}://{request.get_host()}/ws/playback/{token}/'
+    logger.info(f"User {request.user.username} started playback of session {session_id} on server {server_id}")
+    return Response({'websocket_url': websocket_url}, status=status.HTTP_200_OK)
+
+# File transfers. Listing and uploads are plain async Django views that check
+# the JWT themselves, so a long transfer never holds the thread sync views share.
+
+def sftp_error(e):
+    # JSON error response for a failed SFTP call
+    if isinstance(e, Server.DoesNotExist):
+        return JsonResponse({'error': 'Server not found.'}, status=status.HTTP_404_NOT_FOUND)
+    if isinstance(e, FileNotFoundError):
+        return JsonResponse({'error': 'No such file or directory.'}, status=status.HTTP_404_NOT_FOUND)
+    if isinstance(e, PermissionError):
+        return JsonResponse({'error': 'Permission denied on the server.'}, status=status.HTTP_403_FORBIDDEN)
+    if isinstance(e, asyncio.TimeoutError):
+        return JsonResponse({'error': 'The server timed out.'}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+    logger.error(f"SFTP error: {e}", exc_info=True)
+    return JsonResponse({'error': f'SFTP error: {e}'}, status=status.HTTP_502_BAD_GATEWAY)
+
+async def sftp_user(request, server_id):
+    # (user, None) when the request's user may open server_id, else (None, error response)
+    user = await request_user(request)
+    if user is None:
+        return None, JsonResponse({'error': 'Authentication required.'}, status=status.HTTP_401_UNAUTHORIZED)
+    if not await database_sync_to_async(can_connect)(user, server_id):
+        return None, JsonResponse({'error': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
+    return user, None
+
+@csrf_exempt
+@require_http_methods(['GET'])
+async def list_files(request, server_id):
+    # Entries of the directory ?path= (home by default), or the attributes of a file
+    user, error = await sftp_user(request, server_id)
+    if error:
+        return error
+    try:
+        async with sftp_session(server_id) as sftp:
+            data = await run_ssh_io(list_path, sftp, request.GET.get('path') or '.')
+    except Exception as e:
+        return sftp_error(e)
+    return JsonResponse(data)
+
+@csrf_exempt
+@require_http_methods(['PUT'])
+async def upload_file(request, server_id):
+    # Writes the request body to ?path=. An interrupted upload resumes with
+    # ?offset= set to the size the file got to (see list_files).
+    user, error = await sftp_user(request, server_id)
+    if error:
+        return error
+    path = request.GET.get('path')
+    offset = request.GET.get('offset', '0')
+    if not path or not offset.isdigit():
+        return JsonResponse({'error': 'path and a numeric offset are required.'}, status=status.HTTP_400_BAD_REQUEST)
+    offset = int(offset)
+    if not start_transfer(user.id):
+        return JsonResponse({'error': 'Too many transfers running.'}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    try:
+        async with sftp_session(server_id) as sftp:
+            if offset:
+                size = (await run_ssh_io(sftp.stat, path)).st_size
+                if size != offset:
+                    return JsonResponse({'error': f'The file has {size} bytes, resume from there.', 'size': size}, status=status.HTTP_409_CONFLICT)
+            remote = await run_ssh_io(sftp.open, path, 'r+b' if offset else 'wb')
+            try:
+                # Writes go out without waiting for each acknowledgement
+                remote.set_pipelined(True)
+                remote.seek(offset)
+                while written := await run_ssh_io(write_block, request, remote):
+                    offset += written
+                    metrics.sftp_bytes.inc(written, direction='up')
+            finally:
+                await run_ssh_io(remote.close)
+            # Pipelined writes report no errors of their own
+            size = (await run_ssh_io(sftp.stat, path)).st_size
+            if size != offset:
+                raise OSError(f"{path} has {size} bytes after the upload instead of {offset}.")
+    except Exception as e:
+        return sftp_error(e)
+    finally:
+        end_transfer(user.id)
+    logger.info(f"User {user.username} uploaded {path} ({offset} bytes) to server {server_id}")
+    return JsonResponse({'path': path, 'size': offset})
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def start_download(request, server_id):
+    # Download links can be opened by the browser itself, which streams the
+    # file to disk, and by download managers resuming with Range requests
+    path = request.data.get('path')
+    if not isinstance(path, str) or not path:
+        return Response({'error': 'path is required.'}, status=status.HTTP_400_BAD_REQUEST)
+    if not can_connect(request.user, server_id):
+        return Response({'error': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
+    token = signing.dumps({'user_id': request.user.id, 'server_id': server_id, 'path': path}, salt=SFTP_SALT)
+    scheme = 'https' if request.is_secure() else 'http'
+    return Response({'url': f'{scheme}://{request.get_host()}/api/files/{token}/'}, status=status.HTTP_200_OK)
+
+@require_http_methods(['GET', 'HEAD'])
+async def download_file(request, token):
+    try:
+        target = signing.loads(token, salt=SFTP_SALT, max_age=SFTP_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return JsonResponse({'error': 'Invalid or expired download link.'}, status=status.HTTP_403_FORBIDDEN)
+    # Checked again, permissions may have changed since the link was made
+    user = await User.objects.filter(pk=target['user_id']).afirst()
+    if user is None or not await database_sync_to_async(can_connect)(user, target['server_id']):
+        return JsonResponse({'error': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
+    if not start_transfer(user.id):
+        return JsonResponse({'error': 'Too many transfers running.'}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+
+    path = target['path']
+    # Holds what the download needs closed, in reverse order
+    stack = contextlib.AsyncExitStack()
+    stack.callback(end_transfer, user.id)
+    try:
+        sftp = await stack.enter_async_context(sftp_session(target['server_id']))
+        remote = await run_ssh_io(sftp.open, path, 'rb')
+        stack.push_async_callback(run_ssh_io, remote.close)
+        attrs = await run_ssh_io(remote.stat)
+    except asyncio.CancelledError:
+        await stack.aclose()
+        raise
+    except Exception as e:
+        await stack.aclose()
+        return sftp_error(e)
+
+    size = attrs.st_size
+    last_modified = http_date(attrs.st_mtime)
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Last-Modified': last_modified,
+        'Content-Disposition': content_disposition_header(True, posixpath.basename(path)),
+    }
+    range_header = request.headers.get('Range')
+    if request.headers.get('If-Range', last_modified) != last_modified:
+        # The file changed since the client got the first part
+        range_header = None
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        await stack.aclose()
+        return HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers={'Content-Range': f'bytes */{size}'})
+    start, end = byte_range or (0, size)
+    headers['Content-Length'] = str(end - start)
+    if byte_range:
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+    status_code = status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK
+    if request.method == 'HEAD':
+        await stack.aclose()
+        return HttpResponse(status=status_code, headers=headers, content_type='application/octet-stream')
+
+    logger.info(f"User {user.username} downloading {path} (bytes {start}-{end}) from server {target['server_id']}")
+    return StreamingHttpResponse(
+        DownloadStream(stack, remote, start, end),
+        status=status_code, headers=headers, content_type='application/octet-stream'
+    )
@@ -0,0 +1,37 @@
+"""
+Authenticates WebSocket connections with the same JWT access tokens as the
+REST API. Browsers can't set headers on WebSocket requests, so the token is
+passed as the token query parameter.
+"""
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+
+@database_sync_to_async
+def _user_from_token(raw_token):
+    authentication = JWTAuthentication()
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except AuthenticationFailed:
+        return None
+
+
+class JWTAuthMiddleware:
+    """
+    Sets scope['user'] to the user of a valid ?token=<access token>, and
+    leaves whatever an outer middleware put there otherwise.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        token = parse_qs(scope.get('query_string', b'').decode()).get('token', [None])[0]
+        if token:
+            user = await _user_from_token(token)
+            if user is not None:
+                scope = dict(scope, user=user)
+        return await self.app(scope, receive, send)
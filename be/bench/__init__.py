@@ -0,0 +1,4 @@
+"""
+Benchmarks of the terminal path. Run them from the be directory, e.g.
+`uv run python -m bench.pump`; see bench/README.md.
+"""
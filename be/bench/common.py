@@ -0,0 +1,153 @@
+"""
+Shared setup of the benchmarks: Django on a throwaway database, servers
+pointing at an SSH stand-in, and WebSocket terminals driven in process.
+"""
+import asyncio
+import contextlib
+import io
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bench.settings')
+django.setup()
+
+import paramiko  # noqa: E402
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.contrib.auth.models import User  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from rest_framework_simplejwt.tokens import AccessToken  # noqa: E402
+
+from be import routing  # noqa: E402
+from be import terminal_protocol as protocol  # noqa: E402
+from be.models import Server, SSHKey, UserServerAccess  # noqa: E402
+from be.ws_auth import JWTAuthMiddleware  # noqa: E402
+
+from .sshd import FLOOD_LINE  # noqa: E402,F401
+
+call_command('migrate', verbosity=0)
+
+# Connect and disconnect messages would drown the results
+logging.disable(logging.INFO)
+
+application = JWTAuthMiddleware(URLRouter(routing.websocket_urlpatterns))
+
+
+def make_key():
+    pkey = paramiko.RSAKey.generate(2048)
+    buffer = io.StringIO()
+    pkey.write_private_key(buffer)
+    return SSHKey.objects.create(name='bench', key_content=buffer.getvalue())
+
+
+def make_servers(port, count=1, key=None, site_name='bench'):
+    """
+    Creates count servers on the stand-in at port. Each logs in as another
+    user, so they don't share pooled connections.
+    """
+    key = key or make_key()
+    return [
+        Server.objects.create(
+            site_name=site_name, server_name=f'host{number}', host='127.0.0.1', port=port,
+            user=f'user{number}', ssh_key=key,
+        )
+        for number in range(count)
+    ]
+
+
+def make_user(servers, username='bench'):
+    """
+    Returns (user, access token) of a user allowed to open servers.
+    """
+    user, _ = User.objects.get_or_create(username=username)
+    UserServerAccess.objects.bulk_create(
+        [UserServerAccess(user=user, server=server) for server in servers], ignore_conflicts=True
+    )
+    return user, str(AccessToken.for_user(user))
+
+
+@contextlib.contextmanager
+def sshd(*args):
+    """
+    Runs bench.sshd in its own process and yields its port.
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'bench.sshd', '--port', '0', *args], stdout=subprocess.PIPE, text=True
+    )
+    try:
+        yield int(process.stdout.readline().rsplit(':', 1)[1])
+    finally:
+        process.kill()
+        process.wait()
+
+
+class Terminal:
+    """
+    A binary protocol terminal WebSocket, acknowledging output like the
+    browser does.
+    """
+
+    def __init__(self, server, token, session_id, query=''):
+        self.communicator = WebsocketCommunicator(
+            application, f'/ws/connect_server/{server.id}/{session_id}/?token={token}{query}',
+            subprotocols=[protocol.SUBPROTOCOL],
+        )
+        self.output = bytearray()
+        self.frames = 0
+        self.controls = []
+        self.closed = False
+
+    async def open(self, timeout=30):
+        await self.communicator.connect(timeout)
+        await self.read_until(lambda: b'$ ' in self.output, timeout)
+        return self
+
+    async def send(self, data):
+        await self.communicator.send_to(bytes_data=protocol.encode_frame(protocol.OP_DATA, data))
+
+    async def read_until(self, done, timeout=30):
+        """
+        Reads frames until done() is true. Returns False on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while not done():
+            if self.closed:
+                return False
+            # receive_output() would cancel the application on timeout
+            try:
+                message = await asyncio.wait_for(
+                    self.communicator.output_queue.get(), max(0, deadline - time.monotonic())
+                )
+            except asyncio.TimeoutError:
+                return False
+            if message['type'] == 'websocket.close':
+                self.closed = True
+                continue
+            frame = message['bytes']
+            if frame[0] == protocol.OP_DATA:
+                self.output += frame[1:]
+                self.frames += 1
+                await self.communicator.send_to(bytes_data=protocol.encode_ack(len(frame) - 1))
+            elif frame[0] == protocol.OP_CONTROL:
+                self.controls.append(protocol.decode_control(frame[1:]))
+        return True
+
+    async def close(self):
+        await self.communicator.disconnect(code=1000)
+        # Let the session close its channel
+        await asyncio.sleep(0.05)
+
+
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
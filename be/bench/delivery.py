@@ -0,0 +1,132 @@
+"""
+Handing SSH output from the pump thread to the consumer's event loop.
+
+Compares the direct path, call_soon_threadsafe() of the consumer's own
+queue_output(), with what it replaced: sending every chunk with
+run_coroutine_threadsafe() as a message through the in-memory channel
+layer to the consumer's own channel, from where a receive loop dispatches
+it to a handler, like Channels does for ssh_output.
+
+Measures the cost per chunk when the thread sends as fast as the consumer
+keeps up, in batches of BATCH chunks, and the latency of a single chunk
+from the thread to its handler.
+
+    uv run python -m bench.delivery [--chunks 20000]
+"""
+import argparse
+import asyncio
+import threading
+import time
+
+from channels.layers import InMemoryChannelLayer
+
+from . import common
+
+CHUNK = b'y' * 4096
+BATCH = 50
+LATENCY_SAMPLES = 1000
+
+
+class Direct:
+    """
+    The consumer's queue_output(), scheduled with call_soon_threadsafe().
+    """
+
+    async def start(self, handler):
+        self.loop = asyncio.get_running_loop()
+        self.handler = handler
+
+    def send(self, data):
+        self.loop.call_soon_threadsafe(self.handler, data)
+
+    async def stop(self):
+        pass
+
+
+class Layer:
+    """
+    A channel layer message to the consumer's own channel.
+    """
+
+    async def start(self, handler):
+        self.loop = asyncio.get_running_loop()
+        self.layer = InMemoryChannelLayer(capacity=BATCH * 2)
+        self.channel_name = await self.layer.new_channel()
+
+        async def dispatch():
+            while True:
+                message = await self.layer.receive(self.channel_name)
+                handler(message['data'])
+
+        self.task = asyncio.create_task(dispatch())
+
+    def send(self, data):
+        asyncio.run_coroutine_threadsafe(
+            self.layer.send(self.channel_name, {'type': 'ssh_output', 'data': data}), self.loop
+        )
+
+    async def stop(self):
+        self.task.cancel()
+
+
+async def measure(path, chunks):
+    """
+    Returns (wall seconds per chunk, CPU seconds per chunk, latencies).
+    """
+    received = threading.Semaphore(0)
+    stamps = []
+
+    def handler(data):
+        stamps.append(time.perf_counter())
+        received.release()
+
+    await path.start(handler)
+
+    def flood():
+        for _ in range(chunks // BATCH):
+            for _ in range(BATCH):
+                path.send(CHUNK)
+            for _ in range(BATCH):
+                received.acquire()
+
+    cpu = common.cpu_seconds()
+    began = time.perf_counter()
+    await asyncio.to_thread(flood)
+    elapsed = time.perf_counter() - began
+    cpu = common.cpu_seconds() - cpu
+
+    def sample():
+        latencies = []
+        for _ in range(LATENCY_SAMPLES):
+            stamps.clear()
+            sent = time.perf_counter()
+            path.send(CHUNK)
+            received.acquire()
+            latencies.append(stamps[0] - sent)
+            time.sleep(0.0005)
+        return latencies
+
+    latencies = await asyncio.to_thread(sample)
+    await path.stop()
+    return elapsed / chunks, cpu / chunks, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--chunks', type=int, default=20000)
+    options = parser.parse_args()
+    print(f"{'path':<20} {'wall/chunk':>10} {'CPU/chunk':>10} {'latency p50':>12} {'latency p99':>12}")
+    for name, path in (
+        ('channel layer', Layer()),
+        ('call_soon_threadsafe', Direct()),
+    ):
+        per_chunk, cpu, latencies = asyncio.run(measure(path, options.chunks))
+        print(
+            f"{name:<20} {per_chunk * 1e6:>8.1f}us {cpu * 1e6:>8.1f}us "
+            f"{common.percentile(latencies, 0.5) * 1e6:>10.1f}us {common.percentile(latencies, 0.99) * 1e6:>10.1f}us",
+            flush=True,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Running one command on many servers at once through ExecConsumer.
+
+The stand-in answers every exec request after a random delay between
+--delay MIN and MAX seconds. Each run starts the command on --hosts
+servers (each logging in as another user, so none share a connection)
+with EXEC_FANOUT_CONCURRENCY threads, first with no pooled connections
+(every host pays for its handshake), then again on the connections the
+first run left in the pool. Reports how long the run took against the
+slowest host's delay, and the results.
+
+    uv run python -m bench.fanout [--hosts 500] [--concurrency 128 500] [--delay 0.1 1.0]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.testing import WebsocketCommunicator
+from django.core import signing
+from django.test.utils import override_settings
+
+from . import common
+from be import fanout
+from be.ssh_pool import ssh_pool
+
+
+async def run_command(user, command):
+    """
+    Returns (seconds, results counted by outcome, per host seconds).
+    """
+    token = signing.dumps({
+        'user_id': user.id,
+        'username': user.username,
+        'command': command,
+        'site_name': 'bench',
+        'server_ids': None,
+    }, salt=fanout.EXEC_SALT, compress=True)
+    communicator = WebsocketCommunicator(common.application, f'/ws/exec/{token}/')
+    started = time.perf_counter()
+    await communicator.connect()
+    hosts = []
+    while True:
+        # receive_from() would cancel the application on timeout
+        message = await asyncio.wait_for(communicator.output_queue.get(), 300)
+        if message['type'] == 'websocket.close':
+            raise RuntimeError("The run closed before finishing.")
+        message = json.loads(message['text'])
+        if message['type'] == 'exec_result':
+            hosts.append(message['seconds'])
+        elif message['type'] == 'exec_finished':
+            seconds = time.perf_counter() - started
+            await communicator.disconnect()
+            return seconds, collections.Counter(message['results']), hosts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--hosts', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[128, 500])
+    parser.add_argument('--delay', type=float, nargs=2, default=(0.1, 1.0), metavar=('MIN', 'MAX'))
+    options = parser.parse_args()
+    print(f"{options.hosts} hosts, exec delay {options.delay[0]}-{options.delay[1]} s")
+    print(f"{'threads':>7} {'pool':<5} {'run':>8} {'host p50':>9} {'host max':>9} {'results':<20}")
+    with common.sshd('--exec-delay', *map(str, options.delay)) as port:
+        servers = common.make_servers(port, options.hosts)
+        user, _ = common.make_user(servers)
+        for concurrency in options.concurrency:
+            fanout.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='ssh-exec')
+            for pool in ('cold', 'warm'):
+                seconds, results, hosts = asyncio.run(run_command(user, 'uptime'))
+                print(
+                    f"{concurrency:>7} {pool:<5} {seconds:>7.2f}s {common.percentile(hosts, 0.5):>8.2f}s "
+                    f"{max(hosts):>8.2f}s {dict(results)}",
+                    flush=True,
+                )
+            fanout.executor.shutdown()
+            # The next concurrency starts cold again
+            with override_settings(SSH_POOL_IDLE_TIMEOUT=0):
+                ssh_pool.evict_idle()
+
+
+if __name__ == '__main__':
+    main()
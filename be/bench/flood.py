@@ -0,0 +1,94 @@
+"""
+Throughput and echo latency of the SSH -> WebSocket path, through
+SSHConsumer and a binary protocol client that acknowledges output like the
+browser.
+
+A shell on the SSH stand-in prints --lines lines of 1000 bytes as fast as it
+can: with output coalescing (the TERMINAL_OUTPUT_FLUSH_* settings), with
+every chunk read from SSH sent as its own frame, and with 1 KB reads sent as
+one frame each, as before coalescing. Echo latency is
+measured on an idle shell typed into at 50 keys per second, keystroke to
+echoed frame.
+
+    uv run python -m bench.flood [--lines 50000]
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from django.conf import settings
+from django.test.utils import override_settings
+
+from . import common
+from be import ssh_pump
+
+ECHO_SAMPLES = 200
+# Pause between keystrokes, a fast typist's 50 keys per second
+KEYSTROKE_INTERVAL = 0.02
+
+
+async def flood(server, token, lines):
+    """
+    Returns (seconds, bytes, frames) of printing lines lines of output.
+    """
+    terminal = await common.Terminal(server, token, uuid.uuid4()).open()
+    expected = len(terminal.output) + lines * len(common.FLOOD_LINE)
+    frames = terminal.frames
+    start = time.perf_counter()
+    await terminal.send(f'flood {lines}'.encode())
+    if not await terminal.read_until(lambda: len(terminal.output) >= expected, 300):
+        raise RuntimeError("The flood didn't arrive in full.")
+    seconds = time.perf_counter() - start
+    await terminal.close()
+    return seconds, expected, terminal.frames - frames
+
+
+async def echo_latency(server, token, samples=ECHO_SAMPLES):
+    terminal = await common.Terminal(server, token, uuid.uuid4()).open()
+    latencies = []
+    for _ in range(samples):
+        expected = len(terminal.output) + 1
+        start = time.perf_counter()
+        await terminal.send(b'x')
+        await terminal.read_until(lambda: len(terminal.output) >= expected, 10)
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(KEYSTROKE_INTERVAL)
+    await terminal.close()
+    return latencies
+
+
+def report(name, seconds, size, frames, latencies):
+    print(
+        f"{name:<14} {size / seconds / 1e6:>8.1f} MB/s {frames:>8} frames {size / frames / 1024:>8.1f} KB/frame "
+        f"echo p50 {common.percentile(latencies, 0.5) * 1000:.2f} ms p99 {common.percentile(latencies, 0.99) * 1000:.2f} ms",
+        flush=True,
+    )
+
+
+async def run(server, token, lines):
+    report('coalesced', *await flood(server, token, lines), await echo_latency(server, token))
+    with override_settings(TERMINAL_OUTPUT_FLUSH_INTERVAL=0, TERMINAL_OUTPUT_FLUSH_BYTES=1):
+        report('per chunk', *await flood(server, token, lines), await echo_latency(server, token))
+        # What the terminal did before: 1 KB reads, one frame each
+        read_size, drain_size = ssh_pump.READ_SIZE, ssh_pump.MAX_DRAIN_SIZE
+        ssh_pump.READ_SIZE = ssh_pump.MAX_DRAIN_SIZE = 1024
+        try:
+            report('1 KB chunks', *await flood(server, token, lines), await echo_latency(server, token))
+        finally:
+            ssh_pump.READ_SIZE, ssh_pump.MAX_DRAIN_SIZE = read_size, drain_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lines', type=int, default=50000)
+    options = parser.parse_args()
+    print(f"Flush window {settings.TERMINAL_OUTPUT_FLUSH_INTERVAL * 1000:g} ms / {settings.TERMINAL_OUTPUT_FLUSH_BYTES // 1024} KB")
+    with common.sshd() as port:
+        servers = common.make_servers(port)
+        _, token = common.make_user(servers)
+        asyncio.run(run(servers[0], token, options.lines))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Log volume and CPU of the terminal path during an output flood.
+
+Runs the flood of bench.flood three times, with the terminal loggers
+(be.consumers, be.sessions) writing to a sink that counts what it is given:
+
+- payloads: every chunk typed, read from SSH and sent to the browser logged
+  with its content at INFO, as the terminal path did before
+- INFO: the default TERMINAL_LOG_LEVEL
+- DEBUG: TERMINAL_LOG_LEVEL=DEBUG, each session logging a sample of its
+  traffic once per TERMINAL_LOG_SAMPLE_INTERVAL
+
+    uv run python -m bench.log_volume [--lines 100000]
+"""
+import argparse
+import asyncio
+import contextlib
+import logging
+
+from . import common
+from .flood import flood
+from be.sessions import TerminalSession
+
+LOGGERS = ('be.consumers', 'be.sessions')
+
+
+class Sink:
+    def __init__(self):
+        self.bytes = 0
+        self.lines = 0
+
+    def write(self, text):
+        self.bytes += len(text.encode())
+        self.lines += text.count('\n')
+
+    def flush(self):
+        pass
+
+
+@contextlib.contextmanager
+def logging_to(sink, level):
+    handler = logging.StreamHandler(sink)
+    handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] [%(name)s] %(message)s'))
+    saved = []
+    for name in LOGGERS:
+        logger = logging.getLogger(name)
+        saved.append((logger, logger.handlers, logger.level))
+        logger.handlers = [handler]
+        logger.setLevel(level)
+    logging.disable(logging.NOTSET)
+    try:
+        yield
+    finally:
+        logging.disable(logging.INFO)
+        for logger, handlers, level in saved:
+            logger.handlers = handlers
+            logger.setLevel(level)
+
+
+@contextlib.contextmanager
+def payload_logging():
+    """
+    Logs every chunk with its content, as the terminal path used to.
+    """
+    logger = logging.getLogger('be.consumers')
+    on_channel_data, record_input, record_output = (
+        TerminalSession.on_channel_data, TerminalSession.record_input, TerminalSession.record_output
+    )
+
+    def logged(method, message):
+        def wrapper(self, data):
+            logger.info(f"SSHConsumer: {message}: {data.decode(errors='replace')}")
+            return method(self, data)
+        return wrapper
+
+    TerminalSession.on_channel_data = logged(on_channel_data, "Received data from SSH channel")
+    TerminalSession.record_input = logged(record_input, "Received message")
+    TerminalSession.record_output = logged(record_output, "Sending output to WebSocket")
+    try:
+        yield
+    finally:
+        TerminalSession.on_channel_data, TerminalSession.record_input, TerminalSession.record_output = (
+            on_channel_data, record_input, record_output
+        )
+
+
+async def run(server, token, lines):
+    size = lines * len(common.FLOOD_LINE)
+    print(f"Flood of {size / 1e6:.0f} MB")
+    print(f"{'logging':<10} {'throughput':>10} {'CPU':>8} {'log lines':>10} {'log bytes':>12}")
+    for name, level, patch in (
+        ('payloads', logging.INFO, payload_logging),
+        ('INFO', logging.INFO, contextlib.nullcontext),
+        ('DEBUG', logging.DEBUG, contextlib.nullcontext),
+    ):
+        sink = Sink()
+        with patch(), logging_to(sink, level):
+            cpu = common.cpu_seconds()
+            seconds, size, _ = await flood(server, token, lines)
+            cpu = common.cpu_seconds() - cpu
+        print(
+            f"{name:<10} {size / seconds / 1e6:>5.1f} MB/s {cpu:>7.2f}s {sink.lines:>10} {sink.bytes:>12}",
+            flush=True,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lines', type=int, default=100000)
+    options = parser.parse_args()
+    with common.sshd() as port:
+        servers = common.make_servers(port)
+        _, token = common.make_user(servers)
+        asyncio.run(run(servers[0], token, options.lines))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Reading SSH output: the shared channel pump against the thread per terminal
+polling recv_ready() every 10 ms that it replaced.
+
+For 1, 100 and 1000 open shells on the SSH stand-in, measures the CPU the
+process burns while every shell is idle, and the echo latency of a
+keystroke: from sending a byte to the reader handing it on.
+
+    uv run python -m bench.pump [--sessions 1 100 1000]
+"""
+import argparse
+import threading
+import time
+
+import paramiko
+
+from . import common
+from be.ssh_pump import ChannelPump
+
+# Shells per SSH connection, as with the connection pool
+SHELLS_PER_CONNECTION = 100
+IDLE_SECONDS = 5
+ECHO_SAMPLES = 100
+
+
+class PollingReader:
+    """
+    The old read path: one thread per channel, polling every 10 ms.
+    """
+
+    def __init__(self):
+        self.stopped = False
+
+    def register(self, channel, on_data):
+        def read():
+            while not self.stopped and not channel.closed:
+                if channel.recv_ready():
+                    on_data(channel.recv(1024))
+                else:
+                    time.sleep(0.01)
+
+        threading.Thread(target=read, daemon=True).start()
+
+    def stop(self):
+        self.stopped = True
+
+
+class PumpReader:
+    def __init__(self):
+        self.pump = ChannelPump()
+
+    def register(self, channel, on_data):
+        self.pump.register(channel, on_data, lambda: None)
+
+    def stop(self):
+        for key in list(self.pump._selector.get_map().values()):
+            if key.data is not None:
+                self.pump.unregister(key.data[0]).result()
+
+
+def open_shells(port, count):
+    server, = common.make_servers(port)
+    pkey = server.ssh_key.load_pkey()
+    clients = []
+    channels = []
+    for number in range(count):
+        if number % SHELLS_PER_CONNECTION == 0:
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect('127.0.0.1', port=port, username='bench', pkey=pkey)
+            clients.append(client)
+        channel = clients[-1].invoke_shell()
+        while not channel.recv_ready():
+            time.sleep(0.001)
+        channel.recv(1024)
+        channels.append(channel)
+    return clients, channels
+
+
+def measure(reader, channels):
+    received = {}
+
+    for channel in channels:
+        event = threading.Event()
+        received[channel] = event
+        reader.register(channel, lambda data, event=event: event.set())
+
+    time.sleep(1)
+    start = common.cpu_seconds()
+    time.sleep(IDLE_SECONDS)
+    idle_cpu = (common.cpu_seconds() - start) / IDLE_SECONDS
+
+    latencies = []
+    for number in range(ECHO_SAMPLES):
+        channel = channels[number * len(channels) // ECHO_SAMPLES]
+        event = received[channel]
+        event.clear()
+        sent = time.perf_counter()
+        channel.sendall(b'x')
+        event.wait(5)
+        latencies.append(time.perf_counter() - sent)
+        # Let the timing of the next sample land anywhere in a polling period
+        time.sleep(0.0037)
+    reader.stop()
+    return idle_cpu, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 100, 1000])
+    options = parser.parse_args()
+    print(f"{'sessions':>8} {'reader':>8} {'idle CPU':>9} {'echo p50':>9} {'echo p99':>9}")
+    with common.sshd() as port:
+        for count in options.sessions:
+            for name, reader_class in (('polling', PollingReader), ('pump', PumpReader)):
+                clients, channels = open_shells(port, count)
+                idle_cpu, latencies = measure(reader_class(), channels)
+                print(
+                    f"{count:>8} {name:>8} {idle_cpu * 100:>8.1f}% "
+                    f"{common.percentile(latencies, 0.5) * 1000:>7.2f}ms {common.percentile(latencies, 0.99) * 1000:>7.2f}ms",
+                    flush=True,
+                )
+                for client in clients:
+                    client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Overhead of recording terminal sessions during an output flood.
+
+Runs the flood of bench.flood without recording, recording to plain
+asciicast segments and recording to gzip segments. Reports throughput, the
+CPU the process used (the recording writer thread included), how long the
+writer took after the flood to catch up, and the size of the recording.
+
+    uv run python -m bench.recording [--lines 50000]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from django.test.utils import override_settings
+
+from . import common
+from .flood import flood
+from be import recording
+
+
+def directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(directory, name))
+        for directory, _, names in os.walk(path)
+        for name in names
+    )
+
+
+async def run(server, token, lines):
+    print(f"Flood of {lines * len(common.FLOOD_LINE) / 1e6:.0f} MB")
+    print(f"{'recording':<10} {'throughput':>10} {'CPU':>8} {'catch-up':>9} {'recorded':>10}")
+    for name, compress in (('off', None), ('plain', ''), ('gzip', 'gzip')):
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            TERMINAL_RECORDING_DIR=directory if compress is not None else '', TERMINAL_RECORDING_COMPRESS=compress or '',
+        ):
+            cpu = common.cpu_seconds()
+            seconds, size, _ = await flood(server, token, lines)
+            ended = time.perf_counter()
+            # The writer thread still has the end of the flood queued
+            while not recording.writer._queue.empty():
+                await asyncio.sleep(0.01)
+            catch_up = time.perf_counter() - ended
+            cpu = common.cpu_seconds() - cpu
+            print(
+                f"{name:<10} {size / seconds / 1e6:>5.1f} MB/s {cpu:>7.2f}s {catch_up:>8.2f}s "
+                f"{directory_size(directory) / 1e6:>7.1f} MB",
+                flush=True,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lines', type=int, default=50000)
+    options = parser.parse_args()
+    with common.sshd() as port:
+        servers = common.make_servers(port)
+        _, token = common.make_user(servers)
+        asyncio.run(run(servers[0], token, options.lines))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Terminals served by 1, 2 and 4 ASGI worker processes.
+
+Starts each worker as its own uvicorn process on its own port and spreads
+the terminals over them round-robin, as a load balancer would. Every
+terminal types a key as soon as the previous one is echoed, for a fixed
+time. Reports the keystrokes echoed per second over all workers, the echo
+latency, the CPU used by the workers and the echoes per worker CPU second.
+
+Whether the echoes per second grow with the worker count depends on the
+cores left for the workers next to the SSH stand-in and this load
+generator; with fewer cores than processes, only the echoes per CPU second
+compare. Workers use their own in-memory channel layer here, as each
+terminal stays on one worker.
+
+    uv run python -m bench.scaling [--workers 1 2 4] [--terminals 50] [--seconds 10]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import websockets
+
+from . import common
+from be import terminal_protocol as protocol
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_workers(count):
+    """
+    Starts count uvicorn workers. Returns [(process, port)] once they listen.
+    """
+    workers = []
+    for _ in range(count):
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'be.asgi:application', '--port', str(port), '--log-level', 'warning'],
+            env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'bench.settings', 'TERMINAL_LOG_LEVEL': 'WARNING'},
+        )
+        workers.append((process, port))
+    for process, port in workers:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+    return workers
+
+
+def process_cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def terminal(port, server, token, seconds, latencies, ready, start):
+    url = f'ws://127.0.0.1:{port}/ws/connect_server/{server.id}/{uuid.uuid4().hex}/?token={token}'
+    async with websockets.connect(url, subprotocols=[protocol.SUBPROTOCOL], max_size=None) as websocket:
+        async def read_until(marker):
+            output = b''
+            while marker not in output:
+                frame = await websocket.recv()
+                if frame[0] == protocol.OP_DATA:
+                    output += frame[1:]
+                    await websocket.send(protocol.encode_ack(len(frame) - 1))
+
+        await read_until(b'$ ')
+        ready.release()
+        await start.wait()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            sent = time.perf_counter()
+            await websocket.send(protocol.encode_frame(protocol.OP_DATA, b'x'))
+            await read_until(b'x')
+            latencies.append(time.perf_counter() - sent)
+
+
+async def drive(workers, server, token, terminals, seconds):
+    """
+    Returns the echo latencies, and the seconds and worker CPU seconds the
+    typing took.
+    """
+    ports = [port for _, port in workers]
+    latencies = []
+    ready = asyncio.Semaphore(0)
+    start = asyncio.Event()
+    tasks = [
+        asyncio.create_task(terminal(ports[number % len(ports)], server, token, seconds, latencies, ready, start))
+        for number in range(terminals)
+    ]
+    for _ in range(terminals):
+        await ready.acquire()
+    cpu = sum(process_cpu_seconds(process.pid) for process, _ in workers)
+    began = time.monotonic()
+    start.set()
+    await asyncio.gather(*tasks)
+    cpu = sum(process_cpu_seconds(process.pid) for process, _ in workers) - cpu
+    return latencies, time.monotonic() - began, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--terminals', type=int, default=50, help="Terminals per worker.")
+    parser.add_argument('--seconds', type=float, default=10)
+    options = parser.parse_args()
+    print(f"{os.cpu_count()} CPU(s)")
+    print(f"{'workers':>7} {'terminals':>9} {'echoes/s':>9} {'echo p50':>9} {'echo p99':>9} {'worker CPU':>10} {'echoes/CPU s':>12}")
+    with common.sshd() as port:
+        server, = common.make_servers(port)
+        _, token = common.make_user([server])
+        for count in options.workers:
+            workers = start_workers(count)
+            try:
+                latencies, elapsed, cpu = asyncio.run(
+                    drive(workers, server, token, options.terminals * count, options.seconds)
+                )
+            finally:
+                for process, _ in workers:
+                    process.terminate()
+                    process.wait()
+            print(
+                f"{count:>7} {options.terminals * count:>9} {len(latencies) / elapsed:>9.0f} "
+                f"{common.percentile(latencies, 0.5) * 1000:>7.2f}ms {common.percentile(latencies, 0.99) * 1000:>7.2f}ms "
+                f"{cpu / elapsed * 100:>9.0f}% {len(latencies) / cpu:>12.0f}",
+                flush=True,
+            )
+
+
+if __name__ == '__main__':
+    main()
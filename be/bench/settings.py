@@ -0,0 +1,18 @@
+"""
+Settings of the benchmarks: the app's own, on a throwaway database. Worker
+processes started by a benchmark share its database through WEBSSH_BENCH_DB.
+"""
+import os
+import tempfile
+
+from be.settings import *  # noqa: F401,F403
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.setdefault(
+            'WEBSSH_BENCH_DB', path.join(tempfile.mkdtemp(prefix='webssh-bench-'), 'db.sqlite3')  # noqa: F405
+        ),
+    }
+}
+ALLOWED_HOSTS = ['*']
@@ -0,0 +1,246 @@
+"""
+Local SSH server standing in for real hosts in benchmarks and tests.
+
+Accepts any public key. Shells print a "$ " prompt and echo what they
+receive, except for a few commands sent as one chunk:
+
+- "flood <n>": prints n lines of 1000 bytes
+- "exit": closes the shell
+
+Exec requests sleep for the configured delay (fixed, or uniform between two
+bounds), print "out:<command>" and exit with status 0. With read_input off,
+shells never read their input, so a client writing to them eventually
+blocks once the SSH window is full: a deliberately slow host. With stall
+on, connections are accepted and never answered, like a host that hangs
+before the handshake. With answer_keepalives off, a connection stops
+answering anything at its first keepalive@openssh.com request, like a host
+that vanished without closing its connections.
+
+direct-tcpip channels are forwarded, so a stand-in can be a proxy server
+(jump host) for another.
+
+With an sftp_root directory, the SFTP subsystem serves the files below it,
+"/" being sftp_root and relative paths starting there too.
+
+Run it on its own with `python -m bench.sshd --port 2222`, so it doesn't
+share the CPU (and GIL) of the process being measured.
+"""
+import argparse
+import os
+import random
+import socket
+import threading
+import time
+
+import paramiko
+
+FLOOD_LINE = b'y' * 998 + b'\r\n'
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, standin):
+        self.standin = standin
+        # chanid -> (host, port) of direct-tcpip channels not yet accepted
+        self.forwards = {}
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        self.standin.ptys.append((paramiko.util.u(term), width, height))
+        return True
+
+    def check_channel_window_change_request(self, channel, width, height, pixelwidth, pixelheight):
+        self.standin.resizes.append((width, height))
+        return True
+
+    def check_channel_shell_request(self, channel):
+        threading.Thread(target=self.standin.shell, args=(channel,), daemon=True).start()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.standin.exec, args=(channel, command), daemon=True).start()
+        return True
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.forwards[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_global_request(self, kind, msg):
+        if kind == 'keepalive@openssh.com' and not self.standin.answer_keepalives:
+            # Holds up the transport thread, so nothing else is answered either
+            self.standin.stopped.wait()
+        return False
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+    """
+    Serves the files below root.
+    """
+
+    def __init__(self, server, root):
+        super().__init__(server)
+        self.root = root
+
+    def local(self, path):
+        return os.path.join(self.root, os.path.normpath('/' + path).lstrip('/'))
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path)
+
+    def list_folder(self, path):
+        try:
+            local = self.local(path)
+            return [
+                paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local, name)), name)
+                for name in os.listdir(local)
+            ]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self.local(path), flags | getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        mode = 'ab' if flags & os.O_APPEND else 'r+b' if flags & os.O_RDWR else 'wb' if flags & os.O_WRONLY else 'rb'
+        handle = _SFTPHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+
+class SSHStandIn:
+    def __init__(self, port=0, exec_delay=(0, 0), read_input=True, stall=False, sftp_root=None, answer_keepalives=True):
+        self.exec_delay = exec_delay
+        self.read_input = read_input
+        self.stall = stall
+        self.sftp_root = sftp_root
+        self.answer_keepalives = answer_keepalives
+        self.stopped = threading.Event()
+        # (term, cols, rows) of every pty requested, and (cols, rows) of every window change
+        self.ptys = []
+        self.resizes = []
+        self.stalled = []
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.socket = socket.socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', port))
+        self.socket.listen(4096)
+        self.port = self.socket.getsockname()[1]
+        self.transports = []
+
+    def start(self):
+        threading.Thread(target=self.serve, name='sshd-standin', daemon=True).start()
+        return self
+
+    def serve(self):
+        while True:
+            try:
+                sock, _ = self.socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(sock,), daemon=True).start()
+
+    def handle(self, sock):
+        if self.stall:
+            self.stalled.append(sock)
+            return
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.host_key)
+        if self.sftp_root:
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _SFTPServer, self.sftp_root)
+        self.transports.append(transport)
+        server = _Server(self)
+        transport.start_server(server=server)
+        # Channels must be accepted, or paramiko keeps them queued forever
+        accepted = []
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is not None:
+                accepted.append(channel)
+                destination = server.forwards.pop(channel.get_id(), None)
+                if destination is not None:
+                    threading.Thread(target=self.forward, args=(channel, destination), daemon=True).start()
+
+    def shell(self, channel):
+        channel.sendall(b'$ ')
+        if not self.read_input:
+            return
+        while True:
+            data = channel.recv(32768)
+            if not data or data == b'exit':
+                break
+            if data.startswith(b'flood '):
+                for _ in range(int(data.split()[1])):
+                    channel.sendall(FLOOD_LINE)
+            else:
+                channel.sendall(data)
+        channel.close()
+
+    def exec(self, channel, command):
+        low, high = self.exec_delay
+        time.sleep(random.uniform(low, high))
+        channel.sendall(b'out:' + command + b'\n')
+        channel.send_exit_status(0)
+        channel.close()
+
+    def forward(self, channel, destination):
+        try:
+            sock = socket.create_connection(destination)
+        except OSError:
+            channel.close()
+            return
+
+        def copy(source, target):
+            try:
+                while data := source.recv(32768):
+                    target.sendall(data)
+            except OSError:
+                pass
+            channel.close()
+            # Wakes the other direction up
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+        threading.Thread(target=copy, args=(sock, channel), daemon=True).start()
+        copy(channel, sock)
+
+    def stop(self):
+        self.stopped.set()
+        self.socket.close()
+        for sock in self.stalled:
+            sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=2222)
+    parser.add_argument('--exec-delay', type=float, nargs=2, default=(0, 0), metavar=('MIN', 'MAX'))
+    options = parser.parse_args()
+    standin = SSHStandIn(options.port, tuple(options.exec_delay))
+    print(f"Listening on 127.0.0.1:{standin.port}", flush=True)
+    standin.serve()
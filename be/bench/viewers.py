@@ -0,0 +1,168 @@
+"""
+Fanning one terminal's output out to its viewers.
+
+A shell floods --lines lines of output to its owner while 0, 1, 10 or 50
+viewers watch it through the viewer group, every client acknowledging
+output like the browser. A last run adds one viewer whose client never
+acknowledges, which must be dropped and resynced instead of slowing down
+the owner. Reports the owner's throughput and echo latency with the
+viewers attached, how long the last viewer took to see the end of the
+flood, the output frames and bytes viewers were sent, and the snapshots
+they needed to redraw.
+
+    uv run python -m bench.viewers [--viewers 0 1 10 50] [--lines 20000]
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from channels.testing import WebsocketCommunicator
+from django.core import signing
+
+from . import common
+from be import terminal_protocol as protocol
+from be.sessions import VIEWER_SALT
+
+# Printed after the flood, so whoever sees it has seen the whole flood
+MARKER = b'flood-done'
+
+
+class Viewer:
+    def __init__(self, session_id, acknowledge=True):
+        token = signing.dumps({'session_id': session_id, 'mode': 'view'}, salt=VIEWER_SALT)
+        self.communicator = WebsocketCommunicator(
+            common.application, f'/ws/watch/{token}/', subprotocols=[protocol.SUBPROTOCOL]
+        )
+        self.acknowledge = acknowledge
+        self.tail = b''
+        self.bytes = 0
+        self.frames = 0
+        self.snapshots = 0
+        self.done = asyncio.Event()
+        self.done_at = None
+
+    async def open(self):
+        await self.communicator.connect()
+        self.task = asyncio.create_task(self.read())
+
+    async def read(self):
+        while True:
+            message = await self.communicator.output_queue.get()
+            if message['type'] == 'websocket.close':
+                return
+            opcode, payload = protocol.decode_frame(message['bytes'])
+            if opcode == protocol.OP_CONTROL:
+                if protocol.decode_control(payload).get('type') == 'snapshot':
+                    self.snapshots += 1
+                continue
+            if opcode != protocol.OP_DATA:
+                continue
+            self.bytes += len(payload)
+            self.frames += 1
+            self.tail = (self.tail + payload)[-len(MARKER):]
+            if MARKER in self.tail and not self.done.is_set():
+                self.done_at = time.perf_counter()
+                self.done.set()
+            if self.acknowledge:
+                await self.communicator.send_to(bytes_data=protocol.encode_ack(len(payload)))
+
+    async def close(self):
+        self.task.cancel()
+        await self.communicator.disconnect()
+
+
+async def watch(server, token, viewer_count, stalled, lines):
+    session_id = uuid.uuid4().hex
+    owner = await common.Terminal(server, token, session_id).open()
+    viewers = [Viewer(session_id) for _ in range(viewer_count)]
+    if stalled:
+        viewers.append(Viewer(session_id, acknowledge=False))
+    for viewer in viewers:
+        await viewer.open()
+    # Every viewer has its snapshot
+    while any(viewer.snapshots == 0 for viewer in viewers):
+        await asyncio.sleep(0.01)
+
+    expected = len(owner.output) + lines * len(common.FLOOD_LINE) + len(MARKER)
+    start = time.perf_counter()
+    await owner.send(f'flood {lines}'.encode())
+    # Sent once the flood started, so the shell reads it as its own command
+    flooding = len(owner.output) + len(common.FLOOD_LINE)
+    await owner.read_until(lambda: len(owner.output) >= flooding)
+    await owner.send(MARKER)
+    if not await owner.read_until(lambda: len(owner.output) >= expected, 300):
+        raise RuntimeError("The flood didn't arrive in full.")
+    seconds = time.perf_counter() - start
+    watching = [viewer for viewer in viewers if viewer.acknowledge]
+    await asyncio.wait_for(asyncio.gather(*(viewer.done.wait() for viewer in watching)), 60)
+    last_viewer = max((viewer.done_at for viewer in watching), default=start) - start
+    await owner.close()
+    for viewer in viewers:
+        await viewer.close()
+    return {
+        'throughput': lines * len(common.FLOOD_LINE) / seconds,
+        'last_viewer': last_viewer,
+        'frames': sum(viewer.frames for viewer in viewers),
+        'bytes': sum(viewer.bytes for viewer in viewers),
+        'snapshots': sum(viewer.snapshots for viewer in viewers) - len(viewers),
+        'stalled_bytes': viewers[-1].bytes if stalled else None,
+    }
+
+
+async def echo_with_viewers(server, token, viewer_count):
+    # Echo latency of the owner of a session with viewers attached
+    session_id = uuid.uuid4().hex
+    owner = await common.Terminal(server, token, session_id).open()
+    viewers = [Viewer(session_id) for _ in range(viewer_count)]
+    for viewer in viewers:
+        await viewer.open()
+    while any(viewer.snapshots == 0 for viewer in viewers):
+        await asyncio.sleep(0.01)
+    latencies = []
+    for _ in range(100):
+        expected = len(owner.output) + 1
+        sent = time.perf_counter()
+        await owner.send(b'x')
+        await owner.read_until(lambda: len(owner.output) >= expected, 10)
+        latencies.append(time.perf_counter() - sent)
+        await asyncio.sleep(0.02)
+    await owner.close()
+    for viewer in viewers:
+        await viewer.close()
+    return latencies
+
+
+async def run(server, token, counts, lines):
+    print(f"Flood of {lines * len(common.FLOOD_LINE) / 1e6:.0f} MB")
+    print(
+        f"{'viewers':<10} {'owner':>10} {'echo p50':>9} {'echo p99':>9} {'last viewer':>11} "
+        f"{'frames':>8} {'sent':>9} {'resyncs':>7}"
+    )
+    runs = [(count, False) for count in counts] + [(counts[-1], True)]
+    for count, stalled in runs:
+        result = await watch(server, token, count, stalled, lines)
+        latencies = await echo_with_viewers(server, token, count)
+        name = f"{count}{' + 1 stalled' if stalled else ''}"
+        print(
+            f"{name:<10} {result['throughput'] / 1e6:>5.1f} MB/s "
+            f"{common.percentile(latencies, 0.5) * 1000:>7.2f}ms {common.percentile(latencies, 0.99) * 1000:>7.2f}ms "
+            f"{result['last_viewer']:>10.2f}s {result['frames']:>8} {result['bytes'] / 1e6:>6.1f} MB {result['snapshots']:>7}"
+            + (f"  (stalled viewer sent {result['stalled_bytes'] / 1e6:.1f} MB)" if stalled else ''),
+            flush=True,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--viewers', type=int, nargs='+', default=[0, 1, 10, 50])
+    parser.add_argument('--lines', type=int, default=20000)
+    options = parser.parse_args()
+    with common.sshd() as port:
+        servers = common.make_servers(port)
+        _, token = common.make_user(servers)
+        asyncio.run(run(servers[0], token, options.viewers, options.lines))
+
+
+if __name__ == '__main__':
+    main()
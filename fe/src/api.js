@@ -0,0 +1,28 @@
+import axios from 'axios';
+import { backendUrl } from './config.js';
+
+// Fetches one page of a paginated listing ({ results, next }). Pass the
+// previous page's next as after to get the following page.
+const fetchPage = async (path, params = {}) => {
+  const response = await axios.get(`${backendUrl}${path}`, {
+    params,
+    headers: {
+      Authorization: `Bearer ${localStorage.getItem('token')}`,
+    },
+  });
+  return response.data;
+};
+
+// Fetches every page of a paginated listing, for pickers that need all rows
+const fetchAllPages = async (path, params = {}) => {
+  const results = [];
+  let after = null;
+  do {
+    const page = await fetchPage(path, { ...params, limit: 1000, ...(after ? { after } : {}) });
+    results.push(...page.results);
+    after = page.next;
+  } while (after);
+  return results;
+};
+
+export { fetchPage, fetchAllPages };
@@ -6,6 +6,8 @@ import { createRouter, createWebHistory } from 'vue-router';
 import LoginPage from './components/LoginPage.vue';
 import Homepage from './components/Homepage.vue';
 import TerminalPage from './components/TerminalPage.vue';
+import PlaybackPage from './components/PlaybackPage.vue';
+import WatchPage from './components/WatchPage.vue';
 
 const router = createRouter({
   history: createWebHistory(),
@@ -17,6 +19,8 @@ const router = createRouter({
     { path: '/login', component: LoginPage },
     { path: '/homepage', component: Homepage, meta: { requiresAuth: true } },
     { path: '/terminal', component: TerminalPage, meta: { requiresAuth: true } },
+    { path: '/playback', component: PlaybackPage, meta: { requiresAuth: true } },
+    { path: '/watch', component: WatchPage, meta: { requiresAuth: true } },
   ]
 });
 